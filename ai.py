@@ -1,108 +1,392 @@
+import asyncio
 import chromadb
-import numpy as np
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import json
 import os
 import datetime
+import threading
+import time
+from collections import OrderedDict
+from chromadb.config import Settings
+from src.embeddings import EmbeddingEngine, HashingEmbeddingBackend
+from src.gmail.email_store import EmailStore, SENDER_ADDRESS, SENDER_DOMAIN, SYNCED
 from src.gmail.emails_loading import EmailLoader
+from src.gmail.leases import LeaseManager
+from src.gmail.records import AttachmentRecord, EmailRecord
+from src.metrics import metrics
+from src.pipeline import IngestPipeline
+from src.process_pool import create_process_pool
+from src.result_sessions import ListCursor, ResultCursor
+from src.summaries import SummaryEngine
+from src.utils import CHROMA_HOST, CHROMA_PATH
+
+# Шард - отдельная коллекция Chroma на пользователя (chat id из auth_tokens)
+SHARD_PREFIX = "emails"
+LEGACY_COLLECTION = "emails"
+MAX_OPEN_SHARDS = 256
+SHARD_IDLE_TTL = 15 * 60
+# Предел памяти под загруженные HNSW-индексы; сверх него Chroma выгружает давно не использованные
+VECTOR_MEMORY_LIMIT = 512 * 1024 * 1024
 
 class EmailVectorDatabase:
-    def __init__(self, collection_name: str = "emails"):
-        self.client = chromadb.Client()
-        self.collection = self.client.get_or_create_collection(collection_name)
-        self.email_data = []
-        
-    def add_email(self, email: Dict, embedding: List[float]):
-        email_id = str(len(self.email_data))
-        self.email_data.append(email)
+    """
+    Векторный индекс писем, разбитый на коллекции по пользователям: поиск идёт только по
+    ящику пользователя, и его стоимость не зависит от числа остальных пользователей.
+    Коллекции открываются при первом обращении, простаивающие закрываются; загруженные
+    сегменты Chroma вытесняет по LRU при превышении memory_limit.
+    """
+
+    def __init__(self, store: EmailStore, shard_prefix: str = SHARD_PREFIX, path: str = CHROMA_PATH,
+                 max_open_shards: int = MAX_OPEN_SHARDS, idle_ttl: float = SHARD_IDLE_TTL,
+                 memory_limit: int = VECTOR_MEMORY_LIMIT, host: Optional[str] = CHROMA_HOST):
+        if host:
+            # Общий сервер Chroma: встроенный PersistentClient не рассчитан на запись из нескольких процессов
+            hostname, _, port = host.partition(":")
+            self.client = chromadb.HttpClient(host=hostname, port=int(port or 8000),
+                                              settings=Settings(anonymized_telemetry=False))
+        else:
+            # Индекс хранится на диске и переживает перезапуск; id вектора - id письма в Gmail
+            self.client = chromadb.PersistentClient(path=path, settings=Settings(
+                anonymized_telemetry=False,
+                chroma_segment_cache_policy="LRU",
+                chroma_memory_limit_bytes=memory_limit,
+            ))
+        self.store = store
+        self.shard_prefix = shard_prefix
+        self.max_open_shards = max_open_shards
+        self.idle_ttl = idle_ttl
+        self._shards: "OrderedDict[str, Tuple[object, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._drop_legacy_collection()
+
+    def shard_name(self, user_id: str) -> str:
+        return f"{self.shard_prefix}-u{user_id}"
+
+    def _drop_legacy_collection(self):
+        # Общая коллекция всех пользователей из прежних версий; после удаления индекс пуст
+        # и EmailBridge.setup переиндексирует хранилище уже по шардам
+        if LEGACY_COLLECTION in self._collection_names():
+            self.client.delete_collection(LEGACY_COLLECTION)
+
+    def _collection_names(self) -> List[str]:
+        # Старые версии chromadb возвращают объекты коллекций, новые - имена
+        return [getattr(collection, "name", collection) for collection in self.client.list_collections()]
+
+    def _shard(self, user_id: str, create: bool = True):
+        user_id = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._shards.get(user_id)
+            if entry is not None:
+                self._shards[user_id] = (entry[0], now)
+                self._shards.move_to_end(user_id)
+                return entry[0]
+        if create:
+            collection = self.client.get_or_create_collection(self.shard_name(user_id))
+        else:
+            try:
+                collection = self.client.get_collection(self.shard_name(user_id))
+            except Exception:
+                # Такого шарда нет: у пользователя ещё ничего не проиндексировано
+                return None
+        with self._lock:
+            self._shards[user_id] = (collection, now)
+            self._shards.move_to_end(user_id)
+            self._evict(now)
+        return collection
+
+    def _evict(self, now: float):
+        while len(self._shards) > self.max_open_shards:
+            self._shards.popitem(last=False)
+        while self._shards:
+            _, last_used = next(iter(self._shards.values()))
+            if now - last_used <= self.idle_ttl:
+                break
+            self._shards.popitem(last=False)
+
+    def open_shards(self) -> int:
+        return len(self._shards)
         
-        self.collection.add(
-            ids=[email_id],
-            embeddings=[embedding],
+    def add_email(self, email: EmailRecord, embedding: List[float]):
+        self.add_emails([email], [embedding])
+
+    def add_emails(self, emails: List[EmailRecord], embeddings: List[List[float]]):
+        # Письма хранятся в EmailStore, в индексе только вектор и метаданные
+        by_user: Dict[str, Tuple[List[EmailRecord], List[List[float]]]] = {}
+        for email, embedding in zip(emails, embeddings):
+            user_emails, user_embeddings = by_user.setdefault(email.user_id, ([], []))
+            user_emails.append(email)
+            user_embeddings.append(embedding)
+        with metrics.timer("index_write_seconds"):
+            for user_id, (user_emails, user_embeddings) in by_user.items():
+                self._upsert(self._shard(user_id), user_emails, user_embeddings)
+        metrics.inc("emails_indexed_total", len(emails))
+        self.store.mark_indexed(emails)
+
+    def _upsert(self, collection, emails: List[EmailRecord], embeddings: List[List[float]]):
+        collection.upsert(
+            ids=[email.id for email in emails],
+            embeddings=embeddings,
             metadatas=[{
-                "from": email["from"],
-                "to": email["to"],
-                "date": email["date"],
-                "subject": email["subject"]
-            }]
-        )
-        
-    def search_by_embedding(self, query_embedding: List[float], k: int = 5) -> List[Dict]:
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=k
+                "user_id": email.user_id,
+                "from": email.sender or "",
+                "sender_address": EmailStore.sender_address(email.sender) or "",
+                "sender_domain": (EmailStore.sender_address(email.sender) or "").rpartition("@")[2],
+                "timestamp": email.timestamp or 0,
+                "to": email.recipient or "",
+                "date": email.date or "",
+                "subject": email.subject or ""
+            } for email in emails]
         )
+
+    def delete_email(self, user_id: str, email_id: str):
+        self.delete_emails(user_id, [email_id])
+
+    def delete_emails(self, user_id: str, email_ids: List[str]):
+        collection = self._shard(user_id, create=False)
+        if collection is not None and email_ids:
+            collection.delete(ids=email_ids)
+
+    def count(self) -> int:
+        return sum(self.client.get_collection(name).count() for name in self._collection_names()
+                   if name.startswith(f"{self.shard_prefix}-u"))
+
+    def user_ids(self) -> List[str]:
+        prefix = f"{self.shard_prefix}-u"
+        return [name[len(prefix):] for name in self._collection_names() if name.startswith(prefix)]
         
-        matched_emails = []
-        for i, idx in enumerate(results["ids"][0]):
-            email_idx = int(idx)
-            email = self.email_data[email_idx].copy()
-            email['number'] = email_idx + 1
-            matched_emails.append(email)
-            
-        return matched_emails
+    def search_by_embedding(self, user_id: str, query_embedding: List[float], k: int = 5,
+                            where: Optional[Dict] = None) -> List[EmailRecord]:
+        """
+        Ищет ближайшие письма в шарде пользователя. Фильтр where применяется внутри Chroma,
+        а не после выборки. Возвращает записи из хранилища как есть, без копирования.
+        """
+        if k <= 0:
+            return []
+        user_id = str(user_id)
+        with metrics.timer("vector_search_seconds"):
+            collection = self._shard(user_id, create=False)
+            size = collection.count() if collection is not None else 0
+            if size == 0:
+                return []
+            results = collection.query(query_embeddings=[query_embedding], n_results=min(k, size), where=where)
+        # Попадания разрешаются по id одним запросом, порядок близости сохраняется
+        email_ids = results["ids"][0]
+        found = {email.id: email for email in self.store.get_many(user_id, email_ids)}
+        return [found[email_id] for email_id in email_ids if email_id in found]
+
+# Режимы поиска по query: ключевые слова (FTS5), векторная близость или их слияние
+KEYWORD = "keyword"
+SEMANTIC = "semantic"
+HYBRID = "hybrid"
+# Константа reciprocal rank fusion: сглаживает разницу между первыми местами списков
+RRF_K = 60
 
 class EmailBridge:
-    def __init__(self, embedding_dimension: int = 768):
+    def __init__(self, embedding_dimension: int = 768, embedding_backend=None, index_batch_size: int = 256,
+                 summary_backend=None, processes: int = 0, precompute_summaries: bool = False):
+        """
+        processes > 0 выносит разбор писем и эмбеддинги в пул из стольких процессов.
+        precompute_summaries включает фоновую суммаризацию свежих писем (скачивает их тела).
+        """
         self.email_loader = EmailLoader()
-        self.vector_db = EmailVectorDatabase()
-        self.embedding_dimension = embedding_dimension
+        self.store = self.email_loader.store
+        self.vector_db = EmailVectorDatabase(self.store)
+        embedding_backend = embedding_backend or HashingEmbeddingBackend(embedding_dimension)
+        self.process_pool = create_process_pool(processes, embedding_backend) if processes > 0 else None
+        self.email_loader.process_pool = self.process_pool
+        self.embedding_engine = EmbeddingEngine(embedding_backend, process_pool=self.process_pool)
+        self.embedding_dimension = self.embedding_engine.dimension
+        self.index_batch_size = index_batch_size
+        self.summaries = SummaryEngine(self.email_loader, summary_backend, precompute=precompute_summaries)
+        self.pipeline = None
+        self._stopped = threading.Event()
         
-    def setup(self):
-        self.email_loader.add_email_callback(self._handle_new_email)
-        self.email_loader.start_monitoring()
-        initial_emails = self.email_loader.init_emails(50, 50)
-        for email in initial_emails:
-            self._handle_new_email(email)
-    
-    def _handle_new_email(self, email: Dict):
-        embedding = np.random.rand(self.embedding_dimension).tolist()
-        self.vector_db.add_email(email, embedding)
-    
-    def _parse_email_date(self, date_str: str) -> Optional[str]:
-        """Преобразует строку даты в формат YYYY-MM-DD."""
-        try:
-            for fmt in ["%a, %d %b %Y %H:%M:%S %z", "%d %b %Y %H:%M:%S %z"]:
-                try:
-                    dt = datetime.datetime.strptime(date_str, fmt)
-                    return dt.strftime("%Y-%m-%d")
-                except ValueError:
-                    continue
-            return None
-        except Exception:
-            return None
+    def setup(self, loop: Optional[asyncio.AbstractEventLoop] = None, initial_emails: int = 50,
+              monitor: bool = True, leases: Optional[LeaseManager] = None):
+        """
+        Без loop новые письма индексируются прямо в потоках опроса. С loop они идут через
+        IngestPipeline, и слушатели pipeline получают их в этом event loop.
+        monitor=False оставляет фоновый опрос выключенным (синхронизацию вызывают сами, как в бенчмарке).
+        С leases загружаются и опрашиваются только пользователи, арендованные этим процессом.
+        """
+        if leases is not None:
+            self.email_loader.use_leases(leases)
+            leases.start()
+        self.summaries.start()
+        if loop is not None:
+            self.pipeline = IngestPipeline(self.email_loader, self.embedding_engine, self.vector_db, loop,
+                                           summaries=self.summaries)
+            asyncio.run_coroutine_threadsafe(self.pipeline.start(), loop).result()
+            self.email_loader.set_message_sink(self.pipeline.submit)
+        else:
+            self.email_loader.add_emails_callback(self._handle_new_emails)
+        self.email_loader.add_deleted_emails_callback(self._handle_deleted_emails)
+        self.email_loader.init_emails(initial_emails, min(initial_emails, 100))
+        if self._stopped.is_set():
+            # Остановили во время первичной загрузки - опрос уже не запускаем
+            return
+        self.email_loader.score_unscored()
+        self.index_pending()
+        if monitor and not self._stopped.is_set():
+            self.email_loader.start_monitoring()
+
+    def stop(self):
+        """
+        Останавливает опрос, push-приёмник, аренды, фоновую суммаризацию и пул процессов.
+        Конвейер останавливают раньше в его event loop (pipeline.stop), чтобы пачки в очереди отменились.
+        """
+        self._stopped.set()
+        self.email_loader.stop_monitoring()
+        self.summaries.stop()
+        if self.process_pool is not None:
+            self.process_pool.shutdown(cancel_futures=True)
+
+    def index_pending(self):
+        """Досчитывает только письма, которые сохранены, но ещё не попали в индекс."""
+        if self.vector_db.count() == 0:
+            # Каталог индекса пуст (первый запуск или его удалили) - индексируем всё хранилище заново
+            self.store.reset_indexed()
+        batch = []
+        loader = self.email_loader
+        user_ids = loader._sync_user_ids() if loader.leases is not None else None
+        for email in self.store.iter_emails(sync_state=SYNCED, user_ids=user_ids):
+            batch.append(email)
+            if len(batch) >= self.index_batch_size:
+                self._handle_new_emails(batch)
+                batch = []
+        if batch:
+            self._handle_new_emails(batch)
     
-    def get_emails_by_criteria(self, criteria_type: str, criteria_value: str, top_k: int = 5) -> List[Dict]:
-        query_embedding = np.random.rand(self.embedding_dimension).tolist()
-        all_results = self.vector_db.search_by_embedding(query_embedding, k=len(self.vector_db.email_data))
-        filtered_results = []
-        for result in all_results:
-            if criteria_type == "date":
-                email_date = self._parse_email_date(result['date'])
-                if email_date and email_date == criteria_value:
-                    filtered_results.append(result)
-            elif criteria_type == "sender" and criteria_value.lower() in result['from'].lower():
-                filtered_results.append(result)
-        for i, result in enumerate(filtered_results):
-            result['number'] = i + 1
-            
-        return filtered_results
+    def _handle_new_email(self, email: EmailRecord):
+        self._handle_new_emails([email])
+
+    def _handle_new_emails(self, emails: List[EmailRecord]):
+        embeddings = self.embedding_engine.embed_emails(emails)
+        self.vector_db.add_emails(emails, embeddings)
+        self.summaries.submit(emails)
+
+    def _handle_deleted_emails(self, user_id: str, email_ids: List[str]):
+        self.vector_db.delete_emails(user_id, email_ids)
     
-    def get_email_summaries(self, criteria_type: str, criteria_value: str) -> List[Dict]:
-        """Получает список писем с номерами и темами для отображения."""
-        emails = self.get_emails_by_criteria(criteria_type, criteria_value)
-        
-        summaries = []
-        for email in emails:
-            summaries.append({
-                "number": email["number"],
-                "subject": email["subject"] or "(No Subject)"
-            })
-        
-        return summaries
+    def get_emails_by_criteria(self, user_id: str, criteria_type: str, criteria_value: str, top_k: int = 5,
+                               query: Optional[str] = None, mode: str = HYBRID) -> List[EmailRecord]:
+        """
+        Письма пользователя по отправителю ("sender") или дню YYYY-MM-DD по UTC ("date"). Без query выборка идёт
+        по индексам хранилища; с query - поиск top_k с тем же фильтром в режиме mode:
+        keyword (полнотекстовый индекс), semantic (Chroma) или hybrid (слияние обоих).
+        """
+        sender = criteria_value if criteria_type == "sender" else None
+        start = end = None
+        if criteria_type == "date":
+            day = datetime.datetime.strptime(criteria_value, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+            start = int(day.timestamp())
+            end = start + 24 * 60 * 60
+        return self._find(str(user_id), sender, start, end, top_k, query, mode)
+
+    def get_emails_by_date_range(self, user_id: str, start: datetime.datetime, end: datetime.datetime,
+                                 top_k: int = 5, query: Optional[str] = None, mode: str = HYBRID) -> List[EmailRecord]:
+        """Письма пользователя за полуинтервал [start, end); наивные datetime считаются UTC."""
+        return self._find(str(user_id), None, self._to_epoch(start), self._to_epoch(end), top_k, query, mode)
+
+    @staticmethod
+    def _to_epoch(value: datetime.datetime) -> int:
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp())
+
+    def _find(self, user_id: str, sender: Optional[str], start: Optional[int], end: Optional[int],
+              top_k: int, query: Optional[str], mode: str = HYBRID) -> List[EmailRecord]:
+        if query is None:
+            return self.store.find(user_id=user_id, sender=sender, start=start, end=end)
+        if mode == KEYWORD:
+            return self.store.search_text(user_id, query, top_k, sender=sender, start=start, end=end)
+        if mode == SEMANTIC:
+            return self._semantic_search(user_id, sender, start, end, top_k, query)
+        # Кандидатов берём с запасом, чтобы письмо из середины обоих списков могло подняться наверх
+        with metrics.timer("hybrid_search_seconds"):
+            keyword = self.store.search_text(user_id, query, top_k * 2, sender=sender, start=start, end=end)
+            semantic = self._semantic_search(user_id, sender, start, end, top_k * 2, query)
+            return self._fuse([keyword, semantic], top_k)
+
+    @staticmethod
+    def _fuse(rankings: List[List[EmailRecord]], top_k: int) -> List[EmailRecord]:
+        """
+        Reciprocal rank fusion: письмо получает сумму 1 / (RRF_K + место) по спискам. Места, а не
+        bm25 и расстояния, потому что шкалы у полнотекстового и векторного поиска несравнимы.
+        """
+        scores: Dict[Tuple[str, str], float] = {}
+        emails: Dict[Tuple[str, str], EmailRecord] = {}
+        for ranking in rankings:
+            for rank, email in enumerate(ranking, start=1):
+                key = (email.user_id, email.id)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+                emails.setdefault(key, email)
+        best = sorted(scores, key=scores.__getitem__, reverse=True)[:top_k]
+        return [emails[key] for key in best]
+
+    def _semantic_search(self, user_id: str, sender: Optional[str], start: Optional[int],
+                         end: Optional[int], top_k: int, query: str) -> List[EmailRecord]:
+        conditions = []
+        if sender:
+            kind, value = EmailStore.sender_filter(sender, user_id)
+            if kind == SENDER_ADDRESS:
+                conditions.append({"sender_address": value})
+            elif kind == SENDER_DOMAIN:
+                conditions.append({"sender_domain": value})
+            else:
+                # Префиксов и поиска по имени в фильтрах Chroma нет: подходящие адреса берём из хранилища
+                addresses = self.store.sender_addresses(user_id, value)
+                if not addresses:
+                    return []
+                conditions.append({"sender_address": {"$in": addresses}})
+        if start is not None:
+            conditions.append({"timestamp": {"$gte": start}})
+        if end is not None:
+            conditions.append({"timestamp": {"$lt": end}})
+        where = None
+        if len(conditions) == 1:
+            where = conditions[0]
+        elif conditions:
+            where = {"$and": conditions}
+        query_embedding = self.embedding_engine.embed_query(query)
+        return self.vector_db.search_by_embedding(user_id, query_embedding, k=top_k, where=where)
     
-    def get_email_by_number(self, number: int) -> Optional[Dict]:
-        """Получает полное содержимое письма по его номеру."""
-        if 0 < number <= len(self.vector_db.email_data):
-            return self.vector_db.email_data[number - 1]
-        return None
+    def get_email_body(self, user_id: str, email_id: str) -> Optional[str]:
+        """Тело письма; при первом обращении скачивается из Gmail и кэшируется в хранилище."""
+        return self.email_loader.get_email_body(str(user_id), email_id)
+
+    def get_attachments(self, user_id: str, email_id: str) -> List[AttachmentRecord]:
+        """Метаданные вложений письма; сохранены при загрузке, запросов к Gmail не требуют."""
+        return self.email_loader.get_attachments(str(user_id), email_id)
+
+    def get_attachment_path(self, user_id: str, email_id: str, part_id: str) -> Optional[str]:
+        """Файл вложения из дискового кэша; при первом открытии скачивается из Gmail."""
+        return self.email_loader.get_attachment(str(user_id), email_id, part_id)
+
+    def get_user_email(self, user_id: str, number: int) -> Optional[EmailRecord]:
+        """Письмо по номеру, только если оно принадлежит пользователю (номер приходит из кнопки)."""
+        email = self.store.get_by_number(number)
+        return email if email is not None and email.user_id == str(user_id) else None
+
+    def search_cursor(self, user_id: str, sender: Optional[str] = None, start: Optional[datetime.datetime] = None,
+                      end: Optional[datetime.datetime] = None, query: Optional[str] = None, top_k: int = 20,
+                      mode: str = HYBRID):
+        """
+        Курсор по письмам пользователя (новые первыми) для постраничного показа. Без query
+        страницы читаются из хранилища по мере листания; с query - top_k поиска в режиме mode.
+        """
+        start = self._to_epoch(start) if start is not None else None
+        end = self._to_epoch(end) if end is not None else None
+        if query is not None:
+            return ListCursor(self._find(str(user_id), sender, start, end, top_k, query, mode))
+        return ResultCursor(lambda before, limit: self.store.find(user_id=str(user_id), sender=sender, start=start,
+                                                                  end=end, limit=limit, before=before))
+
+    def importance_cursor(self, user_id: str, bucket: str) -> ResultCursor:
+        """Курсор по корзине high/medium/low; важность посчитана при загрузке, здесь только выборка."""
+        return ResultCursor(lambda before, limit: self.store.find_by_importance(str(user_id), bucket, limit, before))
+
+    def summarize_email(self, user_id: str, email_id: str) -> Optional[str]:
+        """Краткое содержание письма: из кэша, если его уже посчитали в фоне, иначе считается сейчас."""
+        return self.summaries.get_summary(str(user_id), email_id)
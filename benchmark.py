@@ -0,0 +1,296 @@
+"""
+Офлайн-бенчмарк синхронизации и поиска на локальной замене Gmail API (src/gmail/fake_api.py).
+Не требует аккаунта Google и сети: база и индекс создаются во временном каталоге.
+
+    python benchmark.py --users 4 --messages 2000 --new 50 --latency 0.05 --mime plain=0.5,html=0.5
+
+Отчёт: скорость загрузки и индексации (писем/с), число вызовов API на новое письмо,
+p50/p99 задержек поиска и обработчиков бота, пиковый RSS процесса.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+
+class BenchMessage:
+    """Минимальная замена aiogram Message для прямого вызова обработчиков."""
+
+    def __init__(self, user_id: str, text: str = ""):
+        self.chat = self.from_user = _Chat(int(user_id))
+        self.text = text
+        self.answers: List[str] = []
+        self.markup = None
+
+    async def answer(self, text: str, reply_markup=None, **kwargs):
+        self.answers.append(text)
+        if reply_markup is not None:
+            self.markup = reply_markup
+
+    async def edit_reply_markup(self, reply_markup=None, **kwargs):
+        self.markup = reply_markup
+
+
+class BenchCallback:
+    def __init__(self, user_id: str, data: str):
+        self.from_user = _Chat(int(user_id))
+        self.data = data
+        self.message = BenchMessage(user_id)
+
+    async def answer(self, text: str = None, **kwargs):
+        pass
+
+
+class BenchState:
+    """Замена FSMContext: состояние и данные в словаре."""
+
+    def __init__(self, **data):
+        self.data = dict(data)
+        self.state = None
+
+    async def get_data(self) -> Dict:
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+    async def set_state(self, state):
+        self.state = state
+
+    async def clear(self):
+        self.data, self.state = {}, None
+
+
+class _Chat:
+    def __init__(self, id: int):
+        self.id = id
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def measure(func: Callable, iterations: int) -> Dict[str, float]:
+    """Задержки вызова func() в миллисекундах."""
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": percentile(latencies, 50), "p99_ms": percentile(latencies, 99), "n": iterations}
+
+
+def api_calls(api) -> Dict[str, int]:
+    calls = dict(api.calls)
+    calls["requests"] = sum(n for method, n in calls.items() if method not in ("http", "errors"))
+    return calls
+
+
+def parse_mime_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, _, share = item.partition("=")
+        mix[kind.strip()] = float(share)
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=1000, help="писем в каждом ящике")
+    parser.add_argument("--new", type=int, default=50, help="новых писем на пользователя за раунд синхронизации")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка HTTP-запроса к API, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 на messages.get")
+    parser.add_argument("--mime", type=parse_mime_mix, default=None,
+                        help="доли типов писем, например plain=0.4,html=0.2,alternative=0.3,attachment=0.1")
+    parser.add_argument("--queries", type=int, default=200, help="повторов каждого запроса поиска")
+    parser.add_argument("--workers", type=int, default=8, help="параллельных синхронизаций, как в PollScheduler")
+    parser.add_argument("--attachments", type=int, default=50, help="сколько вложений открыть (дважды)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="куда дополнительно записать результаты в JSON")
+    parser.add_argument("--keep", action="store_true", help="не удалять временный каталог с базой и индексом")
+    return parser.parse_args()
+
+
+def run(args) -> Dict:
+    # Модули приложения читают пути к базе и индексу при импорте, поэтому импортируем их после подмены
+    from ai import HYBRID, KEYWORD, SEMANTIC
+    import interface
+    from interface import handle_email_pagination, process_end_date, result_sessions, show_selected_email
+    from src.gmail.fake_api import FakeAuth, FakeClientCache, FakeGmailApi, FakeMailbox
+    from src.storage import db
+
+    # Фоновая суммаризация выключена (как по умолчанию в боте): её скачивания тел попали бы
+    # в счётчики вызовов API синхронизации и открытия вложений
+    interface.init_app(precompute_summaries=False)
+    email_bridge = interface.email_bridge
+    rng = random.Random(args.seed)
+    api = FakeGmailApi(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    user_ids = [str(100000 + i) for i in range(args.users)]
+    for i, user_id in enumerate(user_ids):
+        api.add_mailbox(user_id, FakeMailbox(f"user{i}@example.com", size=args.messages,
+                                             mime_mix=args.mime, seed=args.seed + i))
+    db.executemany("INSERT OR REPLACE INTO auth_tokens (user_id, token) VALUES (?, ?)",
+                   [(user_id, "{}") for user_id in user_ids])
+
+    loader = email_bridge.email_loader
+    loader.auth_service = FakeAuth(api)
+    loader.clients = FakeClientCache(api)
+    results = {"config": {key: value for key, value in vars(args).items() if key not in ("json", "keep")}}
+
+    # Первичная загрузка: список, batch-загрузка метаданных, сохранение и индексация
+    start = time.perf_counter()
+    email_bridge.setup(initial_emails=args.messages, monitor=False)
+    elapsed = time.perf_counter() - start
+    total = email_bridge.store.count()
+    results["backfill"] = {"messages": total, "seconds": elapsed, "messages_per_second": total / elapsed,
+                           "api_calls_per_message": api_calls(api)["requests"] / max(total, 1),
+                           "http_round_trips": api.calls["http"],
+                           "embeddings_per_second": email_bridge.embedding_engine.stats()["embeddings_per_second"]}
+
+    # Первая синхронизация только заводит history-курсоры
+    for user_id in user_ids:
+        loader.sync_user(user_id, loader.auth_service.load_creds(user_id))
+
+    # Живая синхронизация: в ящики приходят новые письма, а опрос забирает их по истории
+    sync_seconds, delivered = 0.0, 0
+    api.reset_calls()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for _ in range(args.rounds):
+            for user_id in user_ids:
+                api.mailboxes[user_id].deliver(args.new)
+            start = time.perf_counter()
+            list(executor.map(lambda uid: loader.sync_user(uid, loader.auth_service.load_creds(uid)), user_ids))
+            sync_seconds += time.perf_counter() - start
+            delivered += args.new * len(user_ids)
+    calls = api_calls(api)
+    results["live_sync"] = {"messages": delivered, "seconds": sync_seconds,
+                            "messages_per_second": delivered / sync_seconds if sync_seconds else 0.0,
+                            "api_calls_per_message": calls["requests"] / max(delivered, 1),
+                            "http_round_trips_per_message": calls.get("http", 0) / max(delivered, 1),
+                            "calls": calls}
+
+    # Поиск: по отправителю и дням идёт через индексы хранилища, с query - через FTS5, Chroma или оба
+    senders = [f"sender{i}@example.com" for i in range(0, 50, 4)]
+    days = [(datetime.now() - timedelta(days=d)).strftime("%Y-%m-%d") for d in range(1, 7)]
+    results["lookups"] = {
+        "sender": measure(lambda: email_bridge.get_emails_by_criteria(
+            rng.choice(user_ids), "sender", rng.choice(senders)), args.queries),
+        "domain": measure(lambda: email_bridge.get_emails_by_criteria(
+            rng.choice(user_ids), "sender", "example.com"), args.queries),
+        "date": measure(lambda: email_bridge.get_emails_by_criteria(
+            rng.choice(user_ids), "date", rng.choice(days)), args.queries),
+        "semantic": measure(lambda: email_bridge.get_emails_by_criteria(
+            rng.choice(user_ids), "date", rng.choice(days), query="project deadline", mode=SEMANTIC),
+            args.queries),
+        "keyword": measure(lambda: email_bridge.get_emails_by_criteria(
+            rng.choice(user_ids), "date", rng.choice(days), query="project deadline", mode=KEYWORD),
+            args.queries),
+        "hybrid": measure(lambda: email_bridge.get_emails_by_criteria(
+            rng.choice(user_ids), "date", rng.choice(days), query="project deadline", mode=HYBRID),
+            args.queries),
+    }
+
+    # Обработчики бота вызываются напрямую, ответы в Telegram не отправляются
+    loop = asyncio.new_event_loop()
+    start_date = datetime.now() - timedelta(days=3)
+
+    def date_range_handler():
+        user_id = rng.choice(user_ids)
+        message = BenchMessage(user_id, datetime.now().strftime("%d.%m.%Y"))
+        loop.run_until_complete(process_end_date(message, BenchState(start_date=start_date)))
+        return user_id, message.markup.inline_keyboard
+
+    # Кнопки берутся из клавиатуры, которую обработчик отправил бы пользователю
+    def open_email_handler():
+        user_id, keyboard = date_range_handler()
+        callback = BenchCallback(user_id, keyboard[0][0].callback_data)
+        loop.run_until_complete(show_selected_email(callback, BenchState()))
+
+    def pagination_handler():
+        user_id, keyboard = date_range_handler()
+        for _ in range(3):
+            callback = BenchCallback(user_id, keyboard[-1][-1].callback_data)
+            loop.run_until_complete(handle_email_pagination(callback))
+            if callback.message.markup is None:
+                break
+            keyboard = callback.message.markup.inline_keyboard
+
+    api.reset_calls()
+    results["handlers"] = {
+        "date_range": measure(date_range_handler, args.queries),
+        "open_email": measure(open_email_handler, args.queries),
+        "pagination": measure(pagination_handler, args.queries),
+        "body_downloads": api.calls["messages.get"],
+        "result_sessions": len(result_sessions),
+    }
+    loop.close()
+
+    # Вложения: первое открытие скачивает файл в кэш, повторное и тот же файл в другом письме - нет
+    rows = db.query_all("SELECT user_id, message_id, part_id FROM attachments LIMIT ?", (args.attachments,))
+    opened = {}
+    for label in ("first_open", "repeat_open"):
+        api.reset_calls()
+        start = time.perf_counter()
+        for user_id, message_id, part_id in rows:
+            email_bridge.get_attachment_path(user_id, message_id, part_id)
+        opened[label] = {"seconds": time.perf_counter() - start, "api_calls": api_calls(api)["requests"]}
+    cache = loader.attachment_cache
+    results["attachments"] = dict(opened, opened=len(rows), cached_files=len(db.query_all(
+        "SELECT content_hash FROM attachment_blobs")), cache_mb=cache.size() / (1024 * 1024))
+
+    # ru_maxrss на Linux в килобайтах, на macOS в байтах
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["peak_rss_mb"] = peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return results
+
+
+def print_report(results: Dict):
+    for stage in ("backfill", "live_sync"):
+        data = results[stage]
+        print(f"{stage:>10}: {data['messages']} msgs in {data['seconds']:.2f}s, "
+              f"{data['messages_per_second']:.1f} msg/s, {data['api_calls_per_message']:.2f} API calls/msg")
+    for group in ("lookups", "handlers"):
+        for name, data in results[group].items():
+            if isinstance(data, dict):
+                print(f"{name:>10}: p50 {data['p50_ms']:.2f} ms, p99 {data['p99_ms']:.2f} ms")
+    print(f"{'bodies':>10}: {results['handlers']['body_downloads']} downloaded on open")
+    attachments = results["attachments"]
+    print(f"{'attachments':>10}: {attachments['opened']} opened, API calls {attachments['first_open']['api_calls']} "
+          f"first / {attachments['repeat_open']['api_calls']} repeat, "
+          f"{attachments['cached_files']} files ({attachments['cache_mb']:.1f} MB) on disk")
+    print(f"{'peak RSS':>10}: {results['peak_rss_mb']:.1f} MB")
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="gmail-bench-")
+    os.environ["GMAIL_BOT_DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["GMAIL_BOT_CHROMA_PATH"] = os.path.join(workdir, "chroma")
+    os.environ["GMAIL_BOT_ATTACHMENT_DIR"] = os.path.join(workdir, "attachments")
+    try:
+        results = run(args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
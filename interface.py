@@ -1,7 +1,14 @@
 from src.gmail.auth import GmailAuth
+from ai import EmailBridge
+from src.gmail.records import EmailRecord
+from src.metrics import DEFAULT_METRICS_PORT, metrics, start_metrics_server
+from src.result_sessions import ResultSession, ResultSessions
+import asyncio
+import functools
 import os
 import re
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Optional, Callable, Any, Awaitable
 
 from aiogram import Bot, Dispatcher, Router, types
@@ -13,7 +20,8 @@ from aiogram.types import (
     KeyboardButton,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    ReplyKeyboardRemove
+    ReplyKeyboardRemove,
+    FSInputFile
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
@@ -31,24 +39,59 @@ class RegistrationMiddleware(BaseMiddleware):
 
     async def __call__(self, handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
                        event: Message, data: Dict[str, Any]):
-        if self.auth_manager.load_creds(event.chat.id) is None:
+        # Только поиск в кэше: токены обновляет фоновый поток GmailAuth, а не event loop
+        if self.auth_manager.get_cached_creds(event.chat.id) is None:
             await event.answer("Пожалуйста, сначала авторизуйтесь.")
             return
         return await handler(event, data)
 
+class MetricsMiddleware(BaseMiddleware):
+    """Время и ошибки каждого обработчика; ставится раньше RegistrationMiddleware, чтобы учитывать и её."""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else type(event).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("handler_seconds", time.perf_counter() - started, handler=name)
+
 # Initialize bot and dispatcher
-bot = Bot(token=('7646882683:AAF2DvdkSx7Fgn8gndjZWFpw8x8VUDnWFhk'))
+# Bot и EmailBridge создаёт init_app: пул процессов запускается через spawn, и дочерние процессы
+# импортируют главный модуль заново - на уровне модуля здесь не должно быть ни клиента Chroma, ни пула
+bot: Optional[Bot] = None
+email_bridge: Optional[EmailBridge] = None
 dp = Dispatcher()
 registration_router = Router()
 router = Router()
 dp.include_router(router)
 dp.include_router(registration_router)
 
+for observed_router in (router, registration_router):
+    observed_router.message.middleware(MetricsMiddleware())
+    observed_router.callback_query.middleware(MetricsMiddleware())
 registration_router.message.middleware(RegistrationMiddleware())
 
-# Mock data storage for emails (in a real app, you'd use a database)
-user_emails = {}
-user_auth = {}
+def init_app(processes: int = 0, precompute_summaries: bool = False):
+    """
+    Создаёт бота и EmailBridge; processes > 0 выносит разбор писем и эмбеддинги в пул процессов,
+    precompute_summaries включает фоновую суммаризацию свежих писем.
+    """
+    global bot, email_bridge
+    bot = Bot(token=('7646882683:AAF2DvdkSx7Fgn8gndjZWFpw8x8VUDnWFhk'))
+    email_bridge = EmailBridge(processes=processes, precompute_summaries=precompute_summaries)
+
+# Результаты поиска: одна сессия с курсором на пользователя, в памяти только текущая страница
+result_sessions = ResultSessions()
+# Данные кнопок короткие: номер письма или id сессии и страница
+SELECT_EMAIL_PREFIX = "es:"
+EMAIL_PAGE_PREFIX = "ep:"
+ATTACHMENT_PREFIX = "at:"
 
 # States
 class AuthState(StatesGroup):
@@ -61,6 +104,9 @@ class DateRangeState(StatesGroup):
 class SenderState(StatesGroup):
     waiting_for_sender = State()
 
+class SearchState(StatesGroup):
+    waiting_for_query = State()
+
 class EmailSelectionState(StatesGroup):
     waiting_for_email_selection = State()
 
@@ -76,37 +122,93 @@ class TemplateState(StatesGroup):
 
 
 # Helper functions
-def create_email_list_keyboard(emails: List[Dict], page: int = 0, page_size: int = 5) -> InlineKeyboardMarkup:
+def email_to_view(email: EmailRecord) -> Dict:
+    """Приводит письмо из хранилища к виду, в котором его показывают обработчики."""
+    return {
+        "id": email.id,
+        "user_id": email.user_id,
+        "subject": email.subject or "(Без темы)",
+        "sender": email.sender,
+        "date": datetime.fromtimestamp(email.timestamp, tz=timezone.utc) if email.timestamp is not None else None,
+        # None - тело ещё не скачано, оно загрузится при открытии письма
+        "content": email.body if email.body_loaded else None,
+        "snippet": email.snippet,
+    }
+
+async def load_email_content(email: Dict) -> str:
+    if email.get("content") is None and "user_id" in email:
+        loop = asyncio.get_running_loop()
+        try:
+            email["content"] = await loop.run_in_executor(None, email_bridge.get_email_body,
+                                                          email["user_id"], email["id"])
+        except Exception as e:
+            # Письмо могли удалить в Gmail, или сеть недоступна - показываем хотя бы сниппет
+            print(f"Failed to load email body {email['id']}: {e}")
+            return email.get("snippet") or ""
+    return email.get("content") or email.get("snippet") or ""
+
+def create_email_list_keyboard(session: ResultSession) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     
     # Add email selection buttons
-    for i, email in enumerate(emails[page*page_size:(page+1)*page_size], start=page*page_size):
+    for i, email in enumerate(session.emails, start=session.offset):
         builder.add(InlineKeyboardButton(
-            text=f"{i+1}. {email['subject']}",
-            callback_data=f"select_email_{i}"
+            text=f"{i+1}. {email.subject or '(Без темы)'}",
+            callback_data=f"{SELECT_EMAIL_PREFIX}{email.number}"
         ))
     
     # Add pagination if needed
-    if len(emails) > page_size:
-        row = []
-        if page > 0:
-            row.append(InlineKeyboardButton(
-                text="⬅️ Previous",
-                callback_data=f"email_page_{page-1}"
-            ))
-        if (page+1)*page_size < len(emails):
-            row.append(InlineKeyboardButton(
-                text="Next ➡️",
-                callback_data=f"email_page_{page+1}"
-            ))
+    row = []
+    if session.page > 0:
+        row.append(InlineKeyboardButton(
+            text="⬅️ Previous",
+            callback_data=f"{EMAIL_PAGE_PREFIX}{session.id}:{session.page-1}"
+        ))
+    if session.has_next:
+        row.append(InlineKeyboardButton(
+            text="Next ➡️",
+            callback_data=f"{EMAIL_PAGE_PREFIX}{session.id}:{session.page+1}"
+        ))
+    if row:
         builder.row(*row)
     
     return builder.as_markup()
 
+async def answer_email_list(message: Message, cursor, text: str) -> bool:
+    """Открывает сессию результатов и показывает первую страницу; False, если писем нет."""
+    session = result_sessions.open(message.chat.id, cursor)
+    if not session.emails:
+        return False
+    await message.answer(text, reply_markup=create_email_list_keyboard(session))
+    return True
+
+def get_selected_email(callback: types.CallbackQuery) -> Optional[EmailRecord]:
+    try:
+        number = int(callback.data[len(SELECT_EMAIL_PREFIX):])
+    except ValueError:
+        return None
+    return email_bridge.get_user_email(str(callback.message.chat.id), number)
+
+def format_size(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024 or unit == "МБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def create_attachments_keyboard(email: EmailRecord, attachments) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for attachment in attachments:
+        builder.row(InlineKeyboardButton(
+            text=f"📎 {attachment.filename} ({format_size(attachment.size)})",
+            callback_data=f"{ATTACHMENT_PREFIX}{email.number}:{attachment.part_id}"
+        ))
+    return builder.as_markup()
+
 def get_main_keyboard() -> ReplyKeyboardMarkup:
     buttons = [
         [KeyboardButton(text="📅 Получить письма по дате")],
         [KeyboardButton(text="👤 Письма от отправителя")],
+        [KeyboardButton(text="🔍 Поиск по письмам")],
         [KeyboardButton(text="📝 Суммаризировать письмо")],
         [KeyboardButton(text="❗ Письма по важности")],
         [KeyboardButton(text="✉️ Написать шаблон ответа")]
@@ -130,7 +232,7 @@ async def cmd_start(message: Message, state: FSMContext):
 @router.message(Command("authorize"))
 async def process_register(message: Message, state: FSMContext):
     auth_manager = GmailAuth()
-    creds = auth_manager.load_creds(message.chat.id)
+    creds = auth_manager.get_cached_creds(message.chat.id)
     if creds:
         await message.answer("Вы уже авторизованы")
         return
@@ -189,21 +291,13 @@ async def process_end_date(message: Message, state: FSMContext):
         data = await state.get_data()
         start_date = data['start_date']
         
-        # Here you would normally fetch emails from your email service
-        # For this example, we'll use mock data
-        mock_emails = [
-            {"id": i, "subject": f"Письмо {i}", "sender": "sender@example.com", "date": start_date, "content": f"Содержание письма {i}"}
-            for i in range(1, 11)
-        ]
-        
-        user_emails[message.from_user.id] = mock_emails
-        
-        if not mock_emails:
+        # Конечная дата включительно; страницы читаются по индексу времени в хранилище по мере листания
+        cursor = email_bridge.search_cursor(str(message.chat.id), start=start_date, end=end_date + timedelta(days=1))
+        if not await answer_email_list(message, cursor, "Выберите письмо для просмотра:"):
             await message.answer("Писем за указанный период не найдено.", reply_markup=get_main_keyboard())
             await state.clear()
             return
         
-        await message.answer("Выберите письмо для просмотра:", reply_markup=create_email_list_keyboard(mock_emails))
         await state.set_state(EmailSelectionState.waiting_for_email_selection)
     except ValueError:
         await message.answer("Неверный формат даты. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ:")
@@ -211,10 +305,6 @@ async def process_end_date(message: Message, state: FSMContext):
 # Sender emails
 @registration_router.message(F.text == "👤 Письма от отправителя")
 async def request_sender(message: Message, state: FSMContext):
-    if message.from_user.id not in user_auth:
-        await message.answer("Пожалуйста, сначала авторизуйтесь.")
-        return
-    
     await message.answer("Введите email отправителя:")
     await state.set_state(SenderState.waiting_for_sender)
 
@@ -222,64 +312,73 @@ async def request_sender(message: Message, state: FSMContext):
 async def process_sender(message: Message, state: FSMContext):
     sender_email = message.text.strip()
     
-    # Here you would normally fetch emails from your email service
-    # For this example, we'll use mock data
-    mock_emails = [
-        {"id": i, "subject": f"Письмо от {sender_email} {i}", "sender": sender_email, "date": datetime.now(), "content": f"Содержание письма {i}"}
-        for i in range(1, 6)
-    ] if sender_email == "known@example.com" else []
-    
-    if not mock_emails:
+    cursor = email_bridge.search_cursor(str(message.chat.id), sender=sender_email)
+    if not await answer_email_list(message, cursor, "Выберите письмо для просмотра:"):
         await message.answer(f"Писем от отправителя {sender_email} не найдено. Попробуйте ввести другой email.")
         return
     
-    user_emails[message.from_user.id] = mock_emails
-    await message.answer("Выберите письмо для просмотра:", reply_markup=create_email_list_keyboard(mock_emails))
+    await state.set_state(EmailSelectionState.waiting_for_email_selection)
+
+# Text search
+@registration_router.message(F.text == "🔍 Поиск по письмам")
+async def request_search_query(message: Message, state: FSMContext):
+    await message.answer("Введите слова для поиска. Фразу можно взять в кавычки, "
+                         "искать только в теме или отправителе - subject:слово, from:имя")
+    await state.set_state(SearchState.waiting_for_query)
+
+@registration_router.message(SearchState.waiting_for_query)
+async def process_search_query(message: Message, state: FSMContext):
+    query = message.text.strip()
+    
+    # Полнотекстовый индекс и векторный поиск вместе; запрос эмбеддится в пуле, не блокируя event loop
+    loop = asyncio.get_running_loop()
+    cursor = await loop.run_in_executor(None, functools.partial(email_bridge.search_cursor,
+                                                                str(message.chat.id), query=query))
+    if not await answer_email_list(message, cursor, "Найденные письма:"):
+        await message.answer(f"По запросу «{query}» ничего не найдено. Попробуйте другие слова.")
+        return
+    
     await state.set_state(EmailSelectionState.waiting_for_email_selection)
 
 # Email summary
 @registration_router.message(F.text == "📝 Суммаризировать письмо")
 async def request_email_to_summarize(message: Message, state: FSMContext):
-    if message.from_user.id not in user_auth:
-        await message.answer("Пожалуйста, сначала авторизуйтесь.")
+    cursor = email_bridge.search_cursor(str(message.chat.id))
+    if not await answer_email_list(message, cursor, "Выберите письмо для суммаризации:"):
+        await message.answer("Писем пока нет.", reply_markup=get_main_keyboard())
         return
     
-    # Here you would normally fetch emails from your email service
-    # For this example, we'll use mock data
-    mock_emails = [
-        {"id": i, "subject": f"Письмо для суммаризации {i}", "sender": "sender@example.com", "date": datetime.now(), "content": f"Это длинное содержание письма {i}, которое нужно сократить до основных моментов."}
-        for i in range(1, 6)
-    ]
-    
-    user_emails[message.from_user.id] = mock_emails
-    await message.answer("Выберите письмо для суммаризации:", reply_markup=create_email_list_keyboard(mock_emails))
     await state.set_state(SummaryState.waiting_for_email_to_summarize)
 
-@registration_router.callback_query(SummaryState.waiting_for_email_to_summarize, F.data.startswith("select_email_"))
+@registration_router.callback_query(SummaryState.waiting_for_email_to_summarize, F.data.startswith(SELECT_EMAIL_PREFIX))
 async def summarize_email(callback: types.CallbackQuery, state: FSMContext):
-    email_index = int(callback.data.split("_")[-1])
-    emails = user_emails.get(callback.from_user.id, [])
+    selected_email = get_selected_email(callback)
     
-    if not emails or email_index >= len(emails):
+    if selected_email is None:
         await callback.answer("Письмо не найдено.")
         return
     
-    selected_email = emails[email_index]
-    
-    # Here you would normally call your summarization AI
-    summary = f"Краткое содержание письма '{selected_email['subject']}':\n\nОсновные моменты:\n1. Первый важный момент\n2. Второй важный момент\n3. Третий важный момент"
+    # Свежие письма суммаризированы заранее в фоне; иначе считаем в пуле, не блокируя event loop
+    loop = asyncio.get_running_loop()
+    try:
+        summary = await loop.run_in_executor(None, email_bridge.summarize_email,
+                                             selected_email.user_id, selected_email.id)
+    except Exception as e:
+        print(f"Failed to summarize email {selected_email.id}: {e}")
+        await callback.answer("Не удалось подготовить краткое содержание, попробуйте позже.")
+        return
+    if summary is None:
+        await callback.answer("Письмо не найдено.")
+        return
     
-    await callback.message.answer(summary, reply_markup=get_main_keyboard())
+    await callback.message.answer(f"Краткое содержание письма '{selected_email.subject or '(Без темы)'}':\n\n{summary}",
+                                  reply_markup=get_main_keyboard())
     await state.clear()
     await callback.answer()
 
 # Importance filter
 @registration_router.message(F.text == "❗ Письма по важности")
 async def request_importance_level(message: Message, state: FSMContext):
-    if message.from_user.id not in user_auth:
-        await message.answer("Пожалуйста, сначала авторизуйтесь.")
-        return
-    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔴 Важное", callback_data="importance_high")],
         [InlineKeyboardButton(text="🟡 Среднее", callback_data="importance_medium")],
@@ -293,46 +392,36 @@ async def request_importance_level(message: Message, state: FSMContext):
 async def show_emails_by_importance(callback: types.CallbackQuery, state: FSMContext):
     importance = callback.data.split("_")[-1]
     
-    # Here you would normally fetch emails from your email service filtered by importance
-    # For this example, we'll use mock data
-    mock_emails = [
-        {"id": i, "subject": f"{importance.capitalize()} важность письмо {i}", "sender": "sender@example.com", "date": datetime.now(), "content": f"Содержание {importance} важности письма {i}"}
-        for i in range(1, 6)
-    ]
+    # Важность посчитана при загрузке писем, выборка корзины идёт по индексу
+    cursor = email_bridge.importance_cursor(str(callback.message.chat.id), importance)
+    if not await answer_email_list(callback.message, cursor, "Выберите письмо для просмотра:"):
+        await callback.message.answer("Писем с такой важностью нет.", reply_markup=get_main_keyboard())
+        await state.clear()
+        await callback.answer()
+        return
     
-    user_emails[callback.from_user.id] = mock_emails
-    await callback.message.answer("Выберите письмо для просмотра:", reply_markup=create_email_list_keyboard(mock_emails))
     await state.set_state(EmailSelectionState.waiting_for_email_selection)
     await callback.answer()
 
 # Response template
 @registration_router.message(F.text == "✉️ Написать шаблон ответа")
 async def request_email_for_template(message: Message, state: FSMContext):
-    if message.from_user.id not in user_auth:
-        await message.answer("Пожалуйста, сначала авторизуйтесь.")
+    cursor = email_bridge.search_cursor(str(message.chat.id))
+    if not await answer_email_list(message, cursor, "Выберите письмо для создания шаблона ответа:"):
+        await message.answer("Писем пока нет.", reply_markup=get_main_keyboard())
         return
     
-    # Here you would normally fetch emails from your email service
-    # For this example, we'll use mock data
-    mock_emails = [
-        {"id": i, "subject": f"Письмо для шаблона ответа {i}", "sender": "sender@example.com", "date": datetime.now(), "content": f"Оригинальное содержание письма {i}"}
-        for i in range(1, 6)
-    ]
-    
-    user_emails[message.from_user.id] = mock_emails
-    await message.answer("Выберите письмо для создания шаблона ответа:", reply_markup=create_email_list_keyboard(mock_emails))
     await state.set_state(TemplateState.waiting_for_email_to_template)
 
-@registration_router.callback_query(TemplateState.waiting_for_email_to_template, F.data.startswith("select_email_"))
+@registration_router.callback_query(TemplateState.waiting_for_email_to_template, F.data.startswith(SELECT_EMAIL_PREFIX))
 async def create_response_template(callback: types.CallbackQuery, state: FSMContext):
-    email_index = int(callback.data.split("_")[-1])
-    emails = user_emails.get(callback.from_user.id, [])
+    email = get_selected_email(callback)
     
-    if not emails or email_index >= len(emails):
+    if email is None:
         await callback.answer("Письмо не найдено.")
         return
     
-    selected_email = emails[email_index]
+    selected_email = email_to_view(email)
     await state.update_data(selected_email=selected_email)
     
     await callback.message.answer(
@@ -358,44 +447,118 @@ async def save_response_template(message: Message, state: FSMContext):
     await state.clear()
 
 # Email selection handler (shared for multiple states)
-@registration_router.callback_query(EmailSelectionState.waiting_for_email_selection, F.data.startswith("select_email_"))
+@registration_router.callback_query(EmailSelectionState.waiting_for_email_selection, F.data.startswith(SELECT_EMAIL_PREFIX))
 async def show_selected_email(callback: types.CallbackQuery, state: FSMContext):
-    email_index = int(callback.data.split("_")[-1])
-    emails = user_emails.get(callback.from_user.id, [])
+    email = get_selected_email(callback)
     
-    if not emails or email_index >= len(emails):
+    if email is None:
         await callback.answer("Письмо не найдено.")
         return
     
-    selected_email = emails[email_index]
+    selected_email = email_to_view(email)
+    content = await load_email_content(selected_email)
     
+    date_text = selected_email['date'].strftime('%d.%m.%Y %H:%M') if selected_email['date'] else "-"
     email_text = (
         f"От: {selected_email['sender']}\n"
-        f"Дата: {selected_email['date'].strftime('%d.%m.%Y %H:%M')}\n"
+        f"Дата: {date_text}\n"
         f"Тема: {selected_email['subject']}\n\n"
-        f"Содержание:\n{selected_email['content']}"
+        f"Содержание:\n{content}"
     )
     
     await callback.message.answer(email_text, reply_markup=get_main_keyboard())
+    # Метаданные вложений сохранены при загрузке письма, сами файлы скачиваются по кнопке
+    attachments = email_bridge.get_attachments(email.user_id, email.id)
+    if attachments:
+        await callback.message.answer("Вложения:", reply_markup=create_attachments_keyboard(email, attachments))
     await state.clear()
     await callback.answer()
 
+@registration_router.callback_query(F.data.startswith(ATTACHMENT_PREFIX))
+async def send_attachment(callback: types.CallbackQuery):
+    number, _, part_id = callback.data[len(ATTACHMENT_PREFIX):].partition(":")
+    email = email_bridge.get_user_email(str(callback.message.chat.id), int(number)) if number.isdigit() else None
+    attachment = None
+    if email is not None:
+        attachment = next((item for item in email_bridge.get_attachments(email.user_id, email.id)
+                           if item.part_id == part_id), None)
+    if attachment is None:
+        await callback.answer("Вложение не найдено.")
+        return
+    
+    await callback.answer("Загружаю вложение...")
+    # Файл берётся из дискового кэша; при первом открытии скачивается в пуле, не блокируя event loop
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(None, email_bridge.get_attachment_path, email.user_id, email.id, part_id)
+    if path is None:
+        await callback.message.answer("Не удалось загрузить вложение.")
+        return
+    await callback.message.answer_document(FSInputFile(path, filename=attachment.filename))
+
 # Pagination handler
-@registration_router.callback_query(F.data.startswith("email_page_"))
+@registration_router.callback_query(F.data.startswith(EMAIL_PAGE_PREFIX))
 async def handle_email_pagination(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[-1])
-    emails = user_emails.get(callback.from_user.id, [])
+    session_id, _, page = callback.data[len(EMAIL_PAGE_PREFIX):].partition(":")
+    session = result_sessions.get(callback.message.chat.id, session_id)
     
-    if not emails:
-        await callback.answer("Письма не найдены.")
+    if session is None or not page.isdigit():
+        await callback.answer("Результаты поиска устарели, повторите поиск.")
         return
     
-    await callback.message.edit_reply_markup(reply_markup=create_email_list_keyboard(emails, page))
+    # Читается только запрошенная страница
+    session.show(int(page))
+    await callback.message.edit_reply_markup(reply_markup=create_email_list_keyboard(session))
     await callback.answer()
 
+async def notify_new_emails(user_id: str, emails: List[EmailRecord]):
+    lines = [f"• {email.subject or '(Без темы)'} — {email.sender}" for email in emails[:5]]
+    if len(emails) > 5:
+        lines.append(f"... и ещё {len(emails) - 5}")
+    await bot.send_message(int(user_id), "📬 Новые письма:\n" + "\n".join(lines))
+
 async def main():
-    await dp.start_polling(bot)
+    init_app(processes=int(os.getenv("GMAIL_SYNC_PROCESSES", "0")),
+             precompute_summaries=bool(os.getenv("GMAIL_PRECOMPUTE_SUMMARIES")))
+    loop = asyncio.get_running_loop()
+    # Метрики отдаются локально в формате Prometheus; METRICS_PROFILE включает /profile
+    if os.getenv("METRICS_PORT"):
+        start_metrics_server(host=os.getenv("METRICS_HOST", "127.0.0.1"),
+                             port=int(os.getenv("METRICS_PORT", str(DEFAULT_METRICS_PORT))),
+                             profile=bool(os.getenv("METRICS_PROFILE")))
+    # С GMAIL_SYNC_WORKERS почту синхронизируют процессы worker.py, а бот только отвечает пользователям.
+    # Первичная загрузка ящиков идёт в фоне: бот отвечает сразу, не дожидаясь всех пользователей
+    sync = None
+    if not os.getenv("GMAIL_SYNC_WORKERS"):
+        sync = asyncio.create_task(start_sync(loop))
+        sync.add_done_callback(report_sync_failure)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if sync is not None:
+            sync.cancel()
+        await stop_sync()
+
+def report_sync_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Failed to start email sync: {task.exception()}")
+
+async def start_sync(loop: asyncio.AbstractEventLoop, leases=None, push: bool = True):
+    # Первичная загрузка и индексация блокирующие, поэтому уходят в пул потоков;
+    # дальше новые письма приходят в этот loop через конвейер email_bridge.pipeline
+    await loop.run_in_executor(None, functools.partial(email_bridge.setup, loop, leases=leases))
+    email_bridge.pipeline.add_listener(notify_new_emails)
+    # Push-режим включается, если задан Pub/Sub-топик, на который подписан приёмник
+    if push and os.getenv("GMAIL_PUSH_TOPIC"):
+        email_bridge.email_loader.enable_push(os.getenv("GMAIL_PUSH_TOPIC"),
+                                              host=os.getenv("GMAIL_PUSH_HOST", "127.0.0.1"),
+                                              port=int(os.getenv("GMAIL_PUSH_PORT", "8085")),
+                                              token=os.getenv("GMAIL_PUSH_TOKEN"))
+
+async def stop_sync():
+    # Конвейер первым: пачки в его очереди отменяются, и history-курсор по ним не сдвигается
+    if email_bridge.pipeline is not None:
+        await email_bridge.pipeline.stop()
+    await asyncio.get_running_loop().run_in_executor(None, email_bridge.stop)
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
\ No newline at end of file
@@ -2,4 +2,168 @@ CREATE TABLE IF NOT EXISTS auth_tokens
 (
     user_id TEXT PRIMARY KEY,
     token   TEXT NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS sync_state
+(
+    user_id    TEXT PRIMARY KEY,
+    history_id TEXT    NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+
+-- id - постоянный номер письма: на него ссылаются emails_fts и кнопки бота. Явный INTEGER PRIMARY KEY,
+-- а не неявный rowid, который VACUUM может перенумеровать
+CREATE TABLE IF NOT EXISTS emails
+(
+    id             INTEGER PRIMARY KEY,
+    user_id        TEXT    NOT NULL,
+    message_id     TEXT    NOT NULL,
+    subject        TEXT,
+    sender         TEXT,
+    sender_address TEXT,
+    sender_domain  TEXT,
+    recipient      TEXT,
+    date           TEXT,
+    timestamp      INTEGER,
+    snippet        TEXT,
+    body           TEXT,
+    labels         TEXT    NOT NULL DEFAULT '[]',
+    sync_state     TEXT    NOT NULL DEFAULT 'synced',
+    importance     REAL,
+    importance_bucket TEXT,
+    updated_at     INTEGER NOT NULL,
+    UNIQUE (user_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS emails_sender_address ON emails (user_id, sender_address, timestamp);
+CREATE INDEX IF NOT EXISTS emails_sender_domain ON emails (user_id, sender_domain, timestamp);
+CREATE INDEX IF NOT EXISTS emails_timestamp ON emails (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS emails_importance ON emails (user_id, importance_bucket, timestamp);
+
+CREATE TABLE IF NOT EXISTS embedding_cache
+(
+    content_hash TEXT NOT NULL,
+    model        TEXT NOT NULL,
+    vector       BLOB NOT NULL,
+    PRIMARY KEY (content_hash, model)
+);
+
+CREATE TABLE IF NOT EXISTS gmail_watches
+(
+    user_id       TEXT PRIMARY KEY,
+    email_address TEXT    NOT NULL,
+    history_id    TEXT    NOT NULL,
+    expiration    INTEGER NOT NULL,
+    topic         TEXT    NOT NULL,
+    updated_at    INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS gmail_watches_email_address ON gmail_watches (email_address);
+
+CREATE TABLE IF NOT EXISTS summary_cache
+(
+    user_id      TEXT    NOT NULL,
+    message_id   TEXT    NOT NULL,
+    content_hash TEXT    NOT NULL,
+    model        TEXT    NOT NULL,
+    summary      TEXT    NOT NULL,
+    created_at   INTEGER NOT NULL,
+    PRIMARY KEY (user_id, message_id, model, content_hash)
+);
+
+CREATE TABLE IF NOT EXISTS sender_stats
+(
+    user_id        TEXT    NOT NULL,
+    sender_address TEXT    NOT NULL,
+    received       INTEGER NOT NULL DEFAULT 0,
+    replied        INTEGER NOT NULL DEFAULT 0,
+    updated_at     INTEGER NOT NULL,
+    PRIMARY KEY (user_id, sender_address)
+);
+
+CREATE TABLE IF NOT EXISTS sync_workers
+(
+    worker_id    TEXT PRIMARY KEY,
+    host         TEXT    NOT NULL,
+    pid          INTEGER NOT NULL,
+    started_at   INTEGER NOT NULL,
+    heartbeat_at INTEGER NOT NULL,
+    expires_at   INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user_leases
+(
+    user_id     TEXT PRIMARY KEY,
+    worker_id   TEXT    NOT NULL,
+    acquired_at INTEGER NOT NULL,
+    expires_at  INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS user_leases_worker ON user_leases (worker_id);
+
+-- Полнотекстовый индекс писем без копии текста (content=''): owner - токен пользователя вида u<user_id>,
+-- чтобы фильтр по ящику был пересечением списков в самом индексе; body - тело или сниппет, пока тело не скачано
+CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5
+(
+    owner, subject, sender, body,
+    content = '',
+    prefix = '2 3 4',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails
+WHEN new.sync_state != 'deleted'
+BEGIN
+    INSERT INTO emails_fts (rowid, owner, subject, sender, body)
+    VALUES (new.id, 'u' || new.user_id, new.subject, new.sender, COALESCE(new.body, new.snippet));
+END;
+
+CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails
+WHEN old.sync_state != 'deleted'
+BEGIN
+    INSERT INTO emails_fts (emails_fts, rowid, owner, subject, sender, body)
+    VALUES ('delete', old.id, 'u' || old.user_id, old.subject, old.sender, COALESCE(old.body, old.snippet));
+END;
+
+-- Contentless-индекс удаляет строку только по старым значениям, поэтому обновление - это delete + insert;
+-- смена synced/indexed текст не меняет и индекс не трогает
+CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF subject, sender, snippet, body, sync_state ON emails
+WHEN old.subject IS NOT new.subject OR old.sender IS NOT new.sender
+    OR COALESCE(old.body, old.snippet) IS NOT COALESCE(new.body, new.snippet)
+    OR (old.sync_state = 'deleted') != (new.sync_state = 'deleted')
+BEGIN
+    INSERT INTO emails_fts (emails_fts, rowid, owner, subject, sender, body)
+    SELECT 'delete', old.id, 'u' || old.user_id, old.subject, old.sender, COALESCE(old.body, old.snippet)
+    WHERE old.sync_state != 'deleted';
+    INSERT INTO emails_fts (rowid, owner, subject, sender, body)
+    SELECT new.id, 'u' || new.user_id, new.subject, new.sender, COALESCE(new.body, new.snippet)
+    WHERE new.sync_state != 'deleted';
+END;
+
+-- Письма, сохранённые до появления индекса; на следующих запусках индекс уже не пуст
+INSERT INTO emails_fts (rowid, owner, subject, sender, body)
+SELECT id, 'u' || user_id, subject, sender, COALESCE(body, snippet) FROM emails
+WHERE sync_state != 'deleted' AND NOT EXISTS (SELECT 1 FROM emails_fts LIMIT 1);
+
+CREATE TABLE IF NOT EXISTS attachments
+(
+    user_id       TEXT    NOT NULL,
+    message_id    TEXT    NOT NULL,
+    part_id       TEXT    NOT NULL,
+    filename      TEXT    NOT NULL,
+    mime_type     TEXT,
+    size          INTEGER NOT NULL,
+    attachment_id TEXT,
+    content_hash  TEXT,
+    PRIMARY KEY (user_id, message_id, part_id)
+);
+
+-- Файлы кэша вложений по sha256 содержимого: одно вложение у разных пользователей и в пересылках хранится один раз
+CREATE TABLE IF NOT EXISTS attachment_blobs
+(
+    content_hash TEXT PRIMARY KEY,
+    size         INTEGER NOT NULL,
+    last_used    INTEGER NOT NULL -- мс epoch последнего открытия
+);
+
+CREATE INDEX IF NOT EXISTS attachment_blobs_last_used ON attachment_blobs (last_used);
@@ -0,0 +1,100 @@
+import base64
+import hashlib
+import os
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from src.metrics import metrics
+from src.storage import db
+from src.utils import ATTACHMENT_DIR
+
+MAX_CACHE_BYTES = 1024 * 1024 * 1024
+# Кусок base64 кратен 4 символам, поэтому каждый декодируется отдельно без переноса хвоста
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+
+class AttachmentCache:
+    """
+    Дисковый кэш вложений с адресацией по sha256 содержимого: <directory>/<2 символа хэша>/<хэш>.
+    Одинаковый файл у разных пользователей и в пересылках хранится один раз. Объём ограничен
+    max_bytes; при превышении удаляются файлы, которые дольше всех не открывали.
+    """
+
+    def __init__(self, directory: str = ATTACHMENT_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash[:2], content_hash)
+
+    def open(self, content_hash: str) -> Optional[str]:
+        """Путь к файлу в кэше с отметкой об использовании; None, если файла нет (вытеснен или удалён)."""
+        path = self.path(content_hash)
+        if not os.path.exists(path):
+            db.execute("DELETE FROM attachment_blobs WHERE content_hash = ?", (content_hash,))
+            return None
+        db.execute("UPDATE attachment_blobs SET last_used = ? WHERE content_hash = ?", (time.time_ns() // 1_000_000, content_hash))
+        metrics.inc("attachment_cache_hits_total")
+        return path
+
+    def put_base64(self, data: str) -> Tuple[str, int]:
+        """
+        Сохраняет вложение из base64url-ответа Gmail: строка декодируется кусками прямо во
+        временный файл, хэш считается по дороге, так что раскодированная копия целиком в
+        памяти не собирается. Возвращает (content_hash, размер).
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for start in range(0, len(data), DECODE_CHUNK_SIZE):
+                    encoded = data[start:start + DECODE_CHUNK_SIZE]
+                    chunk = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            content_hash = digest.hexdigest()
+            path = self.path(content_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                # То же содержимое уже скачано для другого письма или пользователя
+                metrics.inc("attachment_dedup_total")
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        db.execute("""
+            INSERT INTO attachment_blobs (content_hash, size, last_used) VALUES (?, ?, ?)
+            ON CONFLICT (content_hash) DO UPDATE SET last_used = excluded.last_used
+        """, (content_hash, size, time.time_ns() // 1_000_000))
+        metrics.inc("attachment_bytes_downloaded_total", size)
+        self.evict(keep=content_hash)
+        return content_hash, size
+
+    def size(self) -> int:
+        return db.query_one("SELECT COALESCE(SUM(size), 0) FROM attachment_blobs")[0]
+
+    def evict(self, keep: Optional[str] = None):
+        """Удаляет давно не открывавшиеся файлы, пока кэш не уложится в max_bytes; keep не трогает."""
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        rows = db.query_all("SELECT content_hash, size FROM attachment_blobs ORDER BY last_used")
+        for content_hash, size in rows:
+            if total <= self.max_bytes:
+                break
+            if content_hash == keep:
+                continue
+            try:
+                os.remove(self.path(content_hash))
+            except FileNotFoundError:
+                pass
+            db.execute("DELETE FROM attachment_blobs WHERE content_hash = ?", (content_hash,))
+            total -= size
+            metrics.inc("attachment_cache_evictions_total")
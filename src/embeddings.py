@@ -0,0 +1,161 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.gmail.records import EmailRecord
+from src.metrics import metrics
+from src.process_pool import embed_in_pool
+from src.storage import db
+
+DEFAULT_DIMENSION = 768
+CACHE_SIZE = 10000
+# Дальше этого длина текста на качество эмбеддинга почти не влияет
+MAX_TEXT_LENGTH = 8000
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_email_text(subject: Optional[str], body: Optional[str]) -> str:
+    text = f"{subject or ''}\n{body or ''}"
+    return _SPACES_RE.sub(" ", text).strip().lower()[:MAX_TEXT_LENGTH]
+
+
+class HashingEmbeddingBackend:
+    """Детерминированный hashing-vectorizer (слова и биграммы): работает офлайн и без модели."""
+
+    def __init__(self, dimension: int = DEFAULT_DIMENSION):
+        self.dimension = dimension
+        self.name = f"hashing-{dimension}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _TOKEN_RE.findall(text.lower())
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                # Младший бит задаёт знак, чтобы коллизии гасили друг друга, а не копились
+                vectors[row, (value >> 1) % self.dimension] += 1.0 if value & 1 else -1.0
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerBackend:
+    """Небольшая локальная модель sentence-transformers на CPU (опциональная зависимость)."""
+
+    def __init__(self, model_name: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+                 batch_size: int = 32):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("Для SentenceTransformerBackend установите sentence-transformers") from e
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True,
+                                 convert_to_numpy=True).astype(np.float32)
+
+
+class EmbeddingEngine:
+    """
+    Считает эмбеддинги писем пачками. Векторы кэшируются по хэшу нормализованных
+    темы и тела (LRU в памяти + таблица embedding_cache), поэтому повторная
+    синхронизация и одинаковые рассылки не пересчитываются.
+    """
+
+    def __init__(self, backend=None, cache_size: int = CACHE_SIZE, process_pool=None):
+        self.backend = backend if backend is not None else HashingEmbeddingBackend()
+        # Пул из create_process_pool с тем же бэкендом: векторы считаются в дочерних процессах
+        self.process_pool = process_pool
+        self.dimension = self.backend.dimension
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._embedded = 0
+        self._cache_hits = 0
+        self._embedding_seconds = 0.0
+
+    @staticmethod
+    def content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def embed_emails(self, emails: List[EmailRecord]) -> List[List[float]]:
+        # Тело скачивается лениво, до этого индексируем по сниппету из метаданных
+        texts = [normalize_email_text(email.subject, email.body or email.snippet) for email in emails]
+        return [vector.tolist() for vector in self.embed_texts(texts)]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_texts([normalize_email_text(None, text)])[0].tolist()
+
+    def embed_texts(self, texts: List[str]) -> List[np.ndarray]:
+        hashes = [self.content_hash(text) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for content_hash in hashes:
+                if content_hash in self._cache:
+                    self._cache.move_to_end(content_hash)
+                    vectors[content_hash] = self._cache[content_hash]
+        missing = [content_hash for content_hash in dict.fromkeys(hashes) if content_hash not in vectors]
+        vectors.update(self._load_cached(missing))
+
+        to_embed = {content_hash: text for content_hash, text in zip(hashes, texts) if content_hash not in vectors}
+        if to_embed:
+            started = time.perf_counter()
+            if self.process_pool is not None:
+                computed = embed_in_pool(self.process_pool, list(to_embed.values()))
+            else:
+                computed = self.backend.embed(list(to_embed.values()))
+            elapsed = time.perf_counter() - started
+            metrics.observe("embedding_batch_seconds", elapsed, backend=self.backend.name)
+            metrics.inc("embeddings_computed_total", len(to_embed))
+            new_vectors = dict(zip(to_embed.keys(), computed))
+            vectors.update(new_vectors)
+            self._save_cached(new_vectors)
+            with self._lock:
+                self._embedded += len(new_vectors)
+                self._embedding_seconds += elapsed
+
+        metrics.inc("embedding_cache_hits_total", len(hashes) - len(to_embed))
+        with self._lock:
+            self._cache_hits += len(hashes) - len(to_embed)
+            for content_hash in set(hashes):
+                self._cache[content_hash] = vectors[content_hash]
+                self._cache.move_to_end(content_hash)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return [vectors[content_hash] for content_hash in hashes]
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "embedded": self._embedded,
+                "cache_hits": self._cache_hits,
+                "embeddings_per_second": self._embedded / self._embedding_seconds if self._embedding_seconds else 0.0,
+            }
+
+    def _load_cached(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        if not hashes:
+            return {}
+        placeholders = ",".join("?" * len(hashes))
+        rows = db.query_all(
+            f"SELECT content_hash, vector FROM embedding_cache WHERE model = ? AND content_hash IN ({placeholders})",
+            (self.backend.name, *hashes))
+        return {content_hash: np.frombuffer(vector, dtype=np.float32) for content_hash, vector in rows}
+
+    def _save_cached(self, vectors: Dict[str, np.ndarray]):
+        db.executemany("""
+            INSERT OR IGNORE INTO embedding_cache (content_hash, model, vector)
+            VALUES (?, ?, ?)
+        """, [(content_hash, self.backend.name, np.asarray(vector, dtype=np.float32).tobytes())
+              for content_hash, vector in vectors.items()])
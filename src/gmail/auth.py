@@ -1,15 +1,24 @@
-import sqlite3
-from typing import Optional
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
 import json
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from urllib.parse import urlparse, parse_qs
 
-from src.utils import DB_PATH
+from src.storage import db
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 PATH_TO_SECRETS = "configs/client_secrets.json"
+# Токен обновляется в фоне за REFRESH_MARGIN секунд до истечения
+REFRESH_MARGIN = 300
+REFRESHER_INTERVAL = 30
+# Сколько помним, что пользователь не авторизован, и сколько живут записи без срока истечения
+NEGATIVE_TTL = 30
+DEFAULT_TTL = 3600
 
 
 class GmailAuth:
@@ -26,32 +35,39 @@ class GmailAuth:
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance.active_flows = {}  # Инициализация для нового экземпляра
+            # Общий на процесс кэш: user_id -> (creds, момент, когда токен пора обновить)
+            cls._instance._creds_cache: Dict[str, Tuple[Optional[Credentials], float]] = {}
+            cls._instance._dirty_tokens: Dict[str, str] = {}
+            # user_id -> токен из БД, который Google отказался обновлять (отозван или удалён)
+            cls._instance._revoked: Dict[str, dict] = {}
+            cls._instance._cache_lock = threading.Lock()
+            cls._instance._refresher_thread = None
+            cls._instance._on_removed = None
         return cls._instance
 
     def __init__(self):
         # Теперь __init__ не перезаписывает active_flows для существующего экземпляра
         if not hasattr(self, 'active_flows'):
             self.active_flows = {}
-        print(self.active_flows)
+
+    def on_removed(self, func: Callable[[List[str]], None]):
+        """func(user_ids) вызывается из фонового потока с пользователями, чьи токены удалены из auth_tokens."""
+        self._on_removed = func
 
     def _save_token_to_db(self, user_id: str, token: str):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO auth_tokens (user_id, token)
-                VALUES (?, ?)
-            """, (user_id, token))
-            conn.commit()
+        self._save_tokens_to_db({user_id: token})
+
+    def _save_tokens_to_db(self, tokens: Dict[str, str]):
+        db.executemany("""
+            INSERT OR REPLACE INTO auth_tokens (user_id, token)
+            VALUES (?, ?)
+        """, list(tokens.items()))
 
     def _load_token_from_db(self, user_id: str) -> Optional[str]:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT token FROM auth_tokens WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if not result:
-                return None
-            result = json.loads(result[0])
-            return result
+        result = db.query_one("SELECT token FROM auth_tokens WHERE user_id = ?", (user_id,))
+        if not result:
+            return None
+        return json.loads(result[0])
 
     @staticmethod
     def get_creds_from_token(token: str) -> Credentials:
@@ -78,16 +94,112 @@ class GmailAuth:
         flow.fetch_token(code=auth_code)
         creds = flow.credentials
         self.active_flows.pop(user_id)
+        with self._cache_lock:
+            self._revoked.pop(str(user_id), None)
         self._save_token_to_db(user_id, str(creds.to_json()))
+        self._cache_creds(user_id, creds)
         return creds
 
     def load_creds(self, user_id: str) -> Optional[Credentials]:
+        """Возвращает действующие креды, при необходимости обновляя токен синхронно."""
+        creds = self.get_cached_creds(user_id)
+        if creds and not creds.valid and creds.refresh_token:
+            if not self._refresh(str(user_id), creds):
+                return None
+        return creds
+
+    def get_cached_creds(self, user_id: str) -> Optional[Credentials]:
+        """Быстрый поиск в кэше без сетевых запросов; при промахе читает токен из БД."""
+        user_id = str(user_id)
+        with self._cache_lock:
+            entry = self._creds_cache.get(user_id)
+        # Положительные записи живут, пока их не заменит фоновый рефрешер, отрицательные - NEGATIVE_TTL
+        if entry is not None and (entry[0] is not None or time.time() < entry[1]):
+            return entry[0]
         creds = None
         token = self._load_token_from_db(user_id)
-        if token:
+        with self._cache_lock:
+            revoked = self._revoked.get(user_id)
+        # Отозванный токен остаётся в БД до повторной авторизации, но пользователь уже не авторизован
+        if token and token != revoked:
             creds = Credentials.from_authorized_user_info(token, SCOPES)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-                self._save_token_to_db(user_id, str(creds.to_json()))
+        self._cache_creds(user_id, creds)
+        self._ensure_refresher()
         return creds
+
+    def _cache_creds(self, user_id: str, creds: Optional[Credentials]):
+        now = time.time()
+        if creds is None:
+            fresh_until = now + NEGATIVE_TTL
+        elif creds.expiry is not None:
+            # expiry в google-auth хранится как naive UTC
+            expires_at = (creds.expiry - datetime.utcnow()).total_seconds() + now
+            fresh_until = max(expires_at - REFRESH_MARGIN, now)
+        else:
+            fresh_until = now + DEFAULT_TTL
+        with self._cache_lock:
+            self._creds_cache[str(user_id)] = (creds, fresh_until)
+
+    def _refresh(self, user_id: str, creds: Credentials) -> bool:
+        """Обновляет токен; False, если Google его больше не принимает и нужна повторная авторизация."""
+        try:
+            creds.refresh(Request())
+        except RefreshError as e:
+            if getattr(e, "retryable", False):
+                raise
+            print(f"Token for user {user_id} was revoked: {e}")
+            token = self._load_token_from_db(user_id)
+            with self._cache_lock:
+                if token:
+                    self._revoked[user_id] = token
+                self._dirty_tokens.pop(user_id, None)
+            self._cache_creds(user_id, None)
+            return False
+        self._cache_creds(user_id, creds)
+        with self._cache_lock:
+            self._dirty_tokens[user_id] = str(creds.to_json())
+        return True
+
+    def _ensure_refresher(self):
+        with self._cache_lock:
+            if self._refresher_thread is not None:
+                return
+            self._refresher_thread = threading.Thread(target=self._refresher_worker, daemon=True)
+        self._refresher_thread.start()
+
+    def _refresher_worker(self):
+        """Обновляет токены незадолго до истечения и пачкой записывает их в БД."""
+        while True:
+            try:
+                self._drop_removed_users()
+            except Exception as e:
+                print(f"Failed to load authorized users: {e}")
+            now = time.time()
+            with self._cache_lock:
+                expiring = [(user_id, creds) for user_id, (creds, fresh_until) in self._creds_cache.items()
+                            if creds is not None and creds.refresh_token and fresh_until <= now]
+            for user_id, creds in expiring:
+                try:
+                    self._refresh(user_id, creds)
+                except Exception as e:
+                    print(f"Failed to refresh token for user {user_id}: {e}")
+            self._flush_tokens()
+            time.sleep(REFRESHER_INTERVAL)
+
+    def _drop_removed_users(self):
+        """Забывает пользователей, чьих токенов больше нет в auth_tokens."""
+        user_ids = {row[0] for row in db.query_all("SELECT user_id FROM auth_tokens")}
+        with self._cache_lock:
+            removed = [user_id for user_id in self._creds_cache if user_id not in user_ids]
+            for user_id in removed:
+                self._creds_cache.pop(user_id)
+            for user_id in [user_id for user_id in self._revoked if user_id not in user_ids]:
+                self._revoked.pop(user_id)
+        if removed and self._on_removed is not None:
+            self._on_removed(removed)
+
+    def _flush_tokens(self):
+        with self._cache_lock:
+            tokens, self._dirty_tokens = self._dirty_tokens, {}
+        if tokens:
+            self._save_tokens_to_db(tokens)
@@ -0,0 +1,67 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+
+HTTP_TIMEOUT = 60
+
+
+class _LockedHttp(AuthorizedHttp):
+    """
+    httplib2.Http не потокобезопасен, поэтому захватывается только на время самого HTTP-запроса:
+    ожидание квоты и паузы между повторами идут без блокировки, и интерактивный запрос не стоит
+    в очереди за фоновой синхронизацией того же пользователя. RLock - потому что при 401
+    AuthorizedHttp обновляет токен и повторяет request рекурсивно.
+    """
+
+    def __init__(self, creds: Credentials, http: httplib2.Http):
+        super().__init__(creds, http=http)
+        self._request_lock = threading.RLock()
+
+    def request(self, *args, **kwargs):
+        with self._request_lock:
+            return super().request(*args, **kwargs)
+
+
+class _CachedClient:
+    def __init__(self, creds: Credentials, service):
+        self.creds = creds
+        self.service = service
+
+
+class GmailClientCache:
+    """
+    Кэш сервисов Gmail API по пользователям. Сервис собирается из встроенного
+    discovery-документа (без сетевого запроса) поверх своего httplib2.Http, который
+    держит keep-alive соединения между опросами. Запись пересоздаётся только когда
+    GmailAuth выдаёт новый объект Credentials (повторная авторизация, перечитывание из БД).
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, _CachedClient] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self, user_id: str, creds: Credentials) -> Iterator:
+        """Выдаёт сервис пользователя; им можно пользоваться из нескольких потоков одновременно."""
+        yield self._get_entry(str(user_id), creds).service
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._clients.pop(str(user_id), None)
+
+    def _get_entry(self, user_id: str, creds: Credentials) -> _CachedClient:
+        with self._lock:
+            entry = self._clients.get(user_id)
+            if entry is not None and entry.creds is creds:
+                return entry
+        http = _LockedHttp(creds, httplib2.Http(timeout=HTTP_TIMEOUT))
+        service = build("gmail", "v1", http=http, static_discovery=True, cache_discovery=False)
+        entry = _CachedClient(creds, service)
+        with self._lock:
+            self._clients[user_id] = entry
+        return entry
@@ -0,0 +1,425 @@
+import json
+import re
+import time
+from email.utils import getaddresses, parseaddr
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from src.gmail.records import AttachmentRecord, EmailRecord
+from src.storage import db
+
+# synced - письмо сохранено, indexed - его вектор уже записан в Chroma
+SYNCED = "synced"
+INDEXED = "indexed"
+DELETED = "deleted"
+
+# Корзины важности: индекс (user_id, importance_bucket, timestamp) отдаёт страницу корзины сразу
+HIGH = "high"
+MEDIUM = "medium"
+LOW = "low"
+IMPORTANCE_BUCKETS = (HIGH, MEDIUM, LOW)
+HIGH_THRESHOLD = 0.6
+MEDIUM_THRESHOLD = 0.3
+
+# Виды фильтра по отправителю (EmailStore.sender_filter)
+SENDER_ADDRESS = "address"
+SENDER_DOMAIN = "domain"
+SENDER_PREFIX = "prefix"
+
+# Тело в выборки не входит: EmailRecord дочитывает его отдельным запросом, если оно понадобится
+_COLUMNS = ("id, user_id, message_id, subject, sender, recipient, date, timestamp, labels, sync_state, snippet, "
+            "importance")
+
+# Веса bm25 по колонкам emails_fts (owner, subject, sender, body): совпадение в теме важнее, чем в тексте
+TEXT_RANK_WEIGHTS = (0.0, 5.0, 3.0, 1.0)
+# Префиксный поиск только для слов не короче этого, иначе "a*" выберет полящика
+MIN_PREFIX_LENGTH = 3
+# Фильтры запроса вида subject:отчёт или from:alice
+TEXT_COLUMNS = {"subject": "subject", "тема": "subject", "from": "sender", "от": "sender", "body": "body"}
+
+_TERM_RE = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))', re.UNICODE)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Значение без "@", похожее на имя хоста: example.com, mail.example.co.uk, но и john.smith
+_HOSTNAME_RE = re.compile(r"^[a-z0-9-]+(\.[a-z0-9-]+)*\.[a-z]{2,}$")
+
+
+def text_query(text: str) -> Optional[str]:
+    """
+    Переводит запрос пользователя в выражение FTS5: слова через AND, каждое ищется по
+    префиксу, "фраза в кавычках" - точной фразой, subject:/from: ограничивают колонку.
+    Все токены берутся в кавычки, поэтому синтаксис FTS5 из ввода не интерпретируется.
+    """
+    terms = []
+    for column, phrase, word in _TERM_RE.findall(text):
+        if column and column.lower() not in TEXT_COLUMNS:
+            # Не фильтр, а обычный текст с двоеточием, например время 10:30
+            phrase, word, column = "", f"{column} {phrase or word}", ""
+        tokens = _WORD_RE.findall(phrase or word)
+        if not tokens:
+            continue
+        if phrase:
+            term = '"' + " ".join(tokens) + '"'
+        else:
+            term = " AND ".join(f'"{token}"*' if len(token) >= MIN_PREFIX_LENGTH else f'"{token}"'
+                                for token in tokens)
+        column = TEXT_COLUMNS[column.lower()] if column else None
+        terms.append(f"{column} : ({term})" if column else f"({term})")
+    return " AND ".join(terms) or None
+
+
+def importance_bucket(score: Optional[float]) -> Optional[str]:
+    if score is None:
+        return None
+    if score >= HIGH_THRESHOLD:
+        return HIGH
+    if score >= MEDIUM_THRESHOLD:
+        return MEDIUM
+    return LOW
+
+
+class EmailStore:
+    """Локальное хранилище распарсенных писем (таблица emails), ключ - (user_id, message_id)."""
+
+    def save_many(self, emails: Iterable[EmailRecord]):
+        """Идемпотентно сохраняет пачку писем; повторная запись обновляет строку, не меняя её номер."""
+        now = int(time.time())
+        rows = []
+        with_attachments = []
+        for email in emails:
+            if email.attachments:
+                with_attachments.append(email)
+            sender_address = self.sender_address(email.sender)
+            rows.append((
+                email.user_id,
+                email.id,
+                email.subject,
+                email.sender,
+                sender_address,
+                sender_address.rpartition("@")[2] if sender_address else None,
+                email.recipient,
+                email.date,
+                email.timestamp,
+                email.snippet,
+                email.body if email.body_loaded else None,
+                json.dumps(list(email.labels)),
+                SYNCED,
+                email.importance,
+                importance_bucket(email.importance),
+                now,
+            ))
+        if not rows:
+            return
+        db.executemany("""
+            INSERT INTO emails (user_id, message_id, subject, sender, sender_address, sender_domain, recipient,
+                                date, timestamp, snippet, body, labels, sync_state, importance, importance_bucket,
+                                updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, message_id) DO UPDATE SET
+                subject = excluded.subject,
+                sender = excluded.sender,
+                sender_address = excluded.sender_address,
+                sender_domain = excluded.sender_domain,
+                recipient = excluded.recipient,
+                date = excluded.date,
+                timestamp = excluded.timestamp,
+                snippet = excluded.snippet,
+                body = COALESCE(excluded.body, emails.body),
+                labels = excluded.labels,
+                sync_state = excluded.sync_state,
+                importance = COALESCE(excluded.importance, emails.importance),
+                importance_bucket = COALESCE(excluded.importance_bucket, emails.importance_bucket),
+                updated_at = excluded.updated_at
+        """, rows)
+        self.save_attachments(with_attachments)
+
+    def save_attachments(self, emails: Iterable[EmailRecord]):
+        """Метаданные вложений; уже скачанное содержимое (content_hash) при повторной записи сохраняется."""
+        db.executemany("""
+            INSERT INTO attachments (user_id, message_id, part_id, filename, mime_type, size, attachment_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, message_id, part_id) DO UPDATE SET
+                filename = excluded.filename,
+                mime_type = excluded.mime_type,
+                size = excluded.size,
+                attachment_id = excluded.attachment_id
+        """, [(email.user_id, email.id, attachment.part_id, attachment.filename, attachment.mime_type,
+               attachment.size, attachment.attachment_id)
+              for email in emails for attachment in email.attachments])
+
+    def get_attachments(self, user_id: str, message_id: str) -> List[AttachmentRecord]:
+        rows = db.query_all("""
+            SELECT part_id, filename, mime_type, size, attachment_id, content_hash FROM attachments
+            WHERE user_id = ? AND message_id = ? ORDER BY part_id
+        """, (user_id, message_id))
+        return [AttachmentRecord(*row) for row in rows]
+
+    def get_attachment(self, user_id: str, message_id: str, part_id: str) -> Optional[AttachmentRecord]:
+        row = db.query_one("""
+            SELECT part_id, filename, mime_type, size, attachment_id, content_hash FROM attachments
+            WHERE user_id = ? AND message_id = ? AND part_id = ?
+        """, (user_id, message_id, part_id))
+        return AttachmentRecord(*row) if row else None
+
+    def save_attachment_content(self, user_id: str, message_id: str, part_id: str, content_hash: str):
+        db.execute("UPDATE attachments SET content_hash = ? WHERE user_id = ? AND message_id = ? AND part_id = ?",
+                   (content_hash, user_id, message_id, part_id))
+
+    def save_importance(self, emails: Iterable[EmailRecord]):
+        db.executemany("""
+            UPDATE emails SET importance = ?, importance_bucket = ?
+            WHERE user_id = ? AND message_id = ?
+        """, [(email.importance, importance_bucket(email.importance), email.user_id, email.id)
+              for email in emails if email.importance is not None])
+
+    def save_body(self, user_id: str, message_id: str, body: str):
+        """Сохраняет тело, загруженное по запросу; NULL в body означает, что тело ещё не скачивали."""
+        db.execute("UPDATE emails SET body = ?, updated_at = ? WHERE user_id = ? AND message_id = ?",
+                   (body, int(time.time()), user_id, message_id))
+
+    def existing_ids(self, user_id: str, message_ids: List[str]) -> Set[str]:
+        """Возвращает те из message_ids, что уже есть в хранилище (включая удалённые)."""
+        if not message_ids:
+            return set()
+        placeholders = ",".join("?" * len(message_ids))
+        rows = db.query_all(
+            f"SELECT message_id FROM emails WHERE user_id = ? AND message_id IN ({placeholders})",
+            (user_id, *message_ids))
+        return {row[0] for row in rows}
+
+    def mark_deleted(self, user_id: str, message_ids: Iterable[str]):
+        now = int(time.time())
+        db.executemany("""
+            UPDATE emails SET sync_state = ?, body = NULL, updated_at = ?
+            WHERE user_id = ? AND message_id = ?
+        """, [(DELETED, now, user_id, message_id) for message_id in message_ids])
+
+    def update_labels(self, user_id: str, message_id: str, added: List[str], removed: List[str]):
+        with db.transaction() as conn:
+            result = conn.execute("SELECT labels FROM emails WHERE user_id = ? AND message_id = ?",
+                                  (user_id, message_id)).fetchone()
+            if not result:
+                return
+            labels = [label for label in json.loads(result[0]) if label not in removed]
+            labels.extend(label for label in added if label not in labels)
+            conn.execute("UPDATE emails SET labels = ?, updated_at = ? WHERE user_id = ? AND message_id = ?",
+                         (json.dumps(labels), int(time.time()), user_id, message_id))
+
+    def load_body(self, user_id: str, message_id: str) -> Optional[str]:
+        result = db.query_one("SELECT body FROM emails WHERE user_id = ? AND message_id = ?", (user_id, message_id))
+        return result[0] if result else None
+
+    def get(self, user_id: str, message_id: str) -> Optional[EmailRecord]:
+        result = db.query_one(f"SELECT {_COLUMNS} FROM emails WHERE user_id = ? AND message_id = ?",
+                              (user_id, message_id))
+        return self._row_to_email(result) if result else None
+
+    def get_many(self, user_id: str, message_ids: List[str]) -> List[EmailRecord]:
+        """Загружает письма одним запросом в порядке message_ids, пропуская отсутствующие."""
+        if not message_ids:
+            return []
+        placeholders = ",".join("?" * len(message_ids))
+        rows = db.query_all(
+            f"SELECT {_COLUMNS} FROM emails WHERE user_id = ? AND message_id IN ({placeholders}) AND sync_state != ?",
+            (user_id, *message_ids, DELETED))
+        emails = {email.id: email for email in map(self._row_to_email, rows)}
+        return [emails[message_id] for message_id in message_ids if message_id in emails]
+
+    def mark_indexed(self, emails: Iterable[EmailRecord]):
+        db.executemany("""
+            UPDATE emails SET sync_state = ?
+            WHERE user_id = ? AND message_id = ? AND sync_state = ?
+        """, [(INDEXED, email.user_id, email.id, SYNCED) for email in emails])
+
+    def reset_indexed(self):
+        """Помечает все письма непроиндексированными, например если каталог индекса удалили."""
+        db.execute("UPDATE emails SET sync_state = ? WHERE sync_state = ?", (SYNCED, INDEXED))
+
+    def get_by_number(self, number: int) -> Optional[EmailRecord]:
+        result = db.query_one(f"SELECT {_COLUMNS} FROM emails WHERE id = ? AND sync_state != ?",
+                              (number, DELETED))
+        return self._row_to_email(result) if result else None
+
+    def find(self, user_id: Optional[str] = None, sender: Optional[str] = None, start: Optional[int] = None,
+             end: Optional[int] = None, limit: Optional[int] = None,
+             before: Optional[Tuple[Optional[int], int]] = None) -> List[EmailRecord]:
+        """
+        Поиск по индексам: sender - адрес целиком, домен ("example.com" или "@example.com")
+        или начало адреса; [start, end) - диапазон UTC epoch, ищется по индексу (user_id, timestamp).
+        Новые письма первыми; before=(timestamp, номер) продолжает выборку после этой строки.
+        """
+        conditions, params = self._filters(user_id, sender, start, end)
+        return self._page(conditions, params, limit, before)
+
+    def search_text(self, user_id: Optional[str], query: str, limit: int = 20, sender: Optional[str] = None,
+                    start: Optional[int] = None, end: Optional[int] = None) -> List[EmailRecord]:
+        """
+        Полнотекстовый поиск по теме, отправителю и тексту (emails_fts), лучшие по bm25 первыми.
+        Ящик пользователя ограничивается в самом индексе, остальные фильтры - как в find.
+        """
+        expression = text_query(query)
+        if expression is None:
+            return []
+        if user_id is not None:
+            expression = f'owner : "u{user_id}" AND {expression}'
+        conditions, params = self._filters(None, sender, start, end, alias="e.")
+        columns = ", ".join(f"e.{column.strip()}" for column in _COLUMNS.split(","))
+        weights = ", ".join(map(str, TEXT_RANK_WEIGHTS))
+        rows = db.query_all(f"""
+            SELECT {columns} FROM emails_fts
+            JOIN emails e ON e.id = emails_fts.rowid
+            WHERE emails_fts MATCH ? AND {' AND '.join(conditions)}
+            ORDER BY bm25(emails_fts, {weights}) LIMIT ?
+        """, (expression, *params, limit))
+        return [self._row_to_email(row) for row in rows]
+
+    @staticmethod
+    def _filters(user_id: Optional[str], sender: Optional[str], start: Optional[int], end: Optional[int],
+                 alias: str = "") -> Tuple[List[str], List]:
+        conditions, params = [f"{alias}sync_state != ?"], [DELETED]
+        kind, value = EmailStore.sender_filter(sender, user_id) if sender else (None, None)
+        if user_id is not None:
+            # Выборку по началу адреса или имени задаёт подзапрос ниже, а не индекс по дате
+            conditions.append(f"{'+' if kind == SENDER_PREFIX else ''}{alias}user_id = ?")
+            params.append(str(user_id))
+        if sender:
+            if kind == SENDER_ADDRESS:
+                conditions.append(f"{alias}sender_address = ?")
+                params.append(value)
+            elif kind == SENDER_DOMAIN:
+                conditions.append(f"{alias}sender_domain = ?")
+                params.append(value)
+            else:
+                # Каждый вариант выбирается своим индексом, а не проверкой всех писем пользователя;
+                # диапазон вместо LIKE, чтобы работал индекс по адресу
+                owner, owner_params = ("user_id = ? AND ", [str(user_id)]) if user_id is not None else ("", [])
+                matches = [f"SELECT id FROM emails WHERE {owner}sender_address >= ? AND sender_address < ?"]
+                params.extend(owner_params + [value, value + "\uffff"])
+                tokens = _WORD_RE.findall(value)
+                if tokens:
+                    # Имя отправителя ищется фразой по колонке sender индекса emails_fts
+                    expression = 'sender : ("' + " ".join(tokens) + '"*)'
+                    if user_id is not None:
+                        expression = f'owner : "u{user_id}" AND {expression}'
+                    matches.append("SELECT rowid FROM emails_fts WHERE emails_fts MATCH ?")
+                    params.append(expression)
+                conditions.append(f"{alias}id IN ({' UNION ALL '.join(matches)})")
+        if start is not None:
+            conditions.append(f"{alias}timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{alias}timestamp < ?")
+            params.append(end)
+        return conditions, params
+
+    def _page(self, conditions: List[str], params: List, limit: Optional[int],
+              before: Optional[Tuple[Optional[int], int]]) -> List[EmailRecord]:
+        """
+        Выборка по ORDER BY timestamp DESC, id DESC, продолжающая после строки before. Письма без даты
+        (timestamp NULL) идут в конце и читаются второй фазой, когда датированные кончились: условие
+        с OR не дало бы SQLite перейти по индексу сразу к before, и глубокие страницы стоили бы O(смещения).
+        """
+        if before is None:
+            return self._select(conditions, params, limit)
+        timestamp, number = before
+        emails = []
+        if timestamp is not None:
+            emails = self._select(conditions + ["(timestamp, id) < (?, ?)"], params + [timestamp, number], limit)
+            if limit is not None and len(emails) >= limit:
+                return emails
+            undated, undated_params = "timestamp IS NULL", []
+        else:
+            undated, undated_params = "timestamp IS NULL AND id < ?", [number]
+        remaining = limit - len(emails) if limit is not None else None
+        return emails + self._select(conditions + [undated], params + undated_params, remaining)
+
+    def _select(self, conditions: List[str], params: List, limit: Optional[int]) -> List[EmailRecord]:
+        sql = f"SELECT {_COLUMNS} FROM emails WHERE {' AND '.join(conditions)} ORDER BY timestamp DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = params + [limit]
+        return [self._row_to_email(row) for row in db.query_all(sql, params)]
+
+    def find_by_importance(self, user_id: str, bucket: str, limit: int = 20,
+                           before: Optional[Tuple[Optional[int], int]] = None) -> List[EmailRecord]:
+        """Новейшие письма корзины важности high/medium/low - один проход по индексу emails_importance."""
+        conditions = ["user_id = ?", "importance_bucket = ?", "sync_state != ?"]
+        return self._page(conditions, [str(user_id), bucket, DELETED], limit, before)
+
+    def count(self) -> int:
+        return db.query_one("SELECT COUNT(*) FROM emails WHERE sync_state != ?", (DELETED,))[0]
+
+    def iter_emails(self, batch_size: int = 500, sync_state: Optional[str] = None,
+                    unscored: bool = False, user_ids: Optional[List[str]] = None) -> Iterator[EmailRecord]:
+        """
+        Обходит неудалённые письма (или только письма в состоянии sync_state, или только ещё
+        не оценённые по важности) пачками вместе с телами, не держа всё хранилище в памяти.
+        user_ids ограничивает обход письмами этих пользователей.
+        """
+        state_condition = "sync_state = ?" if sync_state is not None else "sync_state != ?"
+        if unscored:
+            # Отправленные письма не оцениваются, у них importance всегда NULL
+            state_condition += " AND importance IS NULL AND labels NOT LIKE '%\"SENT\"%'"
+        user_params = ()
+        if user_ids is not None:
+            if not user_ids:
+                return
+            state_condition += f" AND user_id IN ({','.join('?' * len(user_ids))})"
+            user_params = tuple(user_ids)
+        last_id = 0
+        while True:
+            rows = db.query_all(f"""
+                SELECT {_COLUMNS}, body FROM emails
+                WHERE id > ? AND {state_condition}
+                ORDER BY id LIMIT ?
+            """, (last_id, sync_state if sync_state is not None else DELETED, *user_params, batch_size))
+            if not rows:
+                return
+            for row in rows:
+                yield self._row_to_email(row)
+            last_id = rows[-1][0]
+
+    def _row_to_email(self, row) -> EmailRecord:
+        email = EmailRecord(number=row[0], user_id=row[1], id=row[2], subject=row[3], sender=row[4],
+                            recipient=row[5], date=row[6], timestamp=row[7], labels=json.loads(row[8]),
+                            sync_state=row[9], snippet=row[10], importance=row[11], body_loader=self.load_body)
+        if len(row) > 12:
+            email.body = row[12]
+        return email
+
+    @staticmethod
+    def sender_filter(sender: str, user_id: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Вид фильтра по отправителю: адрес целиком, домен ("@example.com", а также "example.com",
+        если письма с такого домена есть) или начало адреса либо имени ("alice", "john.smith").
+        Общий для хранилища и векторного индекса.
+        """
+        sender = sender.strip().lower()
+        if "@" in sender.lstrip("@"):
+            return SENDER_ADDRESS, sender
+        if sender.startswith("@"):
+            return SENDER_DOMAIN, sender.lstrip("@")
+        # "john.smith" тоже похож на имя хоста, поэтому доменом он считается только по данным
+        if _HOSTNAME_RE.match(sender) and EmailStore._has_domain(user_id, sender):
+            return SENDER_DOMAIN, sender
+        return SENDER_PREFIX, sender
+
+    @staticmethod
+    def _has_domain(user_id: Optional[str], domain: str) -> bool:
+        if user_id is None:
+            return db.query_one("SELECT 1 FROM emails WHERE sender_domain = ? LIMIT 1", (domain,)) is not None
+        return db.query_one("SELECT 1 FROM emails WHERE user_id = ? AND sender_domain = ? LIMIT 1",
+                            (str(user_id), domain)) is not None
+
+    def sender_addresses(self, user_id: Optional[str], prefix: str) -> List[str]:
+        """Различные адреса отправителей, подходящие под фильтр вида SENDER_PREFIX, как в find."""
+        conditions, params = self._filters(user_id, prefix, None, None)
+        rows = db.query_all(f"SELECT DISTINCT sender_address FROM emails WHERE {' AND '.join(conditions)}", params)
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def sender_address(sender: Optional[str]) -> Optional[str]:
+        address = parseaddr(sender or "")[1].strip().lower()
+        return address or None
+
+    @staticmethod
+    def recipient_addresses(recipient: Optional[str]) -> List[str]:
+        return [address.strip().lower() for _, address in getaddresses([recipient or ""]) if address.strip()]
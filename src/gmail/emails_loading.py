@@ -1,108 +1,633 @@
+import re
 import time
 import threading
-import sqlite3
 from base64 import urlsafe_b64decode
-from email import message_from_bytes
-from typing import List, Tuple
+from collections import deque
+from email.header import decode_header, make_header
+from email.message import Message
+from email.utils import mktime_tz, parsedate_tz
+from datetime import timezone
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from bs4 import BeautifulSoup
+from dateutil import parser as date_parser
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from src.attachments import AttachmentCache
 from src.gmail.auth import GmailAuth
-from src.utils import DB_PATH
+from src.gmail.clients import GmailClientCache
+from src.gmail.email_store import EmailStore
+from src.gmail.push import DEFAULT_PUSH_PORT, PushReceiver, WatchManager
+from src.gmail.rate_limit import BACKFILL, GLOBAL_UNITS_PER_SECOND, INTERACTIVE, LIVE, QUOTA_UNITS, QuotaLimiter
+from src.gmail.records import AttachmentRecord, EmailRecord
+from src.gmail.scheduler import PollScheduler
+from src.importance import ImportanceScorer
+from src.metrics import metrics
+from src.storage import db
+
+# Gmail принимает до 100 запросов в одном batch, но рекомендует не больше 50
+BATCH_SIZE = 50
+BATCH_RETRIES = 3
+# Сколько последних писем перечитываем, если history-курсор устарел
+FULL_RESYNC_LIMIT = 100
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+# С push-уведомлениями опрос остаётся только страховкой на случай потерянных уведомлений
+PUSH_FALLBACK_INTERVAL = 15 * 60
+# Формат запроса "ingest": format=full с маской полей - заголовки, метки, сниппет и дерево MIME-частей
+# без данных. Одним запросом даёт и поля для списка и индекса, и метаданные вложений; тело по запросу.
+# Маска не умеет выбирать заголовки по имени, а format=metadata не отдаёт дерево частей, поэтому
+# заголовки приходят все, но без лишних полей. Части глубже MAX_PART_DEPTH маска отрезает - такие
+# письма перечитываются целиком (см. is_truncated)
+INGEST = "ingest"
+MAX_PART_DEPTH = 4
+_PART_FIELDS = "partId,mimeType,filename,body(size,attachmentId)"
+
+_DATE_COMMENT_RE = re.compile(r"\([^)]*\)")
+
+
+def parse_email_date(date_str: Optional[str]) -> Optional[int]:
+    """Переводит заголовок Date (RFC 2822 и его распространённые вариации) в UTC epoch."""
+    if not date_str:
+        return None
+    # Комментарии вида "(UTC)" или "(Pacific Standard Time)" на время не влияют
+    cleaned = _DATE_COMMENT_RE.sub("", str(date_str)).strip()
+    parsed = parsedate_tz(cleaned)
+    if parsed is not None:
+        # Неизвестные устаревшие зоны parsedate_tz отдаёт без смещения - по RFC 2822 это UTC
+        if parsed[9] is None:
+            parsed = parsed[:9] + (0,)
+        try:
+            return int(mktime_tz(parsed))
+        except (OverflowError, ValueError):
+            pass
+    try:
+        dt = date_parser.parse(cleaned, fuzzy=True)
+    except (ValueError, OverflowError):
+        return None
+    if dt.tzinfo is None:
+        return int(dt.replace(tzinfo=timezone.utc).timestamp())
+    return int(dt.timestamp())
+
+
+def internal_date(msg: Dict) -> Optional[int]:
+    """Время получения письма Gmail (internalDate, мс) - если заголовок Date пуст или не разбирается."""
+    try:
+        return int(msg["internalDate"]) // 1000
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _parts_fields(depth: int) -> str:
+    return _PART_FIELDS if depth == 0 else f"{_PART_FIELDS},parts({_parts_fields(depth - 1)})"
+
+
+INGEST_FIELDS = f"id,labelIds,snippet,internalDate,payload(headers(name,value),{_parts_fields(MAX_PART_DEPTH)})"
+
+
+def iter_parts(payload: Dict) -> Iterator[Dict]:
+    """Обходит дерево MIME-частей в ширину, начиная с самого payload."""
+    parts = deque([payload])
+    while parts:
+        part = parts.popleft()
+        parts.extend(part.get("parts", []))
+        yield part
+
+
+def is_truncated(msg: Dict) -> bool:
+    """Маска INGEST_FIELDS обрезала дерево: у multipart-части на последнем уровне нет детей."""
+    return any(part.get("mimeType", "").startswith("multipart/") and "parts" not in part
+               for part in iter_parts(msg.get("payload", {})))
+
+
+def parse_attachments(payload: Dict) -> List[AttachmentRecord]:
+    attachments = []
+    for part in iter_parts(payload):
+        body = part.get("body", {})
+        if part.get("filename") and (body.get("attachmentId") or body.get("size")):
+            attachments.append(AttachmentRecord(part_id=part.get("partId", ""), filename=part["filename"],
+                                                mime_type=part.get("mimeType"), size=body.get("size", 0),
+                                                attachment_id=body.get("attachmentId")))
+    return attachments
+
+
+def parse_email(msg: Dict, user_id: Optional[str] = None) -> EmailRecord:
+    """
+    Парсит письмо в формате ingest (или full) в запись; тело остаётся нескачанным (None),
+    у вложений есть только метаданные.
+    """
+    headers = {}
+    for header in msg.get("payload", {}).get("headers", []):
+        headers.setdefault(header["name"].lower(), EmailLoader._decode_header(header["value"]))
+    return EmailRecord(
+        id=msg["id"],
+        user_id=user_id,
+        subject=headers.get("subject"),
+        sender=headers.get("from"),
+        recipient=headers.get("to"),
+        date=headers.get("date"),
+        timestamp=parse_email_date(headers.get("date")) or internal_date(msg),
+        snippet=msg.get("snippet"),
+        labels=msg.get("labelIds", []),
+        body=None,
+        attachments=parse_attachments(msg.get("payload", {})),
+    )
+
+
+def parse_emails(messages: List[Dict], user_id: str) -> List[EmailRecord]:
+    # Функция модуля, а не метод, чтобы её можно было отправить в пул процессов
+    return [parse_email(msg, user_id) for msg in messages]
 
 
 class EmailLoader:
-    def __init__(self):
+    def __init__(self, batch_size: int = BATCH_SIZE):
         self.auth_service = GmailAuth()
-        self._requested_email_ids = set()
+        self.batch_size = batch_size
+        self.store = EmailStore()
+        self.clients = GmailClientCache()
+        self.limiter = QuotaLimiter()
+        self.importance = ImportanceScorer()
+        self.attachment_cache = AttachmentCache()
         self._new_email_callback = None
+        self._message_sink = None
+        self._new_emails_callback = None
+        self._deleted_email_callback = None
+        self._deleted_emails_callback = None
+        self._labels_changed_callback = None
+        self.scheduler = None
         self.worker_thread = None
+        self.watch_manager = None
+        self.push_receiver = None
+        # LeaseManager: в режиме нескольких процессов синхронизируются только арендованные пользователи
+        self.leases = None
+        # ProcessPoolExecutor для разбора писем; без него разбор идёт в вызывающем потоке
+        self.process_pool = None
+        self.auth_service.on_removed(self._forget_users)
+
+    def use_leases(self, leases):
+        """Синхронизирует только арендованных пользователей и делит квоту проекта между живыми процессами."""
+        self.leases = leases
+        leases.on_workers(lambda workers: self.limiter.set_global_rate(GLOBAL_UNITS_PER_SECOND / max(workers, 1)))
+        leases.on_released(self._forget_users)
+
+    def _forget_users(self, user_ids: List[str]):
+        """Закрывает клиентов и бакеты квоты пользователей, которых этот процесс больше не синхронизирует."""
+        for user_id in user_ids:
+            self.clients.invalidate(user_id)
+            self.limiter.forget(user_id)
 
     def start_monitoring(self):
-        self.worker_thread = threading.Thread(
-            target=self.get_recent_worker
-        )
+        self.scheduler = PollScheduler(self._poll_user, self._sync_user_ids)
+        metrics.gauge("sync_lag_seconds", self.scheduler.lags, label="user_id")
+        if self.leases is not None:
+            # Полученных в аренду опрашиваем сразу, не дожидаясь обновления списка пользователей
+            self.leases.on_claimed(lambda user_ids: [self.scheduler.trigger(user_id) for user_id in user_ids])
+        self.worker_thread = threading.Thread(target=self.scheduler.run, daemon=True)
         self.worker_thread.start()
 
+    def stop_monitoring(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.push_receiver is not None:
+            self.push_receiver.stop()
+        if self.watch_manager is not None:
+            self.watch_manager.stop()
+        if self.leases is not None:
+            self.leases.stop()
+
+    def enable_push(self, topic: str, host: str = "127.0.0.1", port: int = DEFAULT_PUSH_PORT,
+                    token: Optional[str] = None):
+        """
+        Включает push-режим: ящики подписываются на Pub/Sub-топик, уведомления принимает
+        локальный HTTP-приёмник и запускает синхронизацию только нужного пользователя.
+        Вызывать после start_monitoring.
+        """
+        self.scheduler.max_interval = PUSH_FALLBACK_INTERVAL
+        self.watch_manager = WatchManager(self, topic)
+        self.watch_manager.start()
+        self.push_receiver = PushReceiver(self._on_push_notification, host=host, port=port, token=token)
+        self.push_receiver.start()
+
+    def _on_push_notification(self, email_address: str, history_id: str):
+        user_id = self.watch_manager.user_for_address(email_address)
+        if user_id is None or (self.leases is not None and not self.leases.holds(user_id)):
+            return
+        cursor = self._load_history_id(user_id)
+        if cursor is not None and int(cursor) >= int(history_id):
+            # Эти изменения уже забраны опросом
+            return
+        self.scheduler.trigger(user_id)
+
+    def _get_user_ids_from_db(self) -> List[str]:
+        return [row[0] for row in db.query_all("SELECT user_id FROM auth_tokens")]
+
+    def _sync_user_ids(self) -> List[str]:
+        """Пользователи, которых синхронизирует этот процесс."""
+        if self.leases is not None:
+            return self.leases.owned_users()
+        return self._get_user_ids_from_db()
+
     def _get_user_creds_from_db(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM auth_tokens")
-            users = cursor.fetchall()
-        user_creds = []
-        for row in users:
-            user_id = row[0]
-            user_creds.append((user_id, self.auth_service.load_creds(user_id)))
-        return user_creds
+        return [(user_id, self.auth_service.load_creds(user_id)) for user_id in self._sync_user_ids()]
+
+    def _poll_user(self, user_id: str) -> int:
+        if self.leases is None:
+            return self._sync_polled_user(user_id)
+        with self.leases.syncing(user_id) as held:
+            # Аренду могли отдать другому процессу, пока пользователь ждал в очереди опроса
+            return self._sync_polled_user(user_id) if held else 0
+
+    def _sync_polled_user(self, user_id: str) -> int:
+        creds = self.auth_service.load_creds(user_id)
+        if creds is None:
+            return 0
+        with metrics.timer("sync_seconds"):
+            return self.sync_user(user_id, creds)
+
+    def _load_history_id(self, user_id: str) -> Optional[str]:
+        result = db.query_one("SELECT history_id FROM sync_state WHERE user_id = ?", (user_id,))
+        return result[0] if result else None
+
+    def _save_history_id(self, user_id: str, history_id: str):
+        db.execute("""
+            INSERT OR REPLACE INTO sync_state (user_id, history_id, updated_at)
+            VALUES (?, ?, ?)
+        """, (user_id, str(history_id), int(time.time())))
 
     def init_emails(self, emails_num: int, max_results: int):
-        emails = self.get_emails(emails_num, max_results)
-        for email in emails:
-            self._requested_email_ids.add(email["id"])
-        return emails
+        return self.get_emails(emails_num, max_results)
 
     def get_emails(self, emails_num: int, max_results=100) -> List:
+        """Загружает и сохраняет последние письма, которых ещё нет в локальном хранилище."""
         all_emails = []
         user_creds = self._get_user_creds_from_db()
         for user_id, creds in user_creds:
-            service = build("gmail", "v1", credentials=creds)
-            next_page = None
-            for i in range(emails_num // max_results + bool(emails_num % max_results)):
-                try:
-                    results = service.users().messages().list(userId="me", pageToken=next_page,
-                                                              maxResults=max_results).execute()
-                    next_page = results.get("nextPageToken")
-                    messages = results.get("messages", [])
-                    if len(messages) == 0:
-                        break
-                    for message in messages:
-                        msg = service.users().messages().get(userId="me", id=message["id"], format="raw").execute()
-                        email_data = self._parse_email(msg["raw"], msg["id"])
-                        all_emails.append(email_data)
-                except Exception as e:
-                    print(f"An error occurred for user {user_id}: {e}")
+            if creds is None:
+                continue
+            # Ошибка одного пользователя (отозванный токен, квота) не останавливает загрузку остальных,
+            # но и не выдаётся за пустой ящик: загрузка этого пользователя прерывается и попадает в лог
+            try:
+                with self.clients.client(user_id, creds) as service:
+                    all_emails.extend(self._get_user_emails(user_id, service, emails_num, max_results))
+            except Exception as e:
+                metrics.inc("backfill_errors_total")
+                print(f"Failed to load emails for user {user_id}: {e}")
         return all_emails
 
-    def get_recent(self):
-        emails = self.get_emails(5, max_results=5)
-        recent = []
-        for email in emails:
-            if email["id"] in self._requested_email_ids:
+    def _get_user_emails(self, user_id: str, service, emails_num: int, max_results: int) -> List:
+        user_emails = []
+        next_page = None
+        for i in range(emails_num // max_results + bool(emails_num % max_results)):
+            request = service.users().messages().list(userId="me", pageToken=next_page, maxResults=max_results)
+            results = self.limiter.execute(request, user_id, "messages.list", BACKFILL)
+            next_page = results.get("nextPageToken")
+            messages = results.get("messages", [])
+            if len(messages) == 0:
+                break
+            message_ids = self._filter_new_ids(user_id, [message["id"] for message in messages])
+            emails = self.parse_messages(self._get_messages_batched(service, user_id, message_ids,
+                                                                    priority=BACKFILL), user_id)
+            self.store_emails(emails)
+            user_emails.extend(emails)
+            if not next_page:
+                break
+        return user_emails
+
+    def _get_messages_batched(self, service, user_id: str, message_ids: List[str], msg_format: str = INGEST,
+                              priority: int = LIVE) -> List[Dict]:
+        """
+        Загружает письма batch-запросами по batch_size штук, повторяя только упавшие подзапросы.
+        Каждый подзапрос расходует квоту как отдельный messages.get, поэтому квота берётся до отправки batch.
+        """
+        fetched = {}
+        pending = list(message_ids)
+        for attempt in range(BATCH_RETRIES + 1):
+            failed = []
+            delays = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    fetched[request_id] = response
+                elif isinstance(exception, HttpError) and self.limiter.is_retryable(exception):
+                    metrics.inc("gmail_errors_total", method="messages.get", status=exception.resp.status)
+                    failed.append(request_id)
+                    delays.append(self.limiter.retry_delay(exception, attempt))
+                    if self.limiter.is_rate_limited(exception):
+                        self.limiter.block_user(user_id, delays[-1])
+                else:
+                    print(f"Failed to fetch message {request_id}: {exception}")
+
+            for start in range(0, len(pending), self.batch_size):
+                chunk = pending[start:start + self.batch_size]
+                self.limiter.acquire(user_id, QUOTA_UNITS["messages.get"] * len(chunk), priority)
+                batch = service.new_batch_http_request(callback=callback)
+                for msg_id in chunk:
+                    batch.add(self._get_message_request(service, msg_id, msg_format), request_id=msg_id)
+                metrics.inc("gmail_requests_total", len(chunk), method="messages.get")
+                with metrics.timer("gmail_request_seconds", method="batch"):
+                    batch.execute()
+            if not failed:
                 break
-            recent.append(email)
-            self._requested_email_ids.add(email["id"])
-            if self._new_email_callback is not None:
+            pending = failed
+            if attempt < BATCH_RETRIES:
+                time.sleep(max(delays))
+        else:
+            print(f"Giving up on {len(pending)} messages after {BATCH_RETRIES} retries")
+        if msg_format == INGEST:
+            truncated = [msg_id for msg_id, msg in fetched.items() if is_truncated(msg)]
+            if truncated:
+                metrics.inc("ingest_truncated_total", len(truncated))
+                # Полный ответ - надмножество ingest, только с данными частей
+                fetched.update((msg["id"], msg) for msg in
+                               self._get_messages_batched(service, user_id, truncated, "full", priority))
+        return [fetched[msg_id] for msg_id in message_ids if msg_id in fetched]
+
+    @staticmethod
+    def _get_message_request(service, msg_id: str, msg_format: str):
+        if msg_format == INGEST:
+            return service.users().messages().get(userId="me", id=msg_id, format="full", fields=INGEST_FIELDS)
+        return service.users().messages().get(userId="me", id=msg_id, format=msg_format)
+
+    def get_email_body(self, user_id: str, message_id: str, priority: int = INTERACTIVE) -> Optional[str]:
+        """
+        Возвращает тело письма: из хранилища или, при первом открытии, загружая его из Gmail.
+        Фоновые задачи передают priority ниже INTERACTIVE, чтобы не задерживать запросы из бота.
+        """
+        email = self.store.get(user_id, message_id)
+        if email is None:
+            return None
+        if email.body is not None:
+            return email.body
+        creds = self.auth_service.load_creds(user_id)
+        if creds is None:
+            return None
+        with self.clients.client(user_id, creds) as service:
+            msg = self.limiter.execute(self._get_message_request(service, message_id, "full"),
+                                       user_id, "messages.get", priority)
+        return self._save_full_message(email, msg)
+
+    def get_email_bodies(self, user_id: str, emails: List[EmailRecord], priority: int = BACKFILL) -> Dict[str, str]:
+        """
+        Тела нескольких писем пользователя: сохранённые берутся из хранилища, остальные скачиваются
+        batch-запросами. Письма, которые не удалось скачать (например, удалённые в Gmail), в ответ не попадают.
+        """
+        bodies = {email.id: email.body for email in emails if email.body is not None}
+        missing = {email.id: email for email in emails if email.id not in bodies}
+        if not missing:
+            return bodies
+        creds = self.auth_service.load_creds(user_id)
+        if creds is None:
+            return bodies
+        with self.clients.client(user_id, creds) as service:
+            messages = self._get_messages_batched(service, user_id, list(missing), "full", priority)
+        for msg in messages:
+            bodies[msg["id"]] = self._save_full_message(missing[msg["id"]], msg)
+        return bodies
+
+    def _save_full_message(self, email: EmailRecord, msg: Dict) -> str:
+        body = self._get_email_body(msg.get("payload", {}))
+        self.store.save_body(email.user_id, email.id, body)
+        # Письма, загруженные до сохранения вложений, получают их метаданные при первом открытии
+        email.attachments = tuple(parse_attachments(msg.get("payload", {})))
+        self.store.save_attachments([email])
+        return body
+
+    def get_attachments(self, user_id: str, message_id: str) -> List[AttachmentRecord]:
+        return self.store.get_attachments(user_id, message_id)
+
+    def get_attachment(self, user_id: str, message_id: str, part_id: str,
+                       priority: int = INTERACTIVE) -> Optional[str]:
+        """
+        Путь к файлу вложения в дисковом кэше. Повторное открытие, в том числе того же файла
+        из другого письма, уже скачанного по content_hash, обходится без запросов к Gmail.
+        """
+        attachment = self.store.get_attachment(user_id, message_id, part_id)
+        if attachment is None:
+            return None
+        if attachment.content_hash is not None:
+            path = self.attachment_cache.open(attachment.content_hash)
+            if path is not None:
+                return path
+        creds = self.auth_service.load_creds(user_id)
+        if creds is None:
+            return None
+        with self.clients.client(user_id, creds) as service:
+            data = self._download_attachment(service, user_id, message_id, attachment, priority)
+        if data is None:
+            return None
+        with metrics.timer("attachment_store_seconds"):
+            content_hash, _ = self.attachment_cache.put_base64(data)
+        self.store.save_attachment_content(user_id, message_id, part_id, content_hash)
+        return self.attachment_cache.path(content_hash)
+
+    def _download_attachment(self, service, user_id: str, message_id: str, attachment: AttachmentRecord,
+                             priority: int) -> Optional[str]:
+        """Содержимое вложения в base64url, как его отдаёт Gmail."""
+        if attachment.attachment_id is not None:
+            try:
+                request = service.users().messages().attachments().get(userId="me", messageId=message_id,
+                                                                       id=attachment.attachment_id)
+                return self.limiter.execute(request, user_id, "messages.attachments.get", priority)["data"]
+            except HttpError as e:
+                # attachmentId, сохранённый при загрузке, мог устареть - берём свежий из письма
+                if e.resp.status not in (400, 404):
+                    raise
+        msg = self.limiter.execute(self._get_message_request(service, message_id, "full"),
+                                   user_id, "messages.get", priority)
+        for part in iter_parts(msg.get("payload", {})):
+            if part.get("partId", "") != attachment.part_id:
+                continue
+            body = part.get("body", {})
+            if body.get("data") is not None:
+                # Маленькие вложения Gmail отдаёт прямо в письме, без attachmentId
+                return body["data"]
+            if body.get("attachmentId"):
+                request = service.users().messages().attachments().get(userId="me", messageId=message_id,
+                                                                       id=body["attachmentId"])
+                return self.limiter.execute(request, user_id, "messages.attachments.get", priority)["data"]
+        return None
+
+    def sync_user(self, user_id: str, creds: Credentials) -> int:
+        """Синхронизирует ящик по history-курсору и возвращает число обработанных изменений."""
+        with self.clients.client(user_id, creds) as service:
+            return self._sync_user(user_id, service)
+
+    def _sync_user(self, user_id: str, service) -> int:
+        history_id = self._load_history_id(user_id)
+        if history_id is None:
+            return self._full_resync(user_id, service)
+        try:
+            history, new_history_id = self._get_history(user_id, service, history_id)
+        except HttpError as e:
+            if e.resp.status == 404:
+                # Курсор устарел (история хранится около недели) - делаем ограниченную полную синхронизацию
+                return self._full_resync(user_id, service)
+            raise
+
+        added, deleted, label_changes = [], set(), []
+        for record in history:
+            for item in record.get("messagesAdded", []):
+                added.append(item["message"]["id"])
+            for item in record.get("messagesDeleted", []):
+                deleted.add(item["message"]["id"])
+            for item in record.get("labelsAdded", []):
+                label_changes.append((item["message"]["id"], item.get("labelIds", []), []))
+            for item in record.get("labelsRemoved", []):
+                label_changes.append((item["message"]["id"], [], item.get("labelIds", [])))
+
+        added = self._filter_new_ids(user_id, [msg_id for msg_id in dict.fromkeys(added) if msg_id not in deleted])
+        self._deliver_new(user_id, self._get_messages_batched(service, user_id, added))
+        self.store.mark_deleted(user_id, deleted)
+        if self._deleted_emails_callback is not None and deleted:
+            self._deleted_emails_callback(user_id, list(deleted))
+        for msg_id in deleted:
+            if self._deleted_email_callback is not None:
+                self._deleted_email_callback(user_id, msg_id)
+        for msg_id, labels_added, labels_removed in label_changes:
+            if msg_id in deleted:
+                continue
+            self.store.update_labels(user_id, msg_id, labels_added, labels_removed)
+            if self._labels_changed_callback is not None:
+                self._labels_changed_callback(user_id, msg_id, labels_added, labels_removed)
+        if label_changes:
+            # IMPORTANT, STARRED и категории - признаки важности, поэтому письма переоцениваются
+            relabeled = self.store.get_many(user_id, list(dict.fromkeys(msg_id for msg_id, _, _ in label_changes)))
+            self.importance.score(relabeled, update_history=False)
+            self.store.save_importance(relabeled)
+
+        self._save_history_id(user_id, new_history_id)
+        return len(added) + len(deleted) + len(label_changes)
+
+    def _get_history(self, user_id: str, service, start_history_id: str) -> Tuple[List[Dict], str]:
+        """Возвращает все записи истории после start_history_id и новый курсор."""
+        history = []
+        next_page = None
+        latest_history_id = start_history_id
+        while True:
+            request = service.users().history().list(userId="me", startHistoryId=start_history_id,
+                                                     historyTypes=HISTORY_TYPES, pageToken=next_page)
+            results = self.limiter.execute(request, user_id, "history.list", LIVE)
+            history.extend(results.get("history", []))
+            latest_history_id = results.get("historyId", latest_history_id)
+            next_page = results.get("nextPageToken")
+            if not next_page:
+                return history, latest_history_id
+
+    def _full_resync(self, user_id: str, service) -> int:
+        """Перечитывает последние FULL_RESYNC_LIMIT писем и заводит новый history-курсор."""
+        # Курсор берём до загрузки писем, чтобы не потерять то, что придёт во время синхронизации
+        history_id = self.limiter.execute(service.users().getProfile(userId="me"), user_id, "getProfile")["historyId"]
+        results = self.limiter.execute(service.users().messages().list(userId="me", maxResults=FULL_RESYNC_LIMIT),
+                                       user_id, "messages.list")
+        message_ids = self._filter_new_ids(user_id, [message["id"] for message in results.get("messages", [])])
+        self._deliver_new(user_id, self._get_messages_batched(service, user_id, message_ids), notify=False)
+        self._save_history_id(user_id, history_id)
+        return len(message_ids)
+
+    def _filter_new_ids(self, user_id: str, message_ids: List[str]) -> List[str]:
+        known = self.store.existing_ids(user_id, message_ids)
+        return [msg_id for msg_id in message_ids if msg_id not in known]
+
+    def _deliver_new(self, user_id: str, messages: List[Dict], notify: bool = True):
+        if self._message_sink is not None:
+            # Разбор, сохранение и индексация выполняются стадиями конвейера; ждём только сохранения,
+            # чтобы курсор не ушёл дальше писем, которые ещё могут потеряться в очереди
+            self._message_sink(user_id, messages, notify).result()
+            return
+        emails = self.parse_messages(messages, user_id)
+        self.store_emails(emails)
+        if self._new_emails_callback is not None and emails:
+            self._new_emails_callback(emails)
+        if self._new_email_callback is not None:
+            for email in emails:
                 self._new_email_callback(email)
 
+    def set_message_sink(self, func):
+        """
+        Вместо разбора на месте отдаёт скачанные сообщения в func(user_id, messages, notify);
+        notify=False для писем, найденных полной пересинхронизацией, а не пришедших только что.
+        func возвращает Future, завершающийся после сохранения писем.
+        """
+        self._message_sink = func
+
     def add_email_callback(self, func):
         self._new_email_callback = func
 
-    def get_recent_worker(self):
-        while True:
-            self.get_recent()
-            time.sleep(5)
-
-    def _parse_email(self, raw_email, msg_id: str):
-        """Парсит сырое письмо в читаемый формат."""
-        msg_bytes = urlsafe_b64decode(raw_email)
-        email_message = message_from_bytes(msg_bytes)
-        return {
-            "id": msg_id,
-            "subject": email_message["Subject"],
-            "from": email_message["From"],
-            "to": email_message["To"],
-            "date": email_message["Date"],
-            "body": self._get_email_body(email_message),
-        }
-
-    def _get_email_body(self, email_message):
-        """Извлекает тело письма."""
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                if content_type == "text/plain":
-                    return part.get_payload(decode=True).decode()
-        else:
-            return email_message.get_payload(decode=True).decode()
+    def add_emails_callback(self, func):
+        """Колбэк получает все новые письма одной синхронизации списком."""
+        self._new_emails_callback = func
+
+    def add_deleted_email_callback(self, func):
+        self._deleted_email_callback = func
+
+    def add_deleted_emails_callback(self, func):
+        """Колбэк получает user_id и список id писем, удалённых за одну синхронизацию."""
+        self._deleted_emails_callback = func
+
+    def add_labels_changed_callback(self, func):
+        self._labels_changed_callback = func
+
+    def store_emails(self, emails: List[EmailRecord]):
+        """Сохраняет новые письма вместе с оценкой важности, посчитанной для всей пачки сразу."""
+        self.importance.score(emails)
+        self.store.save_many(emails)
+
+    def score_unscored(self, batch_size: int = 500):
+        """Оценивает письма, сохранённые до появления оценки важности."""
+        batch = []
+        user_ids = self._sync_user_ids() if self.leases is not None else None
+        for email in self.store.iter_emails(batch_size=batch_size, unscored=True, user_ids=user_ids):
+            batch.append(email)
+            if len(batch) >= batch_size:
+                self.importance.score(batch)
+                self.store.save_importance(batch)
+                batch = []
+        if batch:
+            self.importance.score(batch)
+            self.store.save_importance(batch)
+
+    def parse_messages(self, messages: List[Dict], user_id: str) -> List[EmailRecord]:
+        with metrics.timer("parse_seconds"):
+            if self.process_pool is not None:
+                emails = self.process_pool.submit(parse_emails, messages, user_id).result()
+            else:
+                emails = parse_emails(messages, user_id)
+        metrics.inc("emails_parsed_total", len(emails))
+        return emails
+
+    @staticmethod
+    def _decode_header(value: str) -> str:
+        if "=?" not in value:
+            return value
+        try:
+            return str(make_header(decode_header(value)))
+        except (UnicodeDecodeError, LookupError, ValueError):
+            return value
+
+    def _get_email_body(self, payload: Dict) -> str:
+        """Извлекает тело письма из payload формата full: text/plain, иначе текст из text/html."""
+        html = None
+        for part in iter_parts(payload):
+            data = part.get("body", {}).get("data")
+            if not data or part.get("filename"):
+                continue
+            if part.get("mimeType") == "text/plain":
+                return self._decode_part(part, data)
+            if part.get("mimeType") == "text/html" and html is None:
+                html = self._decode_part(part, data)
+        if html is not None:
+            return BeautifulSoup(html, "html.parser").get_text("\n", strip=True)
+        return ""
+
+    @staticmethod
+    def _decode_part(part: Dict, data: str) -> str:
+        message = Message()
+        for header in part.get("headers", []):
+            if header["name"].lower() == "content-type":
+                message["Content-Type"] = header["value"]
+        charset = message.get_content_charset() or "utf-8"
+        raw = urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        try:
+            return raw.decode(charset, errors="replace")
+        except LookupError:
+            return raw.decode("utf-8", errors="replace")
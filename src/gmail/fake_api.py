@@ -0,0 +1,390 @@
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from email.utils import formatdate
+from typing import Callable, Dict, Iterator, List, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+# Доли типов писем в синтетическом ящике
+DEFAULT_MIME_MIX = {"plain": 0.4, "html": 0.2, "alternative": 0.3, "attachment": 0.1}
+HISTORY_PAGE_SIZE = 100
+# Gmail хранит историю ограниченное время; здесь - ограниченное число записей
+HISTORY_RETENTION = 10000
+SENDER_DOMAINS = ["example.com", "mail.example.org", "news.example.net", "corp.example.io"]
+# Вложения повторяются между письмами и ящиками, как пересылаемые файлы: (имя, размер)
+ATTACHMENT_FILES = [("document.pdf", 200 * 1024), ("invoice.pdf", 120 * 1024), ("photo.jpg", 1024 * 1024),
+                    ("report.xlsx", 60 * 1024)]
+WORDS = ("invoice meeting report project deadline update review budget travel contract "
+         "schedule release design customer offer payment ticket support team plan").split()
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _http_error(status: int, reason: str) -> HttpError:
+    content = json.dumps({"error": {"code": status, "message": reason, "errors": [{"reason": reason}]}})
+    return HttpError(httplib2.Response({"status": status}), content.encode())
+
+
+class FakeMailbox:
+    """
+    Синтетический ящик Gmail: сообщения в формате full, история изменений с historyId
+    и генерация новых писем. Содержимое детерминировано seed, поэтому прогоны сравнимы.
+    """
+
+    def __init__(self, email_address: str, size: int = 1000, mime_mix: Optional[Dict[str, float]] = None,
+                 senders: int = 50, body_words: int = 120, seed: int = 0):
+        self.email_address = email_address
+        self.mime_mix = mime_mix or DEFAULT_MIME_MIX
+        self.body_words = body_words
+        self._random = random.Random(seed)
+        self._senders = [f"sender{i}@{SENDER_DOMAINS[i % len(SENDER_DOMAINS)]}" for i in range(senders)]
+        self._lock = threading.Lock()
+        self.messages: Dict[str, Dict] = {}
+        self.order: List[str] = []  # новые первыми, как в messages.list
+        self.history: List[Dict] = []
+        self.history_id = 1000
+        self._next_id = 0
+        self.attachments: Dict[str, tuple] = {}  # attachmentId -> (имя, размер)
+        # Исходное содержимое ящика истории не порождает, как и у настоящего Gmail
+        start = int(time.time()) - size * 600
+        for i in range(size):
+            self._add(start + i * 600, record_history=False)
+
+    def deliver(self, count: int = 1) -> List[str]:
+        """Добавляет count новых писем во входящие и возвращает их id."""
+        with self._lock:
+            now = int(time.time())
+            return [self._add(now, record_history=True) for _ in range(count)]
+
+    def delete(self, message_ids: List[str]):
+        with self._lock:
+            for msg_id in message_ids:
+                if self.messages.pop(msg_id, None) is not None:
+                    self.order.remove(msg_id)
+                    self._record({"messagesDeleted": [{"message": {"id": msg_id}}]})
+
+    def relabel(self, msg_id: str, added: List[str] = (), removed: List[str] = ()):
+        with self._lock:
+            labels = self.messages[msg_id]["labelIds"]
+            self.messages[msg_id]["labelIds"] = [label for label in labels if label not in removed] + \
+                [label for label in added if label not in labels]
+            message = {"id": msg_id, "labelIds": self.messages[msg_id]["labelIds"]}
+            if added:
+                self._record({"labelsAdded": [{"message": message, "labelIds": list(added)}]})
+            if removed:
+                self._record({"labelsRemoved": [{"message": message, "labelIds": list(removed)}]})
+
+    @staticmethod
+    def attachment_data(filename: str, size: int) -> bytes:
+        """Содержимое определяется именем и размером, поэтому один файл в разных письмах совпадает побайтно."""
+        block = hashlib.sha256(f"{filename}:{size}".encode()).digest()
+        return (block * (size // len(block) + 1))[:size]
+
+    def list_ids(self, offset: int, limit: int) -> List[str]:
+        with self._lock:
+            return self.order[offset:offset + limit]
+
+    def history_since(self, start_history_id: int, offset: int, limit: int) -> Optional[List[Dict]]:
+        """Записи истории после start_history_id; None, если курсор старше хранимой истории."""
+        with self._lock:
+            if self.history and start_history_id < self.history[0]["id"] - 1:
+                return None
+            records = [record for record in self.history if record["id"] > start_history_id]
+            return records[offset:offset + limit]
+
+    def _add(self, timestamp: int, record_history: bool) -> str:
+        self._next_id += 1
+        msg_id = f"{self._next_id:016x}"
+        kind = self._random.choices(list(self.mime_mix), weights=list(self.mime_mix.values()))[0]
+        sender = self._random.choice(self._senders)
+        subject = " ".join(self._random.choices(WORDS, k=4)).capitalize()
+        text = " ".join(self._random.choices(WORDS, k=self.body_words))
+        headers = [
+            {"name": "Subject", "value": subject},
+            {"name": "From", "value": f"{sender.split('@')[0].title()} <{sender}>"},
+            {"name": "To", "value": self.email_address},
+            {"name": "Date", "value": formatdate(timestamp)},
+        ]
+        self.messages[msg_id] = {
+            "id": msg_id,
+            "threadId": msg_id,
+            "labelIds": ["INBOX", "UNREAD"] if record_history else ["INBOX"],
+            "snippet": text[:100],
+            "internalDate": str(timestamp * 1000),
+            "payload": dict(self._payload(kind, text), headers=headers),
+        }
+        self.order.insert(0, msg_id)
+        if record_history:
+            self._record({"messagesAdded": [{"message": {"id": msg_id, "labelIds": ["INBOX", "UNREAD"]}}]})
+        return msg_id
+
+    def _payload(self, kind: str, text: str) -> Dict:
+        def plain(part_id):
+            return {"partId": part_id, "mimeType": "text/plain",
+                    "headers": [{"name": "Content-Type", "value": "text/plain; charset=utf-8"}],
+                    "body": {"data": _b64(text.encode())}}
+
+        def html(part_id):
+            return {"partId": part_id, "mimeType": "text/html",
+                    "headers": [{"name": "Content-Type", "value": "text/html; charset=utf-8"}],
+                    "body": {"data": _b64(f"<html><body><p>{text}</p></body></html>".encode())}}
+
+        if kind == "plain":
+            return plain("")
+        if kind == "html":
+            return html("")
+        if kind == "alternative":
+            return {"partId": "", "mimeType": "multipart/alternative", "body": {"size": 0},
+                    "parts": [plain("0"), html("1")]}
+        filename, size = self._random.choice(ATTACHMENT_FILES)
+        attachment_id = f"att-{self._next_id}"
+        self.attachments[attachment_id] = (filename, size)
+        attachment = {"partId": "1", "mimeType": "application/octet-stream", "filename": filename,
+                      "body": {"attachmentId": attachment_id, "size": size}}
+        alternative = {"partId": "0", "mimeType": "multipart/alternative", "body": {"size": 0},
+                       "parts": [plain("0.0"), html("0.1")]}
+        return {"partId": "", "mimeType": "multipart/mixed", "body": {"size": 0}, "parts": [alternative, attachment]}
+
+    def _record(self, change: Dict):
+        self.history_id += 1
+        self.history.append(dict(change, id=self.history_id))
+        del self.history[:-HISTORY_RETENTION]
+
+
+class FakeGmailApi:
+    """
+    Локальная замена Gmail API для бенчмарков: ящики по user_id, задержка на каждый
+    HTTP-запрос (batch - один запрос) и счётчики вызовов по методам.
+    error_rate - доля подзапросов messages.get, на которые отвечаем 429.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.01, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.mailboxes: Dict[str, FakeMailbox] = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def add_mailbox(self, user_id: str, mailbox: FakeMailbox):
+        self.mailboxes[str(user_id)] = mailbox
+
+    def service(self, user_id: str) -> "FakeGmailService":
+        return FakeGmailService(self, self.mailboxes[str(user_id)])
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def count(self, method: str, n: int = 1):
+        with self._lock:
+            self.calls[method] += n
+
+    def round_trip(self):
+        self.count("http")
+        delay = self.latency + self._uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and self._uniform(0, 1) < self.error_rate
+
+    def _uniform(self, a: float, b: float) -> float:
+        with self._lock:
+            return self._random.uniform(a, b)
+
+
+class FakeRequest:
+    def __init__(self, api: FakeGmailApi, method: str, handler: Callable[[], Dict]):
+        self.api = api
+        self.method = method
+        self.handler = handler
+
+    def execute(self) -> Dict:
+        self.api.round_trip()
+        return self.run()
+
+    def run(self) -> Dict:
+        self.api.count(self.method)
+        return self.handler()
+
+
+class FakeBatch:
+    def __init__(self, api: FakeGmailApi, callback: Callable):
+        self.api = api
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, request_id: str):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.api.round_trip()
+        for request_id, request in self.requests:
+            if request.method == "messages.get" and self.api.should_fail():
+                self.api.count("errors")
+                self.callback(request_id, None, _http_error(429, "rateLimitExceeded"))
+                continue
+            try:
+                self.callback(request_id, request.run(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeGmailService:
+    """Повторяет ту часть интерфейса googleapiclient, которой пользуется EmailLoader."""
+
+    def __init__(self, api: FakeGmailApi, mailbox: FakeMailbox):
+        self.api = api
+        self.mailbox = mailbox
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return _FakeHistory(self)
+
+    def attachments(self):
+        return _FakeAttachments(self)
+
+    def new_batch_http_request(self, callback: Callable) -> FakeBatch:
+        return FakeBatch(self.api, callback)
+
+    def getProfile(self, userId: str = "me") -> FakeRequest:
+        return FakeRequest(self.api, "getProfile", lambda: {
+            "emailAddress": self.mailbox.email_address,
+            "messagesTotal": len(self.mailbox.messages),
+            "historyId": str(self.mailbox.history_id),
+        })
+
+    def watch(self, userId: str = "me", body: Optional[Dict] = None) -> FakeRequest:
+        return FakeRequest(self.api, "watch", lambda: {
+            "historyId": str(self.mailbox.history_id),
+            "expiration": str(int((time.time() + 7 * 24 * 60 * 60) * 1000)),
+        })
+
+    def list(self, userId: str = "me", pageToken: Optional[str] = None, maxResults: int = 100,
+             **kwargs) -> FakeRequest:
+        def handler():
+            offset = int(pageToken or 0)
+            limit = min(maxResults or 100, 500)
+            ids = self.mailbox.list_ids(offset, limit)
+            result = {"messages": [{"id": msg_id, "threadId": msg_id} for msg_id in ids],
+                      "resultSizeEstimate": len(self.mailbox.messages)}
+            if offset + limit < len(self.mailbox.messages):
+                result["nextPageToken"] = str(offset + limit)
+            return result
+        return FakeRequest(self.api, "messages.list", handler)
+
+    def get(self, userId: str = "me", id: str = None, format: str = "full",
+            metadataHeaders: Optional[List[str]] = None, fields: Optional[str] = None) -> FakeRequest:
+        def handler():
+            msg = self.mailbox.messages.get(id)
+            if msg is None:
+                raise _http_error(404, "notFound")
+            if format == "full" and fields:
+                # Частичный ответ по маске EmailLoader: поля письма, заголовки и структура частей без данных
+                partial = {key: msg[key] for key in ("id", "labelIds", "snippet", "internalDate")}
+                # Глубина дерева ограничена вложенностью parts(...) в маске, как у Gmail
+                structure = _structure(msg["payload"], fields.count("parts("))
+                return dict(partial, payload=dict(structure, headers=msg["payload"]["headers"]))
+            if format == "full":
+                return msg
+            wanted = {header.lower() for header in metadataHeaders or []}
+            headers = [header for header in msg["payload"]["headers"]
+                       if not wanted or header["name"].lower() in wanted]
+            return dict(msg, payload={"mimeType": msg["payload"]["mimeType"], "headers": headers})
+        return FakeRequest(self.api, "messages.get", handler)
+
+
+class _FakeHistory:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str = "me", startHistoryId: str = None, historyTypes: Optional[List[str]] = None,
+             pageToken: Optional[str] = None, maxResults: int = HISTORY_PAGE_SIZE) -> FakeRequest:
+        mailbox = self.service.mailbox
+
+        def handler():
+            offset = int(pageToken or 0)
+            records = mailbox.history_since(int(startHistoryId), offset, maxResults + 1)
+            if records is None:
+                raise _http_error(404, "notFound")
+            result = {"history": records[:maxResults], "historyId": str(mailbox.history_id)}
+            if len(records) > maxResults:
+                result["nextPageToken"] = str(offset + maxResults)
+            return result
+        return FakeRequest(self.service.api, "history.list", handler)
+
+
+class _FakeAttachments:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def get(self, userId: str = "me", messageId: str = None, id: str = None) -> FakeRequest:
+        mailbox = self.service.mailbox
+
+        def handler():
+            if messageId not in mailbox.messages or id not in mailbox.attachments:
+                raise _http_error(404, "notFound")
+            data = mailbox.attachment_data(*mailbox.attachments[id])
+            return {"size": len(data), "data": _b64(data)}
+        return FakeRequest(self.service.api, "messages.attachments.get", handler)
+
+
+def _structure(part: Dict, depth: int) -> Dict:
+    result = {key: part[key] for key in ("partId", "mimeType", "filename") if key in part}
+    result["body"] = {key: value for key, value in part.get("body", {}).items() if key != "data"}
+    if "parts" in part and depth > 0:
+        result["parts"] = [_structure(child, depth - 1) for child in part["parts"]]
+    return result
+
+
+class FakeClientCache:
+    """Подменяет GmailClientCache: выдаёт фейковые сервисы вместо googleapiclient."""
+
+    def __init__(self, api: FakeGmailApi):
+        self.api = api
+        self._services: Dict[str, FakeGmailService] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self, user_id: str, creds) -> Iterator[FakeGmailService]:
+        user_id = str(user_id)
+        with self._lock:
+            if user_id not in self._services:
+                self._services[user_id] = self.api.service(user_id)
+                self._locks[user_id] = threading.Lock()
+        with self._locks[user_id]:
+            yield self._services[user_id]
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._services.pop(str(user_id), None)
+
+
+class FakeAuth:
+    """Подменяет GmailAuth: у каждого пользователя с фейковым ящиком есть "учётные данные"."""
+
+    def __init__(self, api: FakeGmailApi):
+        self.api = api
+
+    def load_creds(self, user_id: str):
+        return object() if str(user_id) in self.api.mailboxes else None
+
+    def get_cached_creds(self, user_id: str):
+        return self.load_creds(user_id)
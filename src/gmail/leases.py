@@ -0,0 +1,177 @@
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Set
+
+from src.metrics import metrics
+from src.storage import db
+
+# Аренда, не продлённая за LEASE_TTL секунд, считается брошенной и достаётся другому процессу
+LEASE_TTL = 60
+HEARTBEAT_INTERVAL = 15
+
+
+class LeaseManager:
+    """
+    Делит пользователей между процессами синхронизации через строки user_leases в SQLite.
+    Каждый процесс раз в heartbeat_interval отмечается в sync_workers, продлевает свои аренды
+    и доводит их число до доли ceil(пользователей / живых процессов): лишние отпускает,
+    недостающие забирает из свободных и просроченных. Так нагрузка перераспределяется,
+    когда процессы подключаются или умирают, а один ящик одновременно опрашивает только один.
+    """
+
+    def __init__(self, worker_id: Optional[str] = None, ttl: int = LEASE_TTL,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL):
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.worker_id = worker_id or f"{self.host}:{self.pid}:{uuid.uuid4().hex[:6]}"
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._owned: Set[str] = set()
+        self._syncing: Set[str] = set()
+        # Локальный срок аренд: без успешного heartbeat перестаём синхронизировать раньше,
+        # чем другой процесс сможет их забрать
+        self._valid_until = 0.0
+        self._on_claimed: Optional[Callable[[List[str]], None]] = None
+        self._on_released: Optional[Callable[[List[str]], None]] = None
+        self._on_workers: Optional[Callable[[int], None]] = None
+        # Число живых процессов по последнему heartbeat
+        self.workers = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Регистрирует процесс и сразу забирает свою долю, затем продлевает аренды в фоне."""
+        self.heartbeat()
+        metrics.gauge("leased_users", lambda: len(self._owned))
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Отпускает все аренды, чтобы остальные процессы забрали пользователей без ожидания TTL."""
+        self._stopped.set()
+        with self._lock:
+            released, self._owned = sorted(self._owned), set()
+            self._valid_until = 0.0
+        with db.transaction() as conn:
+            conn.execute("DELETE FROM user_leases WHERE worker_id = ?", (self.worker_id,))
+            conn.execute("DELETE FROM sync_workers WHERE worker_id = ?", (self.worker_id,))
+        if released and self._on_released is not None:
+            self._on_released(released)
+
+    def on_claimed(self, func: Callable[[List[str]], None]):
+        """func(user_ids) вызывается с пользователями, только что полученными в аренду."""
+        self._on_claimed = func
+
+    def on_released(self, func: Callable[[List[str]], None]):
+        """func(user_ids) вызывается с пользователями, чья аренда отдана другим процессам или снята."""
+        self._on_released = func
+
+    def on_workers(self, func: Callable[[int], None]):
+        """func(workers) вызывается, когда меняется число живых процессов синхронизации."""
+        self._on_workers = func
+
+    def owned_users(self) -> List[str]:
+        with self._lock:
+            if time.time() >= self._valid_until:
+                return []
+            return sorted(self._owned)
+
+    def holds(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._owned and time.time() < self._valid_until
+
+    @contextmanager
+    def syncing(self, user_id: str) -> Iterator[bool]:
+        """
+        Отмечает пользователя занятым на время синхронизации; выдаёт False, если аренды нет.
+        Занятых пользователей heartbeat не отпускает при перебалансировке.
+        """
+        with self._lock:
+            held = user_id in self._owned and time.time() < self._valid_until
+            if held:
+                self._syncing.add(user_id)
+        try:
+            yield held
+        finally:
+            if held:
+                with self._lock:
+                    self._syncing.discard(user_id)
+
+    def heartbeat(self):
+        now = int(time.time())
+        expires_at = now + self.ttl
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: два процесса не заберут одного пользователя
+        with db.transaction() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                INSERT INTO sync_workers (worker_id, host, pid, started_at, heartbeat_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (worker_id) DO UPDATE SET
+                    heartbeat_at = excluded.heartbeat_at,
+                    expires_at = excluded.expires_at
+            """, (self.worker_id, self.host, self.pid, now, now, expires_at))
+            conn.execute("DELETE FROM sync_workers WHERE expires_at < ?", (now,))
+            # Аренды удалённых пользователей
+            conn.execute("DELETE FROM user_leases WHERE user_id NOT IN (SELECT user_id FROM auth_tokens)")
+            conn.execute("UPDATE user_leases SET expires_at = ? WHERE worker_id = ?", (expires_at, self.worker_id))
+
+            workers = conn.execute("SELECT COUNT(*) FROM sync_workers").fetchone()[0]
+            users = conn.execute("SELECT COUNT(*) FROM auth_tokens").fetchone()[0]
+            share = math.ceil(users / max(workers, 1))
+            owned = [row[0] for row in conn.execute(
+                "SELECT user_id FROM user_leases WHERE worker_id = ? ORDER BY user_id", (self.worker_id,))]
+
+            released = []
+            if len(owned) > share:
+                with self._lock:
+                    idle = [user_id for user_id in owned if user_id not in self._syncing]
+                released = idle[-(len(owned) - share):]
+                conn.executemany("DELETE FROM user_leases WHERE user_id = ? AND worker_id = ?",
+                                 [(user_id, self.worker_id) for user_id in released])
+
+            claimed = []
+            if len(owned) < share:
+                claimed = [row[0] for row in conn.execute("""
+                    SELECT a.user_id FROM auth_tokens a
+                    LEFT JOIN user_leases l ON l.user_id = a.user_id
+                    WHERE l.user_id IS NULL OR l.expires_at < ?
+                    ORDER BY a.user_id
+                    LIMIT ?
+                """, (now, share - len(owned)))]
+                conn.executemany("""
+                    INSERT INTO user_leases (user_id, worker_id, acquired_at, expires_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        worker_id = excluded.worker_id,
+                        acquired_at = excluded.acquired_at,
+                        expires_at = excluded.expires_at
+                """, [(user_id, self.worker_id, now, expires_at) for user_id in claimed])
+
+        with self._lock:
+            # Аренды удалённых пользователей и просроченные снял не этот heartbeat, но они тоже потеряны
+            released = sorted(((self._owned - set(owned)) | set(released)) - set(claimed))
+            self._owned = (set(owned) - set(released)) | set(claimed)
+            self._valid_until = expires_at
+        metrics.inc("leases_claimed_total", len(claimed))
+        metrics.inc("leases_released_total", len(released))
+        if claimed and self._on_claimed is not None:
+            self._on_claimed(claimed)
+        if released and self._on_released is not None:
+            self._on_released(released)
+        if workers != self.workers:
+            self.workers = workers
+            if self._on_workers is not None:
+                self._on_workers(workers)
+
+    def _worker(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"Failed to renew user leases: {e}")
@@ -0,0 +1,166 @@
+import base64
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from src.storage import db
+
+# Gmail держит watch не дольше 7 дней; продлеваем заранее
+WATCH_RENEW_MARGIN = 24 * 60 * 60
+WATCH_CHECK_INTERVAL = 60 * 60
+DEFAULT_PUSH_PORT = 8085
+
+
+class WatchManager:
+    """Регистрирует users.watch для ящиков и продлевает их, храня срок действия в gmail_watches."""
+
+    def __init__(self, loader, topic: str, label_ids: Optional[List[str]] = None):
+        self.loader = loader
+        self.topic = topic
+        self.label_ids = label_ids or ["INBOX"]
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def user_for_address(self, email_address: str) -> Optional[str]:
+        result = db.query_one("SELECT user_id FROM gmail_watches WHERE email_address = ?",
+                              (email_address.lower(),))
+        return result[0] if result else None
+
+    def renew_expiring(self):
+        deadline_ms = int((time.time() + WATCH_RENEW_MARGIN) * 1000)
+        watched = {row[0]: row[1] for row in db.query_all("SELECT user_id, expiration FROM gmail_watches")}
+        for user_id in self.loader._sync_user_ids():
+            if watched.get(user_id, 0) > deadline_ms:
+                continue
+            try:
+                self.watch(user_id)
+            except Exception as e:
+                print(f"Failed to renew watch for user {user_id}: {e}")
+
+    def watch(self, user_id: str):
+        creds = self.loader.auth_service.load_creds(user_id)
+        if creds is None:
+            return
+        with self.loader.clients.client(user_id, creds) as service:
+            limiter = self.loader.limiter
+            profile = limiter.execute(service.users().getProfile(userId="me"), user_id, "getProfile")
+            response = limiter.execute(service.users().watch(userId="me", body={
+                "topicName": self.topic,
+                "labelIds": self.label_ids,
+                "labelFilterBehavior": "include",
+            }), user_id, "watch")
+        db.execute("""
+            INSERT OR REPLACE INTO gmail_watches (user_id, email_address, history_id, expiration, topic, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, profile["emailAddress"].lower(), str(response["historyId"]),
+              int(response["expiration"]), self.topic, int(time.time())))
+
+    def _worker(self):
+        while not self._stopped.is_set():
+            self.renew_expiring()
+            self._stopped.wait(WATCH_CHECK_INTERVAL)
+
+
+class PushReceiver:
+    """
+    Локальный HTTP-приёмник push-уведомлений Pub/Sub от Gmail. Тело запроса - стандартный
+    конверт {"message": {"data": base64({"emailAddress", "historyId"}), ...}, "subscription": ...}.
+    По каждому уведомлению вызывается on_notification(email_address, history_id).
+    """
+
+    def __init__(self, on_notification: Callable[[str, str], None], host: str = "127.0.0.1",
+                 port: int = DEFAULT_PUSH_PORT, token: Optional[str] = None):
+        self.on_notification = on_notification
+        self.token = token
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def parse_envelope(body: bytes) -> Dict:
+        envelope = json.loads(body)
+        data = envelope["message"]["data"]
+        return json.loads(base64.b64decode(data + "=" * (-len(data) % 4)))
+
+    def _make_handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if receiver.token is not None:
+                    token = parse_qs(urlparse(self.path).query).get("token", [None])[0]
+                    if token != receiver.token:
+                        self._reply(403)
+                        return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    notification = receiver.parse_envelope(self.rfile.read(length))
+                    email_address = notification["emailAddress"]
+                    history_id = str(notification["historyId"])
+                except (ValueError, KeyError, TypeError):
+                    self._reply(400)
+                    return
+                # Подтверждаем сразу: синхронизация идёт в планировщике, а не в запросе Pub/Sub
+                self._reply(204)
+                try:
+                    receiver.on_notification(email_address, history_id)
+                except Exception as e:
+                    print(f"Failed to handle push notification for {email_address}: {e}")
+
+            def _reply(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class LocalPushPublisher:
+    """Заменитель Pub/Sub для тестов и бенчмарков: шлёт приёмнику уведомления в том же формате."""
+
+    def __init__(self, url: str, subscription: str = "projects/local/subscriptions/gmail"):
+        self.url = url
+        self.subscription = subscription
+        self._message_id = 0
+
+    def publish(self, email_address: str, history_id) -> int:
+        self._message_id += 1
+        data = json.dumps({"emailAddress": email_address, "historyId": int(history_id)}).encode()
+        envelope = {
+            "message": {
+                "data": base64.b64encode(data).decode(),
+                "messageId": str(self._message_id),
+                "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            },
+            "subscription": self.subscription,
+        }
+        request = urllib.request.Request(self.url, data=json.dumps(envelope).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request) as response:
+            return response.status
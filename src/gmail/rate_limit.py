@@ -0,0 +1,201 @@
+import itertools
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+
+from src.metrics import metrics
+
+# Приоритеты: меньше - важнее
+INTERACTIVE = 0
+LIVE = 1
+BACKFILL = 2
+
+# Стоимость методов в единицах квоты Gmail API
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.attachments.get": 5,
+    "watch": 100,
+}
+# Лимиты Gmail: 250 единиц в секунду на пользователя и 1 200 000 в минуту на проект
+PER_USER_UNITS_PER_SECOND = 250
+GLOBAL_UNITS_PER_SECOND = 20000
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# Как часто выбрасываются бакеты пользователей, не делавших запросов: полный бакет не отличается от нового
+SWEEP_INTERVAL = 60.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # До этого момента бакет закрыт: так соблюдается Retry-After после 429
+        self.blocked_until = 0.0
+
+    def wait_time(self, units: float, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # Запрос дороже ёмкости всё равно пропускаем, когда бакет полон
+        needed = min(units, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, units: float):
+        self.tokens -= units
+
+    def is_idle(self, now: float) -> bool:
+        """Бакет полон и не закрыт: его можно выбросить без изменения поведения лимитера."""
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class QuotaLimiter:
+    """
+    Общий слой вызовов Gmail API: учёт квоты токен-бакетами на пользователя и на весь процесс,
+    приоритеты (интерактивные запросы бота, затем живая синхронизация, затем догрузка истории)
+    и повтор с экспоненциальной задержкой и jitter на 429/5xx с учётом Retry-After.
+    """
+
+    def __init__(self, per_user_rate: float = PER_USER_UNITS_PER_SECOND,
+                 global_rate: float = GLOBAL_UNITS_PER_SECOND, max_retries: int = MAX_RETRIES):
+        self.per_user_rate = per_user_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._users: Dict[str, TokenBucket] = {}
+        self._cond = threading.Condition()
+        self._waiting: List[Tuple[int, int, str, float]] = []  # (priority, seq, user_id, units) ожидающих вызовов
+        self._seq = itertools.count()
+        self._swept = time.monotonic()
+
+    def acquire(self, user_id: str, units: float, priority: int = LIVE):
+        """Блокирует поток, пока у пользователя и у процесса не хватит квоты."""
+        entry = (priority, next(self._seq), user_id, units)
+        started = time.perf_counter()
+        with self._cond:
+            self._waiting.append(entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    user_bucket = self._user_bucket(user_id)
+                    wait = max(user_bucket.wait_time(units, now), self._global.wait_time(units, now))
+                    if wait == 0.0 and not self._outranked(entry, now):
+                        user_bucket.take(units)
+                        self._global.take(units)
+                        if now - self._swept >= SWEEP_INTERVAL:
+                            self._sweep(now)
+                        metrics.observe("gmail_quota_wait_seconds", time.perf_counter() - started, priority=priority)
+                        return
+                    self._cond.wait(timeout=wait if wait > 0 else 0.05)
+            finally:
+                self._waiting.remove(entry)
+                self._cond.notify_all()
+
+    def _outranked(self, entry: Tuple[int, int, str, float], now: float) -> bool:
+        """
+        Есть ли более приоритетный вызов, претендующий на тот же бакет: того же пользователя или
+        другого, который ждёт уже только общую квоту. Вызов, стоящий на квоте или Retry-After
+        своего пользователя, остальных пользователей не задерживает.
+        """
+        priority, _, user_id, _ = entry
+        for other_priority, _, other_user_id, other_units in self._waiting:
+            if other_priority >= priority:
+                continue
+            if other_user_id == user_id:
+                return True
+            if self._user_bucket(other_user_id).wait_time(other_units, now) == 0.0:
+                return True
+        return False
+
+    def set_global_rate(self, rate: float):
+        """Меняет общую квоту процесса, например когда проектную квоту делят несколько процессов."""
+        with self._cond:
+            self._global.rate = self._global.capacity = rate
+            self._global.tokens = min(self._global.tokens, rate)
+            self._cond.notify_all()
+
+    def block_user(self, user_id: str, seconds: float):
+        """Закрывает квоту пользователя на seconds, чтобы не тратить её на заведомо неудачные повторы."""
+        with self._cond:
+            bucket = self._user_bucket(user_id)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+
+    def forget(self, user_id: str):
+        """Выбрасывает бакет пользователя, которого этот процесс больше не обслуживает."""
+        with self._cond:
+            self._users.pop(user_id, None)
+
+    def _sweep(self, now: float):
+        waiting = {entry[2] for entry in self._waiting}
+        for user_id in [user_id for user_id, bucket in self._users.items()
+                        if user_id not in waiting and bucket.is_idle(now)]:
+            del self._users[user_id]
+        self._swept = now
+
+    def execute(self, request, user_id: str, method: str, priority: int = LIVE):
+        """Выполняет запрос googleapiclient с учётом квоты и повторами на временных ошибках."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(user_id, QUOTA_UNITS.get(method, 5), priority)
+            metrics.inc("gmail_requests_total", method=method)
+            try:
+                with metrics.timer("gmail_request_seconds", method=method):
+                    return request.execute()
+            except HttpError as e:
+                metrics.inc("gmail_errors_total", method=method, status=e.resp.status)
+                if not self.is_retryable(e) or attempt == self.max_retries:
+                    raise
+                metrics.inc("gmail_retries_total", method=method)
+                delay = self.retry_delay(e, attempt)
+                if self.is_rate_limited(e):
+                    self.block_user(user_id, delay)
+                time.sleep(delay)
+
+    @staticmethod
+    def is_rate_limited(error: HttpError) -> bool:
+        if error.resp.status == 429:
+            return True
+        if error.resp.status != 403:
+            return False
+        try:
+            details = json.loads(error.content).get("error", {}).get("errors", [])
+        except (ValueError, AttributeError):
+            return False
+        return any(detail.get("reason") in RATE_LIMIT_REASONS for detail in details)
+
+    @classmethod
+    def is_retryable(cls, error: HttpError) -> bool:
+        return error.resp.status in RETRYABLE_STATUSES or cls.is_rate_limited(error)
+
+    @staticmethod
+    def retry_delay(error: Optional[HttpError], attempt: int) -> float:
+        """Retry-After, если сервер его прислал, иначе "full jitter" от экспоненциальной задержки."""
+        retry_after = error.resp.get("retry-after") if error is not None else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                try:
+                    return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+    def _user_bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.per_user_rate)
+        return bucket
@@ -0,0 +1,84 @@
+import sys
+from typing import Callable, Iterable, Optional, Tuple
+
+_NOT_LOADED = object()
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+class AttachmentRecord:
+    """
+    Вложение письма: метаданные известны с загрузки письма, содержимое скачивается по запросу.
+    content_hash - sha256 содержимого в кэше вложений, None - ещё не скачивали.
+    """
+
+    __slots__ = ("part_id", "filename", "mime_type", "size", "attachment_id", "content_hash")
+
+    def __init__(self, part_id: str, filename: str, mime_type: Optional[str] = None, size: int = 0,
+                 attachment_id: Optional[str] = None, content_hash: Optional[str] = None):
+        self.part_id = part_id
+        self.filename = filename
+        self.mime_type = _intern(mime_type)
+        self.size = size
+        # Ссылка Gmail для attachments.get; у маленьких вложений её нет, данные приходят в самом письме
+        self.attachment_id = attachment_id
+        self.content_hash = content_hash
+
+    def __repr__(self):
+        return f"AttachmentRecord(part_id={self.part_id!r}, filename={self.filename!r}, size={self.size})"
+
+
+class EmailRecord:
+    """
+    Компактная запись письма. Адреса, user_id и метки интернируются, поэтому тысячи писем
+    от одного отправителя делят одну строку. Тело не хранится в записи, пока его не запросят:
+    body_loader вызывается при первом обращении к body.
+    """
+
+    __slots__ = ("number", "user_id", "id", "subject", "sender", "recipient", "date", "timestamp",
+                 "snippet", "labels", "sync_state", "importance", "attachments", "_body", "_body_loader")
+
+    def __init__(self, id: str, user_id: Optional[str] = None, subject: Optional[str] = None,
+                 sender: Optional[str] = None, recipient: Optional[str] = None, date: Optional[str] = None,
+                 timestamp: Optional[int] = None, snippet: Optional[str] = None, labels: Iterable[str] = (),
+                 sync_state: Optional[str] = None, importance: Optional[float] = None,
+                 number: Optional[int] = None, body=_NOT_LOADED,
+                 body_loader: Optional[Callable[[str, str], Optional[str]]] = None,
+                 attachments: Iterable[AttachmentRecord] = ()):
+        self.number = number
+        self.user_id = _intern(user_id)
+        self.id = id
+        self.subject = subject
+        self.sender = _intern(sender)
+        self.recipient = _intern(recipient)
+        self.date = date
+        self.timestamp = timestamp
+        self.snippet = snippet
+        self.labels: Tuple[str, ...] = tuple(sys.intern(label) for label in labels)
+        self.sync_state = _intern(sync_state)
+        # Оценка важности 0..1; None - письмо не оценивалось (например, отправленное)
+        self.importance = importance
+        # Заполняется при разборе письма; записи из хранилища вложения не подгружают
+        self.attachments: Tuple[AttachmentRecord, ...] = tuple(attachments)
+        self._body = body
+        self._body_loader = body_loader
+
+    @property
+    def body(self) -> Optional[str]:
+        """Тело письма; None - тело ещё не скачано из Gmail."""
+        if self._body is _NOT_LOADED:
+            self._body = self._body_loader(self.user_id, self.id) if self._body_loader is not None else None
+        return self._body
+
+    @body.setter
+    def body(self, value: Optional[str]):
+        self._body = value
+
+    @property
+    def body_loaded(self) -> bool:
+        return self._body is not _NOT_LOADED
+
+    def __repr__(self):
+        return f"EmailRecord(id={self.id!r}, user_id={self.user_id!r}, subject={self.subject!r})"
@@ -0,0 +1,144 @@
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+MAX_WORKERS = 8
+MIN_INTERVAL = 2.0
+DEFAULT_INTERVAL = 5.0
+MAX_INTERVAL = 120.0
+BACKOFF_FACTOR = 2.0
+# Как часто перечитываем список пользователей из БД
+USERS_REFRESH_INTERVAL = 30.0
+
+
+class UserPollState:
+    def __init__(self, user_id: str, next_due: float):
+        self.user_id = user_id
+        self.interval = DEFAULT_INTERVAL
+        self.next_due = next_due
+        self.last_success: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.in_flight = False
+        self.triggered = False
+
+
+class PollScheduler:
+    """
+    Опрашивает ящики пользователей параллельно в ограниченном пуле потоков.
+    Для каждого пользователя хранится время следующего опроса: интервал растёт
+    для пустых ящиков и сбрасывается до минимального, когда приходят изменения.
+    """
+
+    def __init__(self, poll_user: Callable[[str], int], list_users: Callable[[], List[str]],
+                 max_workers: int = MAX_WORKERS, min_interval: float = MIN_INTERVAL,
+                 max_interval: float = MAX_INTERVAL):
+        self._poll_user = poll_user
+        self._list_users = list_users
+        self.max_workers = max_workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gmail-poll")
+        self._cond = threading.Condition()
+        self._states: Dict[str, UserPollState] = {}
+        self._queue = []  # (next_due, user_id), устаревшие записи пропускаются при извлечении
+        self._stopped = False
+        self._users_refreshed_at = 0.0
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            if now - self._users_refreshed_at >= USERS_REFRESH_INTERVAL:
+                self._refresh_users()
+            with self._cond:
+                if self._stopped:
+                    break
+                due = self._pop_due(time.monotonic())
+                if not due:
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else USERS_REFRESH_INTERVAL
+                    self._cond.wait(timeout=min(max(timeout, 0.0), USERS_REFRESH_INTERVAL))
+                    continue
+                for state in due:
+                    state.in_flight = True
+            for state in due:
+                self._executor.submit(self._poll, state)
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def trigger(self, user_id: str):
+        """Ставит пользователя на опрос вне очереди."""
+        with self._cond:
+            state = self._states.get(user_id)
+            if state is None:
+                state = self._states[user_id] = UserPollState(user_id, time.monotonic())
+            elif state.in_flight:
+                state.triggered = True
+                return
+            else:
+                state.next_due = time.monotonic()
+            heapq.heappush(self._queue, (state.next_due, user_id))
+            self._cond.notify_all()
+
+    def get_lag(self, user_id: str) -> Optional[float]:
+        """Сколько секунд прошло с последней успешной синхронизации пользователя."""
+        state = self._states.get(user_id)
+        if state is None or state.last_success is None:
+            return None
+        return time.monotonic() - state.last_success
+
+    def lags(self) -> Dict[str, Optional[float]]:
+        return {user_id: self.get_lag(user_id) for user_id in list(self._states)}
+
+    def _refresh_users(self):
+        try:
+            user_ids = set(self._list_users())
+        except Exception as e:
+            print(f"Failed to list users for polling: {e}")
+            return
+        now = time.monotonic()
+        with self._cond:
+            for user_id in user_ids - self._states.keys():
+                state = self._states[user_id] = UserPollState(user_id, now)
+                heapq.heappush(self._queue, (state.next_due, user_id))
+            for user_id in self._states.keys() - user_ids:
+                del self._states[user_id]
+        self._users_refreshed_at = now
+
+    def _pop_due(self, now: float) -> List[UserPollState]:
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            next_due, user_id = heapq.heappop(self._queue)
+            state = self._states.get(user_id)
+            if state is None or state.in_flight or state.next_due != next_due:
+                continue
+            due.append(state)
+        return due
+
+    def _poll(self, state: UserPollState):
+        changes = 0
+        error = None
+        try:
+            changes = self._poll_user(state.user_id)
+        except Exception as e:
+            error = str(e)
+            print(f"An error occurred for user {state.user_id}: {e}")
+        with self._cond:
+            now = time.monotonic()
+            state.in_flight = False
+            state.last_error = error
+            if error is None:
+                state.last_success = now
+            if changes:
+                state.interval = self.min_interval
+            else:
+                state.interval = min(state.interval * BACKOFF_FACTOR, self.max_interval)
+            state.next_due = now if state.triggered else now + state.interval
+            state.triggered = False
+            if state.user_id in self._states:
+                heapq.heappush(self._queue, (state.next_due, state.user_id))
+            self._cond.notify_all()
@@ -0,0 +1,146 @@
+import math
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.gmail.email_store import EmailStore
+from src.gmail.records import EmailRecord
+from src.metrics import metrics
+from src.storage import db
+
+_AUTOMATED_RE = re.compile(r"^(no-?reply|do-?not-?reply|notifications?|mailer-daemon|newsletter|news|info)[@+]")
+_BULK_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_FORUMS"}
+
+
+class HeuristicImportanceClassifier:
+    """Линейная модель с весами, подобранными вручную; работает без обучения и зависимостей."""
+
+    WEIGHTS = {
+        "gmail_important": 0.35,
+        "starred": 0.3,
+        "reply_rate": 0.3,
+        "replied_before": 0.15,
+        "known_sender": 0.05,
+        "bulk": -0.25,
+        "updates": -0.1,
+        "automated": -0.2,
+    }
+    BIAS = 0.2
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, bias: float = BIAS):
+        self.weights = weights or self.WEIGHTS
+        self.bias = bias
+        self.name = "heuristic-v1"
+
+    def score(self, features: List[Dict[str, float]]) -> List[float]:
+        return [min(1.0, max(0.0, self.bias + sum(weight * row.get(name, 0.0)
+                                                  for name, weight in self.weights.items())))
+                for row in features]
+
+
+class SklearnImportanceClassifier:
+    """
+    Обученная модель scikit-learn (например LogisticRegression), сохранённая joblib.
+    Признаки подаются в порядке FEATURES, важность - вероятность положительного класса.
+    """
+
+    FEATURES = tuple(HeuristicImportanceClassifier.WEIGHTS)
+
+    def __init__(self, model_path: str):
+        try:
+            import joblib
+        except ImportError as e:
+            raise ImportError("Для SklearnImportanceClassifier установите scikit-learn") from e
+        self.model = joblib.load(model_path)
+        self.name = f"sklearn:{model_path}"
+
+    def score(self, features: List[Dict[str, float]]) -> List[float]:
+        if not features:
+            return []
+        rows = [[row.get(name, 0.0) for name in self.FEATURES] for row in features]
+        return [float(p) for p in self.model.predict_proba(rows)[:, 1]]
+
+
+class ImportanceScorer:
+    """
+    Оценивает важность писем при сохранении, пачками. Признаки: метки Gmail и история
+    переписки с отправителем (сколько писем от него пришло и сколько раз ему отвечали),
+    которая копится в sender_stats по мере загрузки писем. Отправленные письма не оцениваются.
+    """
+
+    def __init__(self, classifier=None):
+        self.classifier = classifier if classifier is not None else HeuristicImportanceClassifier()
+
+    def score(self, emails: List[EmailRecord], update_history: bool = True):
+        """Проставляет email.importance; update_history=False для повторной оценки уже учтённых писем."""
+        if not emails:
+            return
+        with metrics.timer("importance_batch_seconds"):
+            if update_history:
+                self._update_sender_stats(emails)
+            incoming = [email for email in emails if "SENT" not in email.labels]
+            stats = self._load_sender_stats(incoming)
+            features = [self.features(email, stats.get((email.user_id, EmailStore.sender_address(email.sender)),
+                                                       (0, 0)))
+                        for email in incoming]
+            for email, score in zip(incoming, self.classifier.score(features)):
+                email.importance = score
+
+    @staticmethod
+    def features(email: EmailRecord, stats: Tuple[int, int]) -> Dict[str, float]:
+        received, replied = stats
+        labels = set(email.labels)
+        address = EmailStore.sender_address(email.sender) or ""
+        return {
+            "gmail_important": float("IMPORTANT" in labels),
+            "starred": float("STARRED" in labels),
+            "reply_rate": min(1.0, replied / received) if received else 0.0,
+            "replied_before": float(replied > 0),
+            "known_sender": min(1.0, math.log1p(received) / math.log1p(100)),
+            "bulk": float(bool(labels & _BULK_LABELS)),
+            "updates": float("CATEGORY_UPDATES" in labels),
+            "automated": float(bool(_AUTOMATED_RE.match(address))),
+        }
+
+    def _update_sender_stats(self, emails: Iterable[EmailRecord]):
+        received, replied = {}, {}
+        for email in emails:
+            if "SENT" in email.labels:
+                # Ответ - это отправленное письмо адресату, от которого мы получаем почту
+                for address in EmailStore.recipient_addresses(email.recipient):
+                    replied[(email.user_id, address)] = replied.get((email.user_id, address), 0) + 1
+            else:
+                address = EmailStore.sender_address(email.sender)
+                if address:
+                    received[(email.user_id, address)] = received.get((email.user_id, address), 0) + 1
+        now = int(time.time())
+        rows = [(user_id, address, received.get((user_id, address), 0), replied.get((user_id, address), 0), now)
+                for user_id, address in received.keys() | replied.keys()]
+        if not rows:
+            return
+        db.executemany("""
+            INSERT INTO sender_stats (user_id, sender_address, received, replied, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, sender_address) DO UPDATE SET
+                received = received + excluded.received,
+                replied = replied + excluded.replied,
+                updated_at = excluded.updated_at
+        """, rows)
+
+    def _load_sender_stats(self, emails: List[EmailRecord]) -> Dict[Tuple[str, str], Tuple[int, int]]:
+        by_user: Dict[str, set] = {}
+        for email in emails:
+            address = EmailStore.sender_address(email.sender)
+            if address:
+                by_user.setdefault(email.user_id, set()).add(address)
+        stats = {}
+        for user_id, addresses in by_user.items():
+            addresses = list(addresses)
+            placeholders = ",".join("?" * len(addresses))
+            rows = db.query_all(f"""
+                SELECT sender_address, received, replied FROM sender_stats
+                WHERE user_id = ? AND sender_address IN ({placeholders})
+            """, (user_id, *addresses))
+            for address, received_count, replied_count in rows:
+                stats[(user_id, address)] = (received_count, replied_count)
+        return stats
@@ -0,0 +1,224 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Границы корзин гистограмм в секундах: от быстрых запросов SQLite до медленных вызовов API
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_METRICS_PORT = 9108
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (key + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for key, value in items)
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Счётчики, гистограммы времени и gauge-функции в памяти процесса. Запись - словарь под
+    одной блокировкой, так что вызывать можно из потоков опроса, пула конвейера и event loop.
+    Отдаётся в текстовом формате Prometheus через MetricsServer.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[Labels, float]] = collections.defaultdict(dict)
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = collections.defaultdict(dict)
+        self._gauges: Dict[str, Tuple[Callable[[], object], Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Записывает длительность блока в гистограмму name (секунды), в том числе при исключении."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name: str, func: Callable[[], object], label: Optional[str] = None):
+        """
+        Значение считается при чтении метрик: func возвращает число или, если задан label,
+        словарь {значение метки: число} (например лаг синхронизации по user_id).
+        """
+        self._gauges[name] = (func, label)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: (list(h.counts), h.sum, h.count) for key, h in series.items()}
+                          for name, series in self._histograms.items()}
+        gauges = {}
+        for name, (func, label) in list(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                print(f"Failed to read gauge {name}: {e}")
+                continue
+            if label is None:
+                gauges[name] = {(): value}
+            else:
+                gauges[name] = {((label, str(key)),): item for key, item in value.items()}
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, series in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_format_labels(key)} {'NaN' if value is None else value}"
+                         for key, value in series.items())
+        for name, series in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, (counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', le))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class SamplingProfiler:
+    """
+    Статистический профайлер без зависимостей: раз в interval снимает стеки всех потоков
+    через sys._current_frames и считает одинаковые стеки. Результат - collapsed stacks
+    ("f1;f2;f3 count"), которые читают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float) -> str:
+        # Одновременно работает один профайлер, чтобы не мерить самих себя
+        with self._lock:
+            stacks = collections.Counter()
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    stack = traceback.extract_stack(frame)
+                    stacks[";".join(f"{entry.name} ({entry.filename}:{entry.lineno})" for entry in stack)] += 1
+                time.sleep(self.interval)
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт: GET /metrics - метрики, GET /profile?seconds=N - сэмплирующий профайлер."""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = DEFAULT_METRICS_PORT,
+                 profiler: Optional[SamplingProfiler] = None):
+        self.registry = registry
+        self.profiler = profiler
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/metrics":
+                    self._reply(200, server.registry.render())
+                elif url.path == "/profile" and server.profiler is not None:
+                    try:
+                        seconds = float(parse_qs(url.query).get("seconds", ["5"])[0])
+                    except ValueError:
+                        self._reply(400, "seconds must be a number\n")
+                        return
+                    self._reply(200, server.profiler.profile(seconds))
+                else:
+                    self._reply(404, "not found\n")
+
+            def _reply(self, status: int, body: str):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+metrics = MetricsRegistry()
+
+
+def start_metrics_server(host: str = "127.0.0.1", port: int = DEFAULT_METRICS_PORT,
+                         profile: bool = False) -> MetricsServer:
+    server = MetricsServer(metrics, host=host, port=port, profiler=SamplingProfiler() if profile else None)
+    server.start()
+    return server
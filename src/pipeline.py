@@ -0,0 +1,198 @@
+import asyncio
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from src.gmail.records import EmailRecord
+from src.metrics import metrics
+
+QUEUE_SIZE = 64
+EMBED_BATCH_SIZE = 128
+PARSE_WORKERS = 2
+EMBED_WORKERS = 2
+# messagesAdded включает и собственные отправленные письма, и каждое автосохранение черновика -
+# уведомляем только о входящих
+NOTIFY_LABEL = "INBOX"
+SKIP_NOTIFY_LABELS = frozenset({"SENT", "DRAFT"})
+
+
+def is_incoming(email: EmailRecord) -> bool:
+    return NOTIFY_LABEL in email.labels and SKIP_NOTIFY_LABELS.isdisjoint(email.labels)
+
+
+class _Batch:
+    def __init__(self, user_id: str, notify: bool, messages: Optional[List[Dict]] = None,
+                 emails: Optional[List[EmailRecord]] = None):
+        self.user_id = user_id
+        self.notify = notify
+        self.messages = messages
+        self.emails = emails
+        self.embeddings = None
+        # Завершается, когда письма пачки сохранены в хранилище
+        self.stored: Future = Future()
+
+
+class IngestPipeline:
+    """
+    Конвейер fetch -> parse -> embed -> index -> notify в event loop бота.
+    Стадии связаны ограниченными очередями: если индексация не успевает, очереди заполняются
+    и поток опроса блокируется в submit, а не копит письма в памяти. Разбор, эмбеддинги и
+    запись в индекс выполняются в пуле, чтобы не занимать event loop.
+    """
+
+    def __init__(self, loader, embedding_engine, vector_db, loop: asyncio.AbstractEventLoop,
+                 queue_size: int = QUEUE_SIZE, embed_batch_size: int = EMBED_BATCH_SIZE,
+                 parse_workers: int = PARSE_WORKERS, embed_workers: int = EMBED_WORKERS,
+                 executor: Optional[Executor] = None, summaries=None):
+        self.loader = loader
+        self.embedding_engine = embedding_engine
+        self.vector_db = vector_db
+        # SummaryEngine: проиндексированные письма уходят в его фоновую очередь
+        self.summaries = summaries
+        self.loop = loop
+        self.queue_size = queue_size
+        self.embed_batch_size = embed_batch_size
+        self.parse_workers = parse_workers
+        self.embed_workers = embed_workers
+        self.executor = executor or ThreadPoolExecutor(max_workers=parse_workers + embed_workers + 1,
+                                                       thread_name_prefix="ingest")
+        self._listeners: List[Callable[[str, List[EmailRecord]], Awaitable[None]]] = []
+        self._tasks: List[asyncio.Task] = []
+        self._fetched: Optional[asyncio.Queue] = None
+        self._parsed: Optional[asyncio.Queue] = None
+        self._embedded: Optional[asyncio.Queue] = None
+        self._indexed: Optional[asyncio.Queue] = None
+        self._stopped = False
+
+    def add_listener(self, func: Callable[[str, List[EmailRecord]], Awaitable[None]]):
+        """Корутина, которую вызывают в event loop с user_id и новыми входящими проиндексированными письмами."""
+        self._listeners.append(func)
+
+    async def start(self):
+        self._fetched = asyncio.Queue(self.queue_size)
+        self._parsed = asyncio.Queue(self.queue_size)
+        self._embedded = asyncio.Queue(self.queue_size)
+        self._indexed = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._parse_stage()) for _ in range(self.parse_workers)]
+        self._tasks += [asyncio.create_task(self._embed_stage()) for _ in range(self.embed_workers)]
+        self._tasks.append(asyncio.create_task(self._index_stage()))
+        self._tasks.append(asyncio.create_task(self._notify_stage()))
+        metrics.gauge("pipeline_queue_depth", self.queue_depths, label="queue")
+
+    async def stop(self):
+        self._stopped = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._cancel_queued()
+
+    def _cancel_queued(self):
+        # Несохранённые пачки отменяются: поток опроса не ждёт их вечно и не сдвигает курсор
+        while self._fetched is not None and not self._fetched.empty():
+            self._fetched.get_nowait().stored.cancel()
+
+    def submit(self, user_id: str, messages: List[Dict], notify: bool = True) -> Future:
+        """
+        Передаёт скачанные сообщения Gmail из потока опроса; блокируется, пока в очереди нет места.
+        Возвращает Future, который завершается после сохранения писем (или с ошибкой разбора):
+        history-курсор можно сдвигать только после него, иначе упавшая пачка потеряется.
+        Эмбеддинги, индекс и уведомления догоняют уже после.
+        """
+        batch = _Batch(user_id, notify, messages=messages)
+        if not messages:
+            batch.stored.set_result(0)
+            return batch.stored
+        if self._stopped:
+            # Опрос, начатый до остановки: event loop мог уже закрыться
+            batch.stored.cancel()
+            return batch.stored
+        asyncio.run_coroutine_threadsafe(self._enqueue(batch), self.loop).result()
+        return batch.stored
+
+    async def _enqueue(self, batch: _Batch):
+        if not self._stopped:
+            await self._fetched.put(batch)
+        if self._stopped:
+            # Конвейер остановили до или во время ожидания места в очереди
+            batch.stored.cancel()
+            self._cancel_queued()
+
+    def queue_depths(self) -> Dict[str, int]:
+        queues = {"fetched": self._fetched, "parsed": self._parsed,
+                  "embedded": self._embedded, "indexed": self._indexed}
+        return {name: queue.qsize() if queue is not None else 0 for name, queue in queues.items()}
+
+    async def _run(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _parse_stage(self):
+        while True:
+            batch = await self._fetched.get()
+            try:
+                batch.emails = await self._run(self._parse_and_store, batch.user_id, batch.messages)
+                batch.messages = None
+            except asyncio.CancelledError:
+                batch.stored.cancel()
+                raise
+            except Exception as e:
+                print(f"Failed to parse emails for user {batch.user_id}: {e}")
+                batch.stored.set_exception(e)
+            else:
+                batch.stored.set_result(len(batch.emails))
+                await self._parsed.put(batch)
+            finally:
+                self._fetched.task_done()
+
+    def _parse_and_store(self, user_id: str, messages: List[Dict]) -> List[EmailRecord]:
+        emails = self.loader.parse_messages(messages, user_id)
+        self.loader.store_emails(emails)
+        return emails
+
+    async def _embed_stage(self):
+        while True:
+            batches = [await self._parsed.get()]
+            # Добираем всё, что уже лежит в очереди, чтобы считать эмбеддинги крупными пачками
+            size = len(batches[0].emails)
+            while size < self.embed_batch_size and not self._parsed.empty():
+                batches.append(self._parsed.get_nowait())
+                size += len(batches[-1].emails)
+            try:
+                emails = [email for batch in batches for email in batch.emails]
+                embeddings = await self._run(self.embedding_engine.embed_emails, emails)
+                offset = 0
+                for batch in batches:
+                    batch.embeddings = embeddings[offset:offset + len(batch.emails)]
+                    offset += len(batch.emails)
+                    await self._embedded.put(batch)
+            except Exception as e:
+                print(f"Failed to embed {size} emails: {e}")
+            finally:
+                for _ in batches:
+                    self._parsed.task_done()
+
+    async def _index_stage(self):
+        while True:
+            batch = await self._embedded.get()
+            try:
+                await self._run(self.vector_db.add_emails, batch.emails, batch.embeddings)
+                batch.embeddings = None
+                if self.summaries is not None:
+                    self.summaries.submit(batch.emails)
+                if batch.notify and self._listeners:
+                    batch.emails = [email for email in batch.emails if is_incoming(email)]
+                    if batch.emails:
+                        await self._indexed.put(batch)
+            except Exception as e:
+                print(f"Failed to index emails for user {batch.user_id}: {e}")
+            finally:
+                self._embedded.task_done()
+
+    async def _notify_stage(self):
+        while True:
+            batch = await self._indexed.get()
+            for listener in self._listeners:
+                try:
+                    await listener(batch.user_id, batch.emails)
+                except Exception as e:
+                    print(f"Failed to notify user {batch.user_id}: {e}")
+            self._indexed.task_done()
@@ -0,0 +1,40 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+
+# Крупная пачка режется на части, чтобы её считали все процессы пула, а не один
+EMBED_CHUNK_SIZE = 64
+
+# Бэкенд эмбеддингов дочернего процесса: передаётся один раз при запуске, а не с каждой задачей
+_embedding_backend = None
+
+
+def default_processes() -> int:
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def create_process_pool(processes: int, embedding_backend) -> ProcessPoolExecutor:
+    """
+    Пул процессов для разбора писем и эмбеддингов - CPU-работы, которую потоки не
+    распараллеливают из-за GIL. Процессы запускаются через spawn: форк процесса с
+    потоками и открытыми соединениями SQLite небезопасен.
+    """
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_process, initargs=(embedding_backend,))
+
+
+def _init_process(embedding_backend):
+    global _embedding_backend
+    _embedding_backend = embedding_backend
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    return _embedding_backend.embed(texts)
+
+
+def embed_in_pool(executor: ProcessPoolExecutor, texts: List[str], chunk_size: int = EMBED_CHUNK_SIZE) -> np.ndarray:
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    return np.concatenate(list(executor.map(embed_texts, chunks)))
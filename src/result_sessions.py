@@ -0,0 +1,144 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+from src.gmail.records import EmailRecord
+
+PAGE_SIZE = 5
+MAX_SESSIONS = 1000
+SESSION_TTL = 30 * 60
+
+# Ключ keyset-пагинации: (timestamp, номер письма) последней строки предыдущей страницы;
+# timestamp None у писем без даты
+PageKey = Tuple[Optional[int], int]
+
+
+class ResultCursor:
+    """
+    Курсор по выборке из хранилища: страница читается запросом LIMIT page_size + 1 после
+    ключа предыдущей страницы, поэтому листание стоит O(page_size) независимо от размера выборки.
+    Хранятся только ключи начала уже открытых страниц.
+    """
+
+    def __init__(self, fetch: Callable[[Optional[PageKey], int], List[EmailRecord]]):
+        self._fetch = fetch
+        self._page_keys: List[Optional[PageKey]] = [None]
+
+    def page(self, number: int, page_size: int) -> Tuple[int, List[EmailRecord], bool]:
+        """
+        Номер страницы, её письма и есть ли следующая. Номер за последней известной
+        страницей обрезается до неё: листают по одной странице.
+        """
+        number = max(0, min(number, len(self._page_keys) - 1))
+        emails = self._fetch(self._page_keys[number], page_size + 1)
+        has_next = len(emails) > page_size
+        emails = emails[:page_size]
+        if has_next and len(self._page_keys) == number + 1:
+            last = emails[-1]
+            self._page_keys.append((last.timestamp, last.number))
+        return number, emails, has_next
+
+
+class ListCursor:
+    """Курсор по готовому ограниченному списку, например top_k семантического поиска."""
+
+    def __init__(self, emails: List[EmailRecord]):
+        self._emails = emails
+
+    def page(self, number: int, page_size: int) -> Tuple[int, List[EmailRecord], bool]:
+        number = max(0, min(number, (len(self._emails) - 1) // page_size if self._emails else 0))
+        start = number * page_size
+        return number, self._emails[start:start + page_size], start + page_size < len(self._emails)
+
+
+class ResultSession:
+    __slots__ = ("id", "user_id", "cursor", "page_size", "page", "emails", "has_next", "touched_at")
+
+    def __init__(self, session_id: str, user_id: str, cursor, page_size: int):
+        self.id = session_id
+        self.user_id = user_id
+        self.cursor = cursor
+        self.page_size = page_size
+        self.page = -1
+        # В памяти только текущая страница
+        self.emails: List[EmailRecord] = []
+        self.has_next = False
+        self.touched_at = time.monotonic()
+
+    def show(self, page: int) -> List[EmailRecord]:
+        if page != self.page:
+            self.page, self.emails, self.has_next = self.cursor.page(page, self.page_size)
+        return self.emails
+
+    @property
+    def offset(self) -> int:
+        return self.page * self.page_size
+
+
+class ResultSessions:
+    """
+    Сессии результатов поиска бота: одна активная на пользователя, LRU на max_sessions
+    пользователей и TTL с последнего обращения. Кнопки ссылаются на сессию по короткому id,
+    так что кнопка от старого поиска не листает новый.
+    """
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS, ttl: float = SESSION_TTL, page_size: int = PAGE_SIZE):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.page_size = page_size
+        self._sessions: "OrderedDict[str, ResultSession]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def open(self, user_id, cursor) -> ResultSession:
+        user_id = str(user_id)
+        session = ResultSession(self._next_id(), user_id, cursor, self.page_size)
+        session.show(0)
+        with self._lock:
+            self._sessions[user_id] = session
+            self._sessions.move_to_end(user_id)
+            self._evict(time.monotonic())
+        return session
+
+    def get(self, user_id, session_id: str) -> Optional[ResultSession]:
+        user_id = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None or session.id != session_id:
+                return None
+            if now - session.touched_at > self.ttl:
+                del self._sessions[user_id]
+                return None
+            session.touched_at = now
+            self._sessions.move_to_end(user_id)
+            return session
+
+    def close(self, user_id):
+        with self._lock:
+            self._sessions.pop(str(user_id), None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _next_id(self) -> str:
+        value = next(self._ids) % (36 ** 6)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+        encoded = ""
+        while True:
+            value, remainder = divmod(value, 36)
+            encoded = digits[remainder] + encoded
+            if value == 0:
+                return encoded
+
+    def _evict(self, now: float):
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        # Сессии упорядочены по последнему обращению, поэтому просроченные - в начале
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.touched_at <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
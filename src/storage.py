@@ -0,0 +1,116 @@
+import glob
+import os
+import re
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+from src.utils import DB_PATH, SCHEMA_DIR
+
+BUSY_TIMEOUT_MS = 5000
+# sqlite3 кэширует скомпилированные запросы на уровне соединения
+STATEMENT_CACHE_SIZE = 256
+
+
+class _ThreadConnection:
+    """
+    Соединение, которым владеет один поток через threading.local. Когда поток завершается,
+    его данные в threading.local освобождаются и соединение закрывается в том же потоке -
+    иначе короткие потоки (по одному на запрос у ThreadingHTTPServer) оставляли бы открытые файлы.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def close(self):
+        try:
+            self.conn.close()
+        except sqlite3.ProgrammingError:
+            # Соединение принадлежит другому потоку, оно закроется вместе с ним
+            pass
+
+    def __del__(self):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Общий слой доступа к SQLite: по одному соединению на поток, пока поток жив,
+    WAL (читатели не ждут писателя) и общий busy timeout вместо "database is locked".
+    При первом подключении применяет схемы из schema_dir (sqlite/*.sql).
+    """
+
+    def __init__(self, db_path: str = DB_PATH, schema_dir: str = SCHEMA_DIR):
+        self.db_path = db_path
+        self.schema_dir = schema_dir
+        self._local = threading.local()
+        # Слабые ссылки: пул не удерживает соединения завершившихся потоков
+        self._connections: "weakref.WeakSet[_ThreadConnection]" = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._schema_applied = False
+
+    def connection(self) -> sqlite3.Connection:
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            owner = self._local.owner = _ThreadConnection(self._connect())
+            with self._lock:
+                self._connections.add(owner)
+        return owner.conn
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        with self._lock:
+            if not self._schema_applied:
+                self._apply_schema(conn)
+                self._schema_applied = True
+        return conn
+
+    def _apply_schema(self, conn: sqlite3.Connection):
+        """Применяет схемы по порядку номеров: 1.sql, 2.sql, ..."""
+        files = glob.glob(os.path.join(self.schema_dir, "*.sql"))
+        files.sort(key=lambda path: [int(part) if part.isdigit() else part
+                                     for part in re.split(r"(\d+)", os.path.basename(path))])
+        for path in files:
+            with open(path, encoding="utf-8") as f:
+                conn.executescript(f.read())
+        conn.commit()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self.connection()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def execute(self, sql: str, params: Sequence = ()) -> int:
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql: str, rows: Iterable[Sequence]) -> int:
+        with self.transaction() as conn:
+            return conn.executemany(sql, rows).rowcount
+
+    def query_one(self, sql: str, params: Sequence = ()) -> Optional[tuple]:
+        return self.connection().execute(sql, params).fetchone()
+
+    def query_all(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        return self.connection().execute(sql, params).fetchall()
+
+    def close_all(self):
+        with self._lock:
+            owners, self._connections = list(self._connections), weakref.WeakSet()
+        for owner in owners:
+            owner.close()
+
+
+db = ConnectionPool()
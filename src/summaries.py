@@ -0,0 +1,232 @@
+import hashlib
+import heapq
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from src.gmail.rate_limit import BACKFILL, INTERACTIVE
+from src.gmail.records import EmailRecord
+from src.metrics import metrics
+from src.storage import db
+
+SUMMARY_SENTENCES = 3
+MAX_SUMMARY_LENGTH = 700
+MAX_TEXT_LENGTH = 20000
+SUMMARY_BATCH_SIZE = 16
+QUEUE_SIZE = 1000
+# Заранее суммаризируем только свежие письма: старые открывают редко, а тело пришлось бы скачивать
+PRECOMPUTE_MAX_AGE = 3 * 24 * 60 * 60
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_SPACES_RE = re.compile(r"[ \t\r\f\v]+")
+
+Key = Tuple[str, str]
+
+
+def summary_text(body: Optional[str]) -> str:
+    return _SPACES_RE.sub(" ", body or "").strip()[:MAX_TEXT_LENGTH]
+
+
+class ExtractiveSummaryBackend:
+    """
+    Извлекающая суммаризация на CPU без модели: предложения оцениваются по частоте
+    значимых слов письма, в сводку попадают лучшие в исходном порядке.
+    """
+
+    def __init__(self, sentences: int = SUMMARY_SENTENCES):
+        self.sentences = sentences
+        self.name = f"extractive-v1-{sentences}"
+
+    def summarize(self, texts: List[str]) -> List[str]:
+        return [self._summarize(text) for text in texts]
+
+    def _summarize(self, text: str) -> str:
+        sentences = [sentence.strip() for sentence in _SENTENCE_RE.split(text) if len(sentence.strip()) > 1]
+        if len(sentences) > self.sentences:
+            words = [[word for word in _TOKEN_RE.findall(sentence.lower()) if len(word) > 3]
+                     for sentence in sentences]
+            frequencies = Counter(word for sentence_words in words for word in sentence_words)
+            # Делим на корень длины, чтобы длинные предложения не выигрывали только за счёт объёма
+            scores = [sum(frequencies[word] for word in sentence_words) / max(len(sentence_words), 1) ** 0.5
+                      for sentence_words in words]
+            best = sorted(heapq.nlargest(self.sentences, range(len(sentences)), key=scores.__getitem__))
+            sentences = [sentences[i] for i in best]
+        summary = " ".join(sentences)
+        if len(summary) > MAX_SUMMARY_LENGTH:
+            summary = summary[:MAX_SUMMARY_LENGTH].rsplit(" ", 1)[0] + "…"
+        return summary
+
+
+class TransformersSummaryBackend:
+    """Локальная seq2seq-модель transformers на CPU (опциональная зависимость)."""
+
+    def __init__(self, model_name: str = "csebuetnlp/mT5_multilingual_XLSum", batch_size: int = 4,
+                 max_length: int = 120):
+        try:
+            from transformers import pipeline
+        except ImportError as e:
+            raise ImportError("Для TransformersSummaryBackend установите transformers") from e
+        self.pipeline = pipeline("summarization", model=model_name, device=-1)
+        self.name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def summarize(self, texts: List[str]) -> List[str]:
+        results = self.pipeline(texts, batch_size=self.batch_size, max_length=self.max_length, truncation=True)
+        return [result["summary_text"] for result in results]
+
+
+class SummaryEngine:
+    """
+    Суммаризация писем с кэшем в summary_cache по (письмо, хэш текста, модель): повторное
+    открытие отвечает из кэша, одновременные запросы одного письма ждут одно вычисление.
+    С precompute новые письма ещё и считаются заранее в фоне пачками - ценой второго
+    messages.get на каждое новое письмо, ведь тело при синхронизации не скачивается.
+    """
+
+    def __init__(self, loader, backend=None, batch_size: int = SUMMARY_BATCH_SIZE, queue_size: int = QUEUE_SIZE,
+                 max_age: int = PRECOMPUTE_MAX_AGE, precompute: bool = False):
+        self.loader = loader
+        self.backend = backend if backend is not None else ExtractiveSummaryBackend()
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.precompute = precompute
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._inflight: Dict[Key, Future] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.precompute:
+            return
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # Поток увидит _stopped после текущей пачки
+            pass
+
+    def submit(self, emails: List[EmailRecord]):
+        """Ставит свежие письма в фоновую очередь; при переполнении письмо посчитается при открытии."""
+        if not self.precompute or self._stopped.is_set():
+            return
+        oldest = time.time() - self.max_age
+        for email in emails:
+            if email.timestamp is None or email.timestamp < oldest:
+                continue
+            try:
+                self._queue.put_nowait((email.user_id, email.id))
+            except queue.Full:
+                metrics.inc("summaries_dropped_total")
+
+    def get_summary(self, user_id: str, message_id: str) -> Optional[str]:
+        key = (str(user_id), message_id)
+        return self._summarize([key], INTERACTIVE).get(key)
+
+    def _worker(self):
+        while not self._stopped.is_set():
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                self._summarize(batch, BACKFILL)
+            except Exception as e:
+                print(f"Failed to summarize {len(batch)} emails: {e}")
+
+    def _summarize(self, keys: List[Key], priority: int) -> Dict[Key, Optional[str]]:
+        owned, waiting = [], {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                future = self._inflight.get(key)
+                if future is None:
+                    self._inflight[key] = Future()
+                    owned.append(key)
+                else:
+                    waiting[key] = future
+        results = {}
+        if owned:
+            try:
+                results = self._compute(owned, priority)
+            except BaseException as e:
+                with self._lock:
+                    for key in owned:
+                        self._inflight.pop(key).set_exception(e)
+                raise
+            with self._lock:
+                for key in owned:
+                    self._inflight.pop(key).set_result(results.get(key))
+        for key, future in waiting.items():
+            results[key] = future.result()
+        return results
+
+    def _compute(self, keys: List[Key], priority: int) -> Dict[Key, str]:
+        by_user: Dict[str, List[str]] = {}
+        for user_id, message_id in keys:
+            by_user.setdefault(user_id, []).append(message_id)
+        texts = {}
+        for user_id, message_ids in by_user.items():
+            # Удалённые письма get_many не возвращает
+            emails = self.loader.store.get_many(user_id, message_ids)
+            try:
+                bodies = self.loader.get_email_bodies(user_id, emails, priority)
+            except Exception as e:
+                # Без тел суммаризируем по сниппетам, а не роняем всю пачку
+                print(f"Failed to load email bodies for user {user_id}: {e}")
+                bodies = {}
+            for email in emails:
+                texts[(user_id, email.id)] = summary_text(bodies.get(email.id) or email.snippet)
+        hashes = {key: hashlib.sha256(text.encode("utf-8")).hexdigest() for key, text in texts.items()}
+        summaries = self._load_cached(hashes)
+        missing = [key for key in texts if key not in summaries]
+        if missing:
+            with metrics.timer("summary_batch_seconds", backend=self.backend.name):
+                computed = dict(zip(missing, self.backend.summarize([texts[key] for key in missing])))
+            metrics.inc("summaries_computed_total", len(computed))
+            self._save_cached(computed, hashes)
+            summaries.update(computed)
+        return summaries
+
+    def _load_cached(self, hashes: Dict[Key, str]) -> Dict[Key, str]:
+        by_user: Dict[str, List[str]] = {}
+        for user_id, message_id in hashes:
+            by_user.setdefault(user_id, []).append(message_id)
+        cached = {}
+        for user_id, message_ids in by_user.items():
+            placeholders = ",".join("?" * len(message_ids))
+            rows = db.query_all(f"""
+                SELECT message_id, content_hash, summary FROM summary_cache
+                WHERE user_id = ? AND model = ? AND message_id IN ({placeholders})
+            """, (user_id, self.backend.name, *message_ids))
+            for message_id, content_hash, summary in rows:
+                if hashes[(user_id, message_id)] == content_hash:
+                    cached[(user_id, message_id)] = summary
+        metrics.inc("summary_cache_hits_total", len(cached))
+        return cached
+
+    def _save_cached(self, summaries: Dict[Key, str], hashes: Dict[Key, str]):
+        now = int(time.time())
+        db.executemany("""
+            INSERT OR REPLACE INTO summary_cache (user_id, message_id, content_hash, model, summary, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(user_id, message_id, hashes[(user_id, message_id)], self.backend.name, summary, now)
+              for (user_id, message_id), summary in summaries.items()])
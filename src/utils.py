@@ -1 +1,9 @@
-DB_PATH = "sqlite/tg_gmail_bot.db"
+import os
+
+# Пути можно переопределить окружением, например чтобы бенчмарк работал на временной базе
+DB_PATH = os.getenv("GMAIL_BOT_DB_PATH", "sqlite/tg_gmail_bot.db")
+CHROMA_PATH = os.getenv("GMAIL_BOT_CHROMA_PATH", "chroma_db")
+# host:port сервера Chroma; нужен, когда индекс пишут несколько процессов синхронизации
+CHROMA_HOST = os.getenv("GMAIL_BOT_CHROMA_HOST")
+ATTACHMENT_DIR = os.getenv("GMAIL_BOT_ATTACHMENT_DIR", "attachment_cache")
+SCHEMA_DIR = "sqlite"
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Пути к базе и схемам модули читают при импорте: тесты работают на временной базе из корня репозитория
+os.environ["GMAIL_BOT_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="gmail-bot-tests-"), "test.db")
+os.environ["GMAIL_BOT_ATTACHMENT_DIR"] = os.path.join(os.path.dirname(os.environ["GMAIL_BOT_DB_PATH"]),
+                                                      "attachments")
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+from src.storage import db  # noqa: E402
+
+TABLES = ("emails", "auth_tokens", "sync_state", "sync_workers", "user_leases", "attachments", "attachment_blobs",
+          "summary_cache", "sender_stats", "gmail_watches")
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    yield
+    with db.transaction() as conn:
+        for table in TABLES:
+            conn.execute(f"DELETE FROM {table}")
+
+
+@pytest.fixture
+def fake_gmail(tmp_path):
+    """EmailLoader на локальной замене Gmail API с одним ящиком пользователя "1"."""
+    from src.attachments import AttachmentCache
+    from src.gmail.emails_loading import EmailLoader
+    from src.gmail.fake_api import FakeAuth, FakeClientCache, FakeGmailApi, FakeMailbox
+
+    api = FakeGmailApi(latency=0, jitter=0)
+    api.add_mailbox("1", FakeMailbox("user1@example.com", size=20, seed=1))
+    db.execute("INSERT INTO auth_tokens (user_id, token) VALUES ('1', '{}')")
+    loader = EmailLoader()
+    loader.auth_service = FakeAuth(api)
+    loader.clients = FakeClientCache(api)
+    loader.attachment_cache = AttachmentCache(str(tmp_path / "attachments"))
+    return loader, api
@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import os
+
+import src.attachments
+from src.attachments import AttachmentCache
+from src.storage import db
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def test_put_dedupes_identical_content(tmp_path):
+    cache = AttachmentCache(str(tmp_path))
+    data = os.urandom(5000)
+    first = cache.put_base64(b64(data))
+    second = cache.put_base64(b64(data))
+    assert first == second == (hashlib.sha256(data).hexdigest(), len(data))
+    with open(cache.path(first[0]), "rb") as f:
+        assert f.read() == data
+    assert cache.size() == len(data)
+    # Временные .part-файлы не остаются
+    assert [name for _, _, files in os.walk(tmp_path) for name in files] == [first[0]]
+
+
+def test_put_decodes_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.attachments, "DECODE_CHUNK_SIZE", 8)
+    cache = AttachmentCache(str(tmp_path))
+    data = bytes(range(256)) * 3 + b"tail"
+    content_hash, size = cache.put_base64(b64(data))
+    with open(cache.path(content_hash), "rb") as f:
+        assert f.read() == data
+    assert size == len(data)
+
+
+def test_evicts_least_recently_opened(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=2500)
+    a, _ = cache.put_base64(b64(b"a" * 1000))
+    b, _ = cache.put_base64(b64(b"b" * 1000))
+    # a открыли позже b, поэтому вытесняется b
+    db.execute("UPDATE attachment_blobs SET last_used = last_used - 1000 WHERE content_hash = ?", (b,))
+    assert cache.open(a) is not None
+    c, _ = cache.put_base64(b64(b"c" * 1000))
+    assert cache.open(b) is None
+    assert cache.open(a) is not None and cache.open(c) is not None
+    assert cache.size() == 2000
+
+
+def test_new_file_is_kept_even_if_larger_than_cache(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=100)
+    small, _ = cache.put_base64(b64(b"s" * 50))
+    large, _ = cache.put_base64(b64(b"l" * 500))
+    assert cache.open(large) is not None
+    assert cache.open(small) is None
+
+
+def test_open_forgets_files_removed_from_disk(tmp_path):
+    cache = AttachmentCache(str(tmp_path))
+    content_hash, _ = cache.put_base64(b64(b"data"))
+    os.remove(cache.path(content_hash))
+    assert cache.open(content_hash) is None
+    assert cache.size() == 0
+
+
+def test_loader_downloads_each_file_once(fake_gmail):
+    loader, api = fake_gmail
+    mailbox = api.mailboxes["1"]
+    mailbox.mime_mix = {"attachment": 1.0}
+    mailbox.deliver(8)
+    loader.init_emails(30, 30)
+    rows = db.query_all("SELECT message_id, part_id, filename FROM attachments WHERE user_id = '1'")
+    assert len(rows) >= 8
+    api.reset_calls()
+    paths = {}
+    for message_id, part_id, filename in rows:
+        path = loader.get_attachment("1", message_id, part_id)
+        with open(path, "rb") as f:
+            assert f.read() == mailbox.attachment_data(filename, os.path.getsize(path))
+        paths.setdefault(filename, set()).add(path)
+    # Одинаковые файлы из разных писем лежат в кэше одним файлом, но скачиваются по разу на письмо
+    assert all(len(files) == 1 for files in paths.values())
+    assert api.calls["messages.attachments.get"] == len(rows)
+    api.reset_calls()
+    for message_id, part_id, _ in rows:
+        loader.get_attachment("1", message_id, part_id)
+    assert api_requests(api) == 0
+
+
+def api_requests(api):
+    return sum(n for method, n in api.calls.items() if method not in ("http", "errors"))
@@ -0,0 +1,79 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from google.auth.exceptions import RefreshError
+from google.oauth2.credentials import Credentials
+
+import src.gmail.auth
+from src.gmail.auth import GmailAuth
+from src.storage import db
+
+TOKEN = {"token": "access", "refresh_token": "refresh", "client_id": "id", "client_secret": "secret",
+         "token_uri": "https://oauth2.googleapis.com/token"}
+
+
+@pytest.fixture
+def auth(monkeypatch):
+    auth = GmailAuth()
+    # Фоновый рефрешер не запускаем: тесты вызывают его шаги сами
+    monkeypatch.setattr(auth, "_ensure_refresher", lambda: None)
+    monkeypatch.setattr(auth, "_on_removed", None)
+    yield auth
+    auth._creds_cache.clear()
+    auth._revoked.clear()
+    auth._dirty_tokens.clear()
+
+
+def save_token(user_id, token=TOKEN, expiry=None):
+    token = dict(token, expiry=expiry.isoformat() + "Z") if expiry is not None else token
+    db.execute("INSERT OR REPLACE INTO auth_tokens (user_id, token) VALUES (?, ?)", (user_id, json.dumps(token)))
+
+
+def test_missing_user_is_cached_for_negative_ttl(auth, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(src.gmail.auth.time, "time", lambda: now[0])
+    assert auth.get_cached_creds("1") is None
+    save_token("1")
+    # Токен появился в БД, но отрицательная запись ещё действует
+    assert auth.get_cached_creds("1") is None
+    now[0] += src.gmail.auth.NEGATIVE_TTL + 1
+    assert auth.get_cached_creds("1").refresh_token == "refresh"
+
+
+def test_cached_creds_are_not_reread_from_db(auth, monkeypatch):
+    save_token("1", expiry=datetime.utcnow() + timedelta(hours=1))
+    creds = auth.get_cached_creds("1")
+    monkeypatch.setattr(auth, "_load_token_from_db", lambda user_id: pytest.fail("token reread from db"))
+    assert auth.get_cached_creds("1") is creds
+
+
+def test_revoked_token_stays_revoked_until_reauthorization(auth, monkeypatch):
+    save_token("1", expiry=datetime.utcnow() - timedelta(minutes=1))
+
+    def refresh(self, request):
+        raise RefreshError("invalid_grant: Token has been expired or revoked.")
+    monkeypatch.setattr(Credentials, "refresh", refresh)
+    assert auth.load_creds("1") is None
+    # Отрицательная запись истекла, но в БД всё тот же отозванный токен
+    auth._creds_cache.clear()
+    assert auth.get_cached_creds("1") is None
+    # Новый токен в БД (например, после авторизации в другом процессе) снова действует
+    save_token("1", dict(TOKEN, refresh_token="new"))
+    auth._creds_cache.clear()
+    assert auth.get_cached_creds("1").refresh_token == "new"
+
+
+def test_removed_users_are_forgotten_and_reported(auth):
+    removed = []
+    auth.on_removed(removed.append)
+    save_token("1")
+    save_token("2")
+    auth.get_cached_creds("1")
+    auth.get_cached_creds("2")
+    auth._revoked["2"] = TOKEN
+    db.execute("DELETE FROM auth_tokens WHERE user_id = '2'")
+    auth._drop_removed_users()
+    assert set(auth._creds_cache) == {"1"}
+    assert auth._revoked == {}
+    assert removed == [["2"]]
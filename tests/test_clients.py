@@ -0,0 +1,51 @@
+from google.oauth2.credentials import Credentials
+
+from src.gmail.auth import GmailAuth
+from src.gmail.clients import GmailClientCache
+from src.gmail.leases import LeaseManager
+from src.storage import db
+
+
+def make_creds():
+    return Credentials(token="token", refresh_token="refresh", client_id="id", client_secret="secret",
+                       token_uri="https://oauth2.googleapis.com/token")
+
+
+def test_client_is_reused_until_credentials_change():
+    clients = GmailClientCache()
+    creds = make_creds()
+    with clients.client("1", creds) as first, clients.client("1", creds) as second:
+        assert first is second
+    with clients.client("1", make_creds()) as renewed:
+        assert renewed is not first
+    clients.invalidate("1")
+    with clients.client("1", creds) as rebuilt:
+        assert rebuilt is not first
+
+
+def cached_services(loader):
+    return set(loader.clients._services)
+
+
+def test_loader_forgets_clients_of_removed_users(fake_gmail):
+    loader, _ = fake_gmail
+    auth = GmailAuth()
+    with loader.clients.client("1", None):
+        pass
+    auth._cache_creds("1", make_creds())
+    db.execute("DELETE FROM auth_tokens WHERE user_id = '1'")
+    auth._drop_removed_users()
+    assert cached_services(loader) == set()
+
+
+def test_loader_forgets_clients_of_released_users(fake_gmail):
+    loader, _ = fake_gmail
+    leases = LeaseManager(worker_id="a")
+    loader.use_leases(leases)
+    leases.heartbeat()
+    with loader.clients.client("1", None):
+        pass
+    loader.limiter.acquire("1", 1)
+    leases.stop()
+    assert cached_services(loader) == set()
+    assert "1" not in loader.limiter._users
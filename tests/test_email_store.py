@@ -0,0 +1,111 @@
+from src.gmail.email_store import SENDER_ADDRESS, SENDER_DOMAIN, SENDER_PREFIX, EmailStore, text_query
+from src.gmail.records import EmailRecord
+from src.storage import db
+
+
+def make_email(message_id, user_id="1", sender="Alice <alice@example.com>", subject="Hello", timestamp=None,
+               snippet=""):
+    return EmailRecord(id=message_id, user_id=user_id, subject=subject, sender=sender, recipient="me@example.com",
+                       timestamp=timestamp, snippet=snippet, labels=["INBOX"])
+
+
+def ids(emails):
+    return [email.id for email in emails]
+
+
+def test_text_query_quotes_tokens_and_uses_prefixes():
+    assert text_query("report") == '("report"*)'
+    # Короткие слова ищутся целиком, иначе префикс выбрал бы полящика
+    assert text_query("q1 report") == '("q1") AND ("report"*)'
+    assert text_query('"quarterly report"') == '("quarterly report")'
+    assert text_query("") is None
+    assert text_query("!!!") is None
+    # Операторы FTS5 из ввода - просто слова
+    assert text_query("NOT report*") == '("NOT"*) AND ("report"*)'
+
+
+def test_text_query_column_filters():
+    assert text_query("subject:invoice") == 'subject : ("invoice"*)'
+    assert text_query("from:alice report") == 'sender : ("alice"*) AND ("report"*)'
+    assert text_query("тема:отчёт") == 'subject : ("отчёт"*)'
+    # Неизвестный "столбец" - обычный текст, а не синтаксис FTS5
+    assert text_query("10:30") == '("10" AND "30")'
+
+
+def test_search_text_ranks_and_filters_by_owner():
+    store = EmailStore()
+    store.save_many([
+        make_email("a", subject="Quarterly report", snippet="numbers inside"),
+        make_email("b", subject="Lunch", snippet="see the report attached"),
+        make_email("c", user_id="2", subject="Quarterly report"),
+        make_email("d", user_id="11", subject="Quarterly report"),
+    ])
+    # Совпадение в теме весит больше, чем в тексте
+    assert ids(store.search_text("1", "repo")) == ["a", "b"]
+    assert ids(store.search_text("1", "subject:report")) == ["a"]
+    assert ids(store.search_text("1", "отчёт")) == []
+    # Префикс владельца не путает пользователей 1 и 11
+    assert sorted(ids(store.search_text(None, "quarterly"))) == ["a", "c", "d"]
+
+
+def test_search_text_follows_updates_and_deletes():
+    store = EmailStore()
+    store.save_many([make_email("a", subject="Draft", snippet="short preview")])
+    assert ids(store.search_text("1", "preview")) == ["a"]
+    # Скачанное тело заменяет сниппет в индексе
+    store.save_body("1", "a", "full text about the migration plan")
+    assert ids(store.search_text("1", "migration")) == ["a"]
+    assert ids(store.search_text("1", "preview")) == []
+    store.save_many([make_email("a", subject="Final")])
+    assert ids(store.search_text("1", "subject:final")) == ["a"]
+    assert ids(store.search_text("1", "subject:draft")) == []
+    store.mark_deleted("1", ["a"])
+    assert store.search_text("1", "migration") == []
+
+
+def test_email_numbers_survive_resave_and_vacuum():
+    store = EmailStore()
+    store.save_many([make_email(f"m{i}", subject=f"Subject {i}") for i in range(5)])
+    numbers = {email.id: email.number for email in store.find(user_id="1")}
+    store.mark_deleted("1", ["m1", "m3"])
+    store.save_many([make_email("m4", subject="Subject 4 updated")])
+    db.connection().execute("VACUUM")
+    assert {email.id: email.number for email in store.find(user_id="1")} == \
+        {key: value for key, value in numbers.items() if key not in ("m1", "m3")}
+    assert store.get_by_number(numbers["m4"]).subject == "Subject 4 updated"
+    assert store.get_by_number(numbers["m1"]) is None
+    assert ids(store.search_text("1", "updated")) == ["m4"]
+
+
+def test_sender_filter_kinds():
+    EmailStore().save_many([make_email("a", sender="bob@example.com")])
+    assert EmailStore.sender_filter(" Alice@Example.com ") == (SENDER_ADDRESS, "alice@example.com")
+    assert EmailStore.sender_filter("@example.com") == (SENDER_DOMAIN, "example.com")
+    # Без "@" значение с точкой - домен, только если письма с него есть в ящике
+    assert EmailStore.sender_filter("example.com", "1") == (SENDER_DOMAIN, "example.com")
+    assert EmailStore.sender_filter("example.com", "2") == (SENDER_PREFIX, "example.com")
+    assert EmailStore.sender_filter("john.smith", "1") == (SENDER_PREFIX, "john.smith")
+    assert EmailStore.sender_filter("alice") == (SENDER_PREFIX, "alice")
+
+
+def test_find_by_sender_address_domain_or_name():
+    store = EmailStore()
+    store.save_many([
+        make_email("a", sender="Alice <alice@example.com>", timestamp=1),
+        make_email("b", sender="alice.smith@work.org", timestamp=2),
+        make_email("c", sender="bob@example.com", timestamp=3),
+        make_email("d", sender="John Smith <js@corp.example.io>", timestamp=4),
+        make_email("e", sender="john.smith@mail.example.org", timestamp=5),
+        make_email("f", user_id="2", sender="john.smith@mail.example.org", timestamp=6),
+    ])
+    assert ids(store.find(user_id="1", sender="alice")) == ["b", "a"]
+    assert ids(store.find(user_id="1", sender="example.com")) == ["c", "a"]
+    assert ids(store.find(user_id="1", sender="@example.com")) == ["c", "a"]
+    # Адрес john.smith@... и имя "John Smith"
+    assert ids(store.find(user_id="1", sender="john.smith")) == ["e", "d"]
+    assert ids(store.find(user_id="1", sender="John")) == ["e", "d"]
+    assert ids(store.find(user_id="1", sender="js@corp.example.io")) == ["d"]
+    assert sorted(store.sender_addresses("1", "alice")) == ["alice.smith@work.org", "alice@example.com"]
+    assert sorted(store.sender_addresses("1", "john.smith")) == ["john.smith@mail.example.org",
+                                                                 "js@corp.example.io"]
+    assert sorted(ids(store.find(user_id=None, sender="john.smith"))) == ["d", "e", "f"]
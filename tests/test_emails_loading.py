@@ -0,0 +1,90 @@
+from datetime import datetime, timezone
+
+import pytest
+
+for module in ("bs4", "dateutil", "google.oauth2", "googleapiclient"):
+    pytest.importorskip(module)
+
+from src.gmail.emails_loading import (INGEST_FIELDS, MAX_PART_DEPTH, is_truncated, iter_parts,  # noqa: E402
+                                      parse_email, parse_email_date)
+from src.gmail.fake_api import _b64  # noqa: E402
+
+EPOCH = int(datetime(2024, 3, 5, 14, 30, tzinfo=timezone.utc).timestamp())
+
+
+@pytest.mark.parametrize("header", [
+    "Tue, 05 Mar 2024 14:30:00 +0000",
+    "Tue, 05 Mar 2024 14:30:00 +0000 (UTC)",
+    "Tue, 05 Mar 2024 16:30:00 +0200 (Восточная Европа)",
+    "Tue, 05 Mar 2024 09:30:00 EST",
+    "Tue, 05 Mar 2024 14:30:00 GMT",
+    "5 Mar 2024 14:30:00 UT",
+    # Без зоны и с неизвестной устаревшей зоной - UTC по RFC 2822
+    "Tue, 05 Mar 2024 14:30:00",
+    "Tue, 05 Mar 2024 14:30:00 XYZ",
+    "2024-03-05T14:30:00Z",
+])
+def test_parse_email_date_variants(header):
+    assert parse_email_date(header) == EPOCH
+
+
+@pytest.mark.parametrize("header", [None, "", "not a date"])
+def test_parse_email_date_invalid(header):
+    assert parse_email_date(header) is None
+
+
+def test_parse_email_falls_back_to_internal_date():
+    msg = {
+        "id": "m1",
+        "snippet": "hi",
+        "internalDate": str(EPOCH * 1000),
+        "payload": {"headers": [{"name": "Date", "value": "garbage"}, {"name": "Subject", "value": "Hello"}]},
+    }
+    email = parse_email(msg, "1")
+    assert (email.subject, email.date, email.timestamp) == ("Hello", "garbage", EPOCH)
+
+
+def text_part(part_id, mime_type, text):
+    return {"partId": part_id, "mimeType": mime_type, "body": {"data": _b64(text.encode())}}
+
+
+def nested(depth, leaf):
+    """Цепочка из depth multipart-частей, на дне которой leaf."""
+    part = leaf
+    for level in range(depth):
+        part = {"partId": "", "mimeType": "multipart/mixed", "body": {"size": 0}, "parts": [part]}
+    return part
+
+
+def test_iter_parts_walks_breadth_first():
+    payload = {"partId": "", "mimeType": "multipart/mixed", "parts": [
+        {"partId": "0", "mimeType": "multipart/alternative", "parts": [{"partId": "0.0"}, {"partId": "0.1"}]},
+        {"partId": "1"},
+    ]}
+    assert [part["partId"] for part in iter_parts(payload)] == ["", "0", "1", "0.0", "0.1"]
+
+
+def test_email_body_prefers_plain_text_at_any_depth(fake_gmail):
+    loader, _ = fake_gmail
+    html = text_part("0", "text/html", "<p>Rich <b>text</b></p>")
+    assert loader._get_email_body(nested(2, html)) == "Rich\ntext"
+    payload = {"mimeType": "multipart/mixed", "parts": [html, nested(3, text_part("1", "text/plain", "Plain"))]}
+    assert loader._get_email_body(payload) == "Plain"
+
+
+def test_ingest_refetches_messages_deeper_than_the_mask(fake_gmail):
+    loader, api = fake_gmail
+    mailbox = api.mailboxes["1"]
+    shallow, deep = mailbox.order[:2]
+    attachment = {"partId": "deep", "mimeType": "application/pdf", "filename": "deep.pdf",
+                  "body": {"attachmentId": "att-deep", "size": 10}}
+    mailbox.messages[deep]["payload"] = dict(nested(MAX_PART_DEPTH + 1, attachment),
+                                             headers=mailbox.messages[deep]["payload"]["headers"])
+    assert INGEST_FIELDS.count("parts(") == MAX_PART_DEPTH
+    with loader.clients.client("1", None) as service:
+        messages = loader._get_messages_batched(service, "1", [shallow, deep])
+    assert [msg["id"] for msg in messages] == [shallow, deep]
+    assert not any(is_truncated(msg) for msg in messages)
+    # Неглубокое письмо пришло по маске без данных частей, глубокое перечитано целиком
+    assert all("data" not in part.get("body", {}) for part in iter_parts(messages[0]["payload"]))
+    assert [a.filename for a in parse_email(messages[1], "1").attachments] == ["deep.pdf"]
@@ -0,0 +1,92 @@
+from src.gmail.fake_api import FakeMailbox, _http_error
+from src.storage import db
+
+
+def sync(loader):
+    return loader.sync_user("1", object())
+
+
+def stored_ids(loader):
+    return {email.id for email in loader.store.find(user_id="1")}
+
+
+def cursor(loader):
+    return loader._load_history_id("1")
+
+
+def test_first_sync_loads_recent_mail_and_sets_cursor(fake_gmail):
+    loader, api = fake_gmail
+    mailbox = api.mailboxes["1"]
+    assert sync(loader) == 20
+    assert stored_ids(loader) == set(mailbox.order)
+    assert cursor(loader) == str(mailbox.history_id)
+
+
+def test_history_sync_applies_added_deleted_and_label_changes(fake_gmail):
+    loader, api = fake_gmail
+    mailbox = api.mailboxes["1"]
+    sync(loader)
+    new_ids = mailbox.deliver(2)
+    deleted = mailbox.order[-1]
+    mailbox.delete([deleted])
+    starred = mailbox.order[5]
+    mailbox.relabel(starred, added=["STARRED"], removed=["INBOX"])
+    deleted_events, label_events = [], []
+    loader.add_deleted_emails_callback(lambda user_id, ids: deleted_events.append(ids))
+    loader._labels_changed_callback = lambda *change: label_events.append(change)
+    api.reset_calls()
+
+    assert sync(loader) == 5
+    assert api.calls["history.list"] == 1
+    assert api.calls["messages.get"] == 2
+    assert stored_ids(loader) == set(mailbox.order)
+    assert deleted_events == [[deleted]]
+    assert label_events == [("1", starred, ["STARRED"], []), ("1", starred, [], ["INBOX"])]
+    assert "STARRED" in loader.store.get("1", starred).labels
+    assert "INBOX" not in loader.store.get("1", starred).labels
+    assert set(new_ids) <= stored_ids(loader)
+    assert cursor(loader) == str(mailbox.history_id)
+
+
+def test_message_added_and_deleted_between_polls_is_not_fetched(fake_gmail):
+    loader, api = fake_gmail
+    mailbox = api.mailboxes["1"]
+    sync(loader)
+    [msg_id] = mailbox.deliver(1)
+    mailbox.delete([msg_id])
+    api.reset_calls()
+    sync(loader)
+    assert api.calls.get("messages.get", 0) == 0
+    assert msg_id not in stored_ids(loader)
+
+
+def test_expired_cursor_falls_back_to_full_resync(fake_gmail):
+    loader, api = fake_gmail
+    mailbox = api.mailboxes["1"]
+    sync(loader)
+    mailbox.deliver(3)
+    # История старше первой хранимой записи: Gmail отвечает 404
+    loader._save_history_id("1", "1")
+    api.reset_calls()
+    sync(loader)
+    assert api.calls["history.list"] == 1
+    assert api.calls["getProfile"] == 1
+    assert stored_ids(loader) == set(mailbox.order)
+    assert cursor(loader) == str(mailbox.history_id)
+
+
+def test_backfill_error_is_not_reported_as_empty_mailbox(fake_gmail, monkeypatch, capsys):
+    loader, api = fake_gmail
+    api.add_mailbox("2", FakeMailbox("user2@example.com", size=5, seed=2))
+    db.execute("INSERT INTO auth_tokens (user_id, token) VALUES ('2', '{}')")
+
+    def forbidden(offset, limit):
+        raise _http_error(403, "forbidden")
+    monkeypatch.setattr(api.mailboxes["1"], "list_ids", forbidden)
+
+    emails = loader.init_emails(10, 10)
+    # Загрузка пользователя "1" прервалась с ошибкой в логе, пользователь "2" загружен
+    assert {email.user_id for email in emails} == {"2"}
+    assert "Failed to load emails for user 1" in capsys.readouterr().out
+    assert stored_ids(loader) == set()
+    assert api.calls["messages.list"] == 2
@@ -0,0 +1,123 @@
+from src.gmail.leases import LeaseManager
+from src.storage import db
+
+
+def add_users(count):
+    db.executemany("INSERT INTO auth_tokens (user_id, token) VALUES (?, '{}')",
+                   [(f"u{i:02d}",) for i in range(count)])
+
+
+def test_single_worker_takes_all_users():
+    add_users(5)
+    worker = LeaseManager(worker_id="a")
+    worker.heartbeat()
+    assert worker.owned_users() == [f"u{i:02d}" for i in range(5)]
+    assert worker.workers == 1
+
+
+def test_heartbeat_rebalances_when_workers_join_and_leave():
+    add_users(10)
+    a, b, c = LeaseManager(worker_id="a"), LeaseManager(worker_id="b"), LeaseManager(worker_id="c")
+    a.heartbeat()
+    b.heartbeat()
+    # a отдаёт лишних только на своём следующем heartbeat, после чего b добирает долю
+    a.heartbeat()
+    b.heartbeat()
+    assert (len(a.owned_users()), len(b.owned_users())) == (5, 5)
+
+    c.heartbeat()
+    a.heartbeat()
+    b.heartbeat()
+    c.heartbeat()
+    owned = [a.owned_users(), b.owned_users(), c.owned_users()]
+    assert sorted(map(len, owned)) == [2, 4, 4]
+    assert sorted(user_id for users in owned for user_id in users) == [f"u{i:02d}" for i in range(10)]
+
+    b.stop()
+    c.stop()
+    a.heartbeat()
+    assert len(a.owned_users()) == 10
+
+
+def test_busy_users_are_not_released():
+    add_users(4)
+    a, b = LeaseManager(worker_id="a"), LeaseManager(worker_id="b")
+    a.heartbeat()
+    b.heartbeat()
+    with a.syncing("u03") as held:
+        assert held
+        a.heartbeat()
+        assert a.holds("u03")
+    assert not b.holds("u03")
+
+
+def test_on_workers_reports_live_worker_count():
+    add_users(2)
+    counts = []
+    a, b = LeaseManager(worker_id="a"), LeaseManager(worker_id="b")
+    a.on_workers(counts.append)
+    a.heartbeat()
+    b.heartbeat()
+    a.heartbeat()
+    b.stop()
+    a.heartbeat()
+    assert counts == [1, 2, 1]
+
+
+def test_stop_releases_leases():
+    add_users(3)
+    worker = LeaseManager(worker_id="a")
+    worker.heartbeat()
+    worker.stop()
+    assert worker.owned_users() == []
+    assert db.query_one("SELECT COUNT(*) FROM user_leases")[0] == 0
+    assert db.query_one("SELECT COUNT(*) FROM sync_workers")[0] == 0
+
+
+def test_leases_of_dead_worker_are_taken_over():
+    add_users(4)
+    a = LeaseManager(worker_id="a")
+    # Процесс, переставший продлевать аренды: его срок уже истёк
+    dead = LeaseManager(worker_id="dead", ttl=-1)
+    a.heartbeat()
+    dead.heartbeat()
+    a.heartbeat()
+    assert len(a.owned_users()) == 4
+    assert a.workers == 1
+
+
+def test_removed_users_are_released():
+    add_users(3)
+    worker = LeaseManager(worker_id="a")
+    worker.heartbeat()
+    db.execute("DELETE FROM auth_tokens WHERE user_id = 'u01'")
+    worker.heartbeat()
+    assert worker.owned_users() == ["u00", "u02"]
+    assert not worker.holds("u01")
+
+
+def test_claimed_users_are_reported():
+    add_users(2)
+    claimed = []
+    worker = LeaseManager(worker_id="a")
+    worker.on_claimed(claimed.append)
+    worker.heartbeat()
+    worker.heartbeat()
+    assert claimed == [["u00", "u01"]]
+
+
+def test_released_users_are_reported():
+    add_users(4)
+    released = []
+    a, b = LeaseManager(worker_id="a"), LeaseManager(worker_id="b")
+    a.on_released(released.append)
+    a.heartbeat()
+    b.heartbeat()
+    a.heartbeat()
+    assert released == [["u02", "u03"]]
+    db.execute("DELETE FROM auth_tokens WHERE user_id = 'u00'")
+    a.heartbeat()
+    assert released[-1] == ["u00"]
+    a_owned = a.owned_users()
+    a.stop()
+    assert released[-1] == a_owned
@@ -0,0 +1,116 @@
+import asyncio
+
+from src.gmail.records import EmailRecord
+from src.pipeline import IngestPipeline
+
+
+class Loader:
+    def __init__(self, fail_users=()):
+        self.stored = []
+        self.fail_users = fail_users
+
+    def parse_messages(self, messages, user_id):
+        if user_id in self.fail_users:
+            raise ValueError("broken message")
+        return [EmailRecord(id=msg["id"], user_id=user_id, labels=msg["labelIds"]) for msg in messages]
+
+    def store_emails(self, emails):
+        self.stored.extend(email.id for email in emails)
+
+
+class Embeddings:
+    def embed_emails(self, emails):
+        return [[0.0] for _ in emails]
+
+
+class VectorDb:
+    def __init__(self):
+        self.indexed = []
+
+    def add_emails(self, emails, embeddings):
+        self.indexed.extend(email.id for email in emails)
+
+
+def message(msg_id, *labels):
+    return {"id": msg_id, "labelIds": list(labels)}
+
+
+async def run_pipeline(submissions, loader=None):
+    """Прогоняет пачки через конвейер из потока опроса, как EmailLoader, и возвращает уведомления."""
+    loop = asyncio.get_running_loop()
+    loader = loader or Loader()
+    pipeline = IngestPipeline(loader, Embeddings(), VectorDb(), loop)
+    notified = []
+
+    async def listener(user_id, emails):
+        notified.append((user_id, [email.id for email in emails]))
+
+    pipeline.add_listener(listener)
+    await pipeline.start()
+
+    def poll():
+        results = []
+        for user_id, messages, notify in submissions:
+            try:
+                results.append(pipeline.submit(user_id, messages, notify).result(timeout=5))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    results = await loop.run_in_executor(None, poll)
+    for queue in (pipeline._fetched, pipeline._parsed, pipeline._embedded, pipeline._indexed):
+        await queue.join()
+    await pipeline.stop()
+    return results, notified, loader
+
+
+def test_submit_resolves_after_emails_are_stored():
+    results, _, loader = asyncio.run(run_pipeline([("1", [message("a", "INBOX"), message("b", "INBOX")], True),
+                                                   ("1", [], True)]))
+    assert results == [2, 0]
+    assert loader.stored == ["a", "b"]
+
+
+def test_parse_failure_fails_the_batch_future():
+    results, notified, _ = asyncio.run(run_pipeline([("bad", [message("a", "INBOX")], True),
+                                                     ("1", [message("b", "INBOX")], True)],
+                                                    loader=Loader(fail_users={"bad"})))
+    assert isinstance(results[0], ValueError)
+    assert results[1] == 1
+    assert notified == [("1", ["b"])]
+
+
+def test_notifies_only_about_incoming_mail():
+    _, notified, loader = asyncio.run(run_pipeline([
+        ("1", [message("in", "INBOX", "UNREAD"), message("sent", "SENT"), message("draft", "DRAFT"),
+               message("sent-to-self", "INBOX", "SENT")], True),
+        ("1", [message("draft2", "DRAFT")], True),
+        ("2", [message("resync", "INBOX")], False),
+    ]))
+    assert notified == [("1", ["in"])]
+    # Сохраняются и индексируются все письма, фильтр касается только уведомлений
+    assert loader.stored == ["in", "sent", "draft", "sent-to-self", "draft2", "resync"]
+
+
+def test_stop_cancels_batches_still_queued():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        pipeline = IngestPipeline(Loader(), Embeddings(), VectorDb(), loop)
+        # Без стадий пачка остаётся в очереди fetched
+        pipeline._fetched = asyncio.Queue(1)
+        future = await loop.run_in_executor(None, pipeline.submit, "1", [message("a", "INBOX")])
+        await pipeline.stop()
+        return future
+
+    assert asyncio.run(scenario()).cancelled()
+
+
+def test_submit_after_stop_is_cancelled():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        pipeline = IngestPipeline(Loader(), Embeddings(), VectorDb(), loop)
+        await pipeline.start()
+        await pipeline.stop()
+        return await loop.run_in_executor(None, pipeline.submit, "1", [message("a", "INBOX")])
+
+    assert asyncio.run(scenario()).cancelled()
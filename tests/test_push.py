@@ -0,0 +1,95 @@
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from src.gmail.push import LocalPushPublisher, PushReceiver, WatchManager
+from src.storage import db
+
+
+class RecordingScheduler:
+    def __init__(self):
+        self.triggered = []
+        self.event = threading.Event()
+
+    def trigger(self, user_id):
+        self.triggered.append(user_id)
+        self.event.set()
+
+
+@pytest.fixture
+def push(fake_gmail):
+    """Приёмник на свободном порту, связанный с EmailLoader; ящик пользователя "1" подписан через watch."""
+    loader, api = fake_gmail
+    loader.scheduler = RecordingScheduler()
+    loader.watch_manager = WatchManager(loader, "projects/local/topics/gmail")
+    loader.watch_manager.watch("1")
+    receiver = PushReceiver(loader._on_push_notification, port=0, token="secret")
+    receiver.start()
+    yield loader, api, receiver
+    receiver.stop()
+
+
+def publish(receiver, email_address, history_id, token="secret"):
+    return LocalPushPublisher(f"{receiver.url}?token={token}").publish(email_address, history_id)
+
+
+def test_notification_triggers_the_mailbox_owner(push):
+    loader, api, receiver = push
+    loader._save_history_id("1", "1000")
+    assert publish(receiver, "User1@Example.com", 1005) == 204
+    assert loader.scheduler.event.wait(5)
+    assert loader.scheduler.triggered == ["1"]
+
+
+def test_notification_already_synced_is_ignored(push):
+    loader, _, receiver = push
+    loader._save_history_id("1", "2000")
+    assert publish(receiver, "user1@example.com", 1500) == 204
+    assert publish(receiver, "stranger@example.com", 5000) == 204
+    assert not loader.scheduler.event.wait(0.3)
+
+
+def test_notification_for_user_leased_elsewhere_is_ignored(push):
+    loader, _, receiver = push
+
+    class Leases:
+        def holds(self, user_id):
+            return False
+
+    loader.leases = Leases()
+    assert publish(receiver, "user1@example.com", 5000) == 204
+    assert not loader.scheduler.event.wait(0.3)
+
+
+def test_bad_token_is_rejected(push):
+    loader, _, receiver = push
+    with pytest.raises(urllib.error.HTTPError) as error:
+        publish(receiver, "user1@example.com", 5000, token="wrong")
+    assert error.value.code == 403
+    assert not loader.scheduler.event.wait(0.3)
+
+
+def test_malformed_envelope_is_rejected(push):
+    _, _, receiver = push
+    request = urllib.request.Request(receiver.url + "?token=secret", data=b'{"message": {}}', method="POST")
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request)
+    assert error.value.code == 400
+
+
+def test_request_threads_do_not_keep_connections(push):
+    loader, _, receiver = push
+    loader._save_history_id("1", "1000")
+    for history_id in range(1001, 1031):
+        publish(receiver, "user1@example.com", history_id)
+    deadline = time.monotonic() + 5
+    while len(loader.scheduler.triggered) < 30 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Каждый запрос обслуживает свой поток; их соединения закрываются вместе с ними
+    while len(db._connections) > 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(loader.scheduler.triggered) == 30
+    assert len(db._connections) <= 2
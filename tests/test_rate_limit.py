@@ -0,0 +1,74 @@
+import threading
+import time
+
+from src.gmail.rate_limit import BACKFILL, INTERACTIVE, LIVE, QuotaLimiter
+
+
+def start(limiter, order, name, user_id, units, priority):
+    def run():
+        limiter.acquire(user_id, units, priority)
+        order.append(name)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    # Даём вызову встать в очередь ожидающих
+    time.sleep(0.05)
+    return thread
+
+
+def test_blocked_user_does_not_delay_other_users():
+    limiter = QuotaLimiter(per_user_rate=100, global_rate=1000)
+    limiter.block_user("a", 1.0)
+    order = []
+    waiting = start(limiter, order, "a", "a", 1, INTERACTIVE)
+    started = time.monotonic()
+    limiter.acquire("b", 1, LIVE)
+    limiter.acquire("c", 1, BACKFILL)
+    assert time.monotonic() - started < 0.3
+    assert order == []
+    waiting.join(timeout=2)
+    assert order == ["a"]
+
+
+def test_same_user_lower_priority_waits():
+    limiter = QuotaLimiter(per_user_rate=10, global_rate=1000)
+    limiter.acquire("a", 10, LIVE)
+    order = []
+    # Одной единице квоты хватило бы через 0.1 с, но она не должна обгонять интерактивный вызов
+    high = start(limiter, order, "hi", "a", 5, INTERACTIVE)
+    low = start(limiter, order, "lo", "a", 1, BACKFILL)
+    high.join(timeout=2)
+    low.join(timeout=2)
+    assert order == ["hi", "lo"]
+
+
+def test_global_quota_goes_to_higher_priority_first():
+    limiter = QuotaLimiter(per_user_rate=1000, global_rate=10)
+    limiter.acquire("x", 10, LIVE)
+    order = []
+    low = start(limiter, order, "lo", "x", 5, BACKFILL)
+    high = start(limiter, order, "hi", "y", 5, INTERACTIVE)
+    low.join(timeout=2)
+    high.join(timeout=2)
+    assert order == ["hi", "lo"]
+
+
+def test_idle_user_buckets_are_swept(monkeypatch):
+    monkeypatch.setattr("src.gmail.rate_limit.SWEEP_INTERVAL", 0.0)
+    limiter = QuotaLimiter(per_user_rate=1000, global_rate=10000)
+    limiter.acquire("a", 1000)
+    limiter.block_user("b", 60)
+    time.sleep(0.01)
+    limiter.acquire("c", 1)
+    # Бакет "a" ещё пополняется, "b" закрыт по Retry-After, "c" только что потратил квоту
+    assert set(limiter._users) == {"a", "b", "c"}
+    time.sleep(1.0)
+    limiter.acquire("d", 1)
+    assert set(limiter._users) == {"b", "d"}
+
+
+def test_forget_drops_user_bucket():
+    limiter = QuotaLimiter()
+    limiter.acquire("a", 1)
+    limiter.forget("a")
+    limiter.forget("missing")
+    assert limiter._users == {}
@@ -0,0 +1,93 @@
+from src.gmail.email_store import EmailStore, HIGH
+from src.gmail.records import EmailRecord
+from src.result_sessions import ListCursor, ResultCursor, ResultSessions
+
+
+def make_email(message_id, timestamp=None, user_id="1"):
+    return EmailRecord(id=message_id, user_id=user_id, subject=message_id, sender="alice@example.com",
+                       timestamp=timestamp, labels=["INBOX"])
+
+
+def read_all(cursor, page_size):
+    seen, page = [], 0
+    while True:
+        _, emails, has_next = cursor.page(page, page_size)
+        seen.extend(email.id for email in emails)
+        if not has_next:
+            return seen
+        page += 1
+
+
+def store_cursor(store, user_id="1"):
+    return ResultCursor(lambda before, limit: store.find(user_id=user_id, limit=limit, before=before))
+
+
+def test_result_cursor_pages_through_emails_without_dates():
+    store = EmailStore()
+    # Письма без разобранной даты идут в конце выборки, по убыванию номера
+    store.save_many([make_email(f"m{i}", timestamp=i if i % 3 == 0 else None) for i in range(12)])
+    for page_size in (1, 3, 4, 5, 20):
+        seen = read_all(store_cursor(store), page_size)
+        assert seen == ["m9", "m6", "m3", "m0", "m11", "m10", "m8", "m7", "m5", "m4", "m2", "m1"]
+
+
+def test_result_cursor_skips_other_users_and_deleted():
+    store = EmailStore()
+    store.save_many([make_email(f"m{i}", timestamp=i) for i in range(6)] + [make_email("other", 3, user_id="2")])
+    store.mark_deleted("1", ["m2"])
+    assert read_all(store_cursor(store), 2) == ["m5", "m4", "m3", "m1", "m0"]
+
+
+def test_result_cursor_reopens_earlier_pages():
+    store = EmailStore()
+    store.save_many([make_email(f"m{i}", timestamp=i) for i in range(7)])
+    cursor = store_cursor(store)
+    first = [email.id for email in cursor.page(0, 3)[1]]
+    cursor.page(1, 3)
+    number, emails, has_next = cursor.page(2, 3)
+    assert (number, [email.id for email in emails], has_next) == (2, ["m0"], False)
+    assert [email.id for email in cursor.page(0, 3)[1]] == first
+    # Дальше последней известной страницы не прыгаем
+    assert cursor.page(10, 3)[0] == 2
+
+
+def test_importance_pages_include_undated_emails():
+    store = EmailStore()
+    emails = [make_email(f"m{i}", timestamp=i if i % 2 else None) for i in range(6)]
+    for email in emails:
+        email.importance = 0.9
+    store.save_many(emails)
+    store.save_importance(emails)
+    cursor = ResultCursor(lambda before, limit: store.find_by_importance("1", HIGH, limit, before))
+    assert read_all(cursor, 2) == ["m5", "m3", "m1", "m4", "m2", "m0"]
+
+
+def test_list_cursor_pages():
+    emails = [make_email(f"m{i}") for i in range(5)]
+    cursor = ListCursor(emails)
+    assert cursor.page(0, 2)[1:] == (emails[:2], True)
+    assert cursor.page(2, 2)[1:] == (emails[4:], False)
+    assert cursor.page(7, 2)[0] == 2
+    assert ListCursor([]).page(3, 2) == (0, [], False)
+
+
+def test_sessions_are_per_user_and_bounded():
+    sessions = ResultSessions(max_sessions=2, page_size=2)
+    first = sessions.open(1, ListCursor([make_email("a"), make_email("b"), make_email("c")]))
+    assert [email.id for email in first.emails] == ["a", "b"] and first.has_next
+    assert sessions.get(1, first.id) is first
+    # Новый поиск заменяет сессию, кнопки старого больше не листают
+    second = sessions.open(1, ListCursor([make_email("d")]))
+    assert sessions.get(1, first.id) is None
+    assert sessions.get("1", second.id) is second
+    sessions.open(2, ListCursor([]))
+    sessions.open(3, ListCursor([]))
+    assert len(sessions) == 2
+    assert sessions.get(1, second.id) is None
+
+
+def test_sessions_expire():
+    sessions = ResultSessions(ttl=0)
+    session = sessions.open(1, ListCursor([make_email("a")]))
+    session.touched_at -= 1
+    assert sessions.get(1, session.id) is None
@@ -0,0 +1,34 @@
+import os
+import threading
+
+from src.storage import db
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_connections_of_finished_threads_are_closed():
+    db.query_one("SELECT 1")
+    before = open_fds()
+
+    def query():
+        db.query_one("SELECT COUNT(*) FROM emails")
+
+    # Как у ThreadingHTTPServer: каждый запрос в своём коротком потоке
+    for _ in range(50):
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join()
+    assert len(db._connections) == 1
+    if os.path.isdir("/proc/self/fd"):
+        assert open_fds() <= before + 2
+
+
+def test_thread_reuses_its_connection():
+    assert db.connection() is db.connection()
+    other = []
+    thread = threading.Thread(target=lambda: other.append(db.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not db.connection()
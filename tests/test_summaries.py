@@ -0,0 +1,92 @@
+import time
+
+from src.gmail.email_store import EmailStore
+from src.gmail.records import EmailRecord
+from src.storage import db
+from src.summaries import ExtractiveSummaryBackend, SummaryEngine
+
+
+class Loader:
+    def __init__(self, bodies=None, fail=False):
+        self.store = EmailStore()
+        self.bodies = bodies or {}
+        self.fail = fail
+        self.requested = []
+
+    def get_email_bodies(self, user_id, emails, priority):
+        self.requested.append([email.id for email in emails])
+        if self.fail:
+            raise ConnectionError("Gmail недоступен")
+        return {email.id: self.bodies[email.id] for email in emails if email.id in self.bodies}
+
+
+class CountingBackend(ExtractiveSummaryBackend):
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    def summarize(self, texts):
+        self.texts.extend(texts)
+        return super().summarize(texts)
+
+
+def save(loader, *message_ids):
+    loader.store.save_many([EmailRecord(id=message_id, user_id="1", subject=message_id, snippet=f"snippet {message_id}",
+                                        timestamp=int(time.time()), labels=["INBOX"]) for message_id in message_ids])
+
+
+def test_extractive_summary_keeps_best_sentences_in_order():
+    text = ("Budget review moved to Friday. Lunch is at noon. The budget review needs the final budget numbers. "
+            "Parking is closed. Please send budget numbers before the review.")
+    summary = ExtractiveSummaryBackend(sentences=2).summarize([text])[0]
+    assert summary == "The budget review needs the final budget numbers. Please send budget numbers before the review."
+    assert ExtractiveSummaryBackend().summarize(["Short one."]) == ["Short one."]
+
+
+def test_summary_is_cached_by_content():
+    backend = CountingBackend()
+    loader = Loader(bodies={"a": "First sentence. Second sentence."})
+    save(loader, "a")
+    engine = SummaryEngine(loader, backend)
+    first = engine.get_summary("1", "a")
+    assert engine.get_summary("1", "a") == first
+    assert len(backend.texts) == 1
+    assert db.query_one("SELECT COUNT(*) FROM summary_cache")[0] == 1
+    # Текст изменился (скачали тело вместо сниппета) - сводка считается заново
+    loader.bodies["a"] = "Other text."
+    assert engine.get_summary("1", "a") == "Other text."
+    assert len(backend.texts) == 2
+
+
+def test_failed_body_download_falls_back_to_snippet():
+    loader = Loader(fail=True)
+    save(loader, "a")
+    assert SummaryEngine(loader).get_summary("1", "a") == "snippet a"
+
+
+def test_missing_email_has_no_summary():
+    assert SummaryEngine(Loader()).get_summary("1", "missing") is None
+
+
+def test_precompute_is_off_by_default():
+    loader = Loader(bodies={"a": "Body."})
+    save(loader, "a")
+    engine = SummaryEngine(loader)
+    engine.start()
+    engine.submit(loader.store.get_many("1", ["a"]))
+    assert engine._thread is None and engine._queue.empty()
+    assert loader.requested == []
+
+
+def test_precompute_summarizes_fresh_emails_in_batches():
+    loader = Loader(bodies={"a": "Body a.", "b": "Body b."})
+    save(loader, "a", "b")
+    old = EmailRecord(id="old", user_id="1", timestamp=int(time.time()) - 30 * 24 * 60 * 60)
+    engine = SummaryEngine(loader, precompute=True)
+    engine.submit(loader.store.get_many("1", ["a", "b"]) + [old])
+    engine.start()
+    deadline = time.monotonic() + 5
+    while db.query_one("SELECT COUNT(*) FROM summary_cache")[0] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    engine.stop()
+    assert loader.requested == [["a", "b"]]
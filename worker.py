@@ -0,0 +1,57 @@
+"""
+Процесс синхронизации почты без бота. Несколько таких процессов делят пользователей через
+аренды в SQLite (src/gmail/leases.py): каждый опрашивает только своих, а при запуске или
+падении процесса пользователи перераспределяются за один-два heartbeat.
+
+    GMAIL_SYNC_WORKERS=1 python interface.py          # бот без синхронизации
+    python worker.py --processes 3                    # столько раз, сколько нужно процессов
+    GMAIL_BOT_CHROMA_HOST=127.0.0.1:8000 ...          # общий сервер Chroma для индекса
+
+Все процессы должны видеть один файл базы (GMAIL_BOT_DB_PATH).
+"""
+import argparse
+import asyncio
+import signal
+
+from src.gmail.leases import HEARTBEAT_INTERVAL, LEASE_TTL
+from src.process_pool import default_processes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=default_processes(),
+                        help="процессов для разбора писем и эмбеддингов (0 - в потоках этого процесса)")
+    parser.add_argument("--worker-id", help="имя процесса в sync_workers, по умолчанию host:pid:случайный суффикс")
+    parser.add_argument("--lease-ttl", type=int, default=LEASE_TTL)
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL)
+    parser.add_argument("--metrics-port", type=int, help="порт /metrics этого процесса")
+    parser.add_argument("--precompute-summaries", action="store_true",
+                        help="заранее суммаризировать свежие письма (второй messages.get на письмо)")
+    return parser.parse_args()
+
+
+async def run(args):
+    import interface
+    from src.gmail.leases import LeaseManager
+    from src.metrics import start_metrics_server
+
+    interface.init_app(processes=args.processes, precompute_summaries=args.precompute_summaries)
+    if args.metrics_port:
+        start_metrics_server(port=args.metrics_port)
+    leases = LeaseManager(worker_id=args.worker_id, ttl=args.lease_ttl, heartbeat_interval=args.heartbeat)
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    try:
+        # Push-приёмник слушает один порт и получает уведомления по всем ящикам, поэтому здесь не запускается
+        await interface.start_sync(loop, leases=leases, push=False)
+        print(f"Sync worker {leases.worker_id} started with {len(leases.owned_users())} users")
+        await stopped.wait()
+    finally:
+        # Аренды отпускаются сразу, чтобы остальные процессы забрали пользователей без ожидания TTL
+        await interface.stop_sync()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))